@@ -79,6 +79,7 @@ import sabnzbd.cfg
 import sabnzbd.downloader
 from sabnzbd.encoding import unicoder, latin1
 import sabnzbd.growler as growler
+import sabnzbd.events as events
 
 from threading import Thread
 
@@ -196,7 +197,8 @@ class guiHandler(logging.Handler):
             self.store.append(self.format(record))
         except UnicodeDecodeError:
             # Catch elusive Unicode conversion problems
-            pass
+            return
+        events.post('warning', {'text' : self.store[-1]})
 
     def clear(self):
         self.store = []
@@ -495,9 +497,9 @@ def print_modules():
             logging.info("ionice binary... NOT found!")
 
     if sabnzbd.newswrapper.HAVE_SSL:
-        logging.info("pyOpenSSL... found (%s)", sabnzbd.newswrapper.HAVE_SSL)
+        logging.info("SSL... found (%s)", sabnzbd.newswrapper.HAVE_SSL)
     else:
-        logging.info("pyOpenSSL... NOT found - try apt-get install python-pyopenssl (SSL is optional)")
+        logging.info("SSL... NOT found - use Python 2.7.9 or newer, or install python-pyopenssl (SSL is optional)")
 
 
 #------------------------------------------------------------------------------
@@ -1407,6 +1409,7 @@ def main():
     cherrypy.config.update({'server.environment': 'production',
                             'server.socket_host': cherryhost,
                             'server.socket_port': cherryport,
+                            'server.thread_pool': 10 + MAX_EVENT_WATCHERS,
                             'log.screen': cherrylogtoscreen,
                             'engine.autoreload_frequency' : 100,
                             'engine.autoreload_on' : False,
@@ -1430,9 +1433,13 @@ def main():
         staticcfg = {'tools.staticdir.on': True, 'tools.staticdir.dir': os.path.join(web_dirc, 'staticcfg')}
     wizard_static = {'tools.staticdir.on': True, 'tools.staticdir.dir': os.path.join(wizard_dir, 'static')}
 
+    events_conf = {'tools.basic_auth.on' : False, 'response.stream' : True}
     appconfig = {'/sabnzbd/api' : {'tools.basic_auth.on' : False},
                  '/api' : {'tools.basic_auth.on' : False},
                  '/m/api' : {'tools.basic_auth.on' : False},
+                 '/sabnzbd/events' : events_conf,
+                 '/events' : events_conf,
+                 '/m/events' : events_conf,
                  '/rss' : {'tools.basic_auth.on' : False},
                  '/sabnzbd/rss' : {'tools.basic_auth.on' : False},
                  '/m/rss' : {'tools.basic_auth.on' : False},
@@ -1450,6 +1457,7 @@ def main():
         static2 = {'tools.staticdir.on': True, 'tools.staticdir.dir': os.path.join(web_dir2, 'static')}
         appconfig['/sabnzbd/m/api'] = {'tools.basic_auth.on' : False}
         appconfig['/sabnzbd/m/rss'] = {'tools.basic_auth.on' : False}
+        appconfig['/sabnzbd/m/events'] = events_conf
         appconfig['/sabnzbd/m/shutdown'] = {'streamResponse': True}
         appconfig['/sabnzbd/m/static'] = static2
         appconfig['/m/static'] = static2
@@ -85,6 +85,7 @@ import sabnzbd.config as config
 from sabnzbd.bpsmeter import BPSMeter
 import sabnzbd.cfg as cfg
 import sabnzbd.database
+import sabnzbd.events as events
 import sabnzbd.lang as lang
 import sabnzbd.api
 from sabnzbd.decorators import *
@@ -239,6 +240,9 @@ def initialize(pause_downloader = False, clean_up = False, evalSched=False, repa
     cfg.https_cert.callback(guard_restart)
     cfg.https_key.callback(guard_restart)
     cfg.enable_https.callback(guard_restart)
+    cfg.poller.callback(guard_restart)
+    cfg.decoder_workers.callback(guard_restart)
+    cfg.assembler_workers.callback(guard_restart)
     cfg.bandwidth_limit.callback(guard_speedlimit)
     cfg.top_only.callback(guard_top_only)
     cfg.pause_on_post_processing.callback(guard_pause_on_pp)
@@ -358,6 +362,8 @@ def halt():
     if __INITIALIZED__:
         logging.info('SABnzbd shutting down...')
         __SHUTTING_DOWN__ = True
+        # Release the clients waiting for events
+        events.post('shutdown', {})
 
         rss.stop()
 
@@ -384,6 +390,8 @@ def halt():
         except:
             pass
 
+        logging.debug('Stopping queue loader')
+        NzbQueue.do.stop_loading()
 
         ## Stop Required Objects ##
         logging.debug('Stopping downloader')
@@ -1031,7 +1039,6 @@ def check_all_tasks():
     if not sabnzbd.scheduler.sched_check():
         logging.info('Restarting crashed scheduler')
         sabnzbd.scheduler.init()
-        sabnzbd.downloader.Downloader.do.unblock_all()
 
     # Check one-shot pause
     sabnzbd.scheduler.pause_check()
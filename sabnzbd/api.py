@@ -63,6 +63,8 @@ from sabnzbd.database import build_history_info, unpack_history_info, get_histor
 import sabnzbd.growler
 import sabnzbd.rss
 import sabnzbd.emailer
+import sabnzbd.revisions as revisions
+import sabnzbd.events as events
 
 
 #------------------------------------------------------------------------------
@@ -98,7 +100,7 @@ def api_handler(kwargs):
     if isinstance(mode, list): mode = mode[0]
     if isinstance(output, list): output = output[0]
     response = _api_table.get(mode, _api_undefined)(name, output, kwargs)
-    if output == 'json' and callback:
+    if output == 'json' and callback and response:
         response = '%s(%s)' % (callback, response)
     return response
 
@@ -244,12 +246,13 @@ def _api_queue_sort(output, value, kwargs):
 
 
 def _api_queue_default(output, value, kwargs):
-    """ API: accepts output, sort, dir, start, limit """
+    """ API: accepts output, sort, dir, start, limit, since """
     sort = kwargs.get('sort')
     direction = kwargs.get('dir', '')
     start = kwargs.get('start')
     limit = kwargs.get('limit')
     trans = kwargs.get('trans')
+    since = kwargs.get('since')
 
     if output in ('xml', 'json'):
         if sort and sort != 'index':
@@ -259,8 +262,14 @@ def _api_queue_default(output, value, kwargs):
         # &history=1 will show unprocessed items in the history
         history = bool(kwargs.get('history'))
 
+        # Take the revision before building, later changes are in the next one
+        revision = revisions.current()
+        if not_modified('q%s' % revision_tag(revision, kwargs)):
+            return ''
+
         info, pnfo_list, bytespersec, verbose_list, dictn = \
-            build_queue(history=history, start=start, limit=limit, output=output, trans=trans)
+            build_queue(history=history, start=start, limit=limit, output=output, trans=trans, since=since)
+        info['revision'] = revision
         info['categories'] = info.pop('cat_list')
         info['scripts'] = info.pop('script_list')
         return report(output, keyword='queue', data=remove_callable(info))
@@ -416,12 +425,16 @@ def _api_fullstatus(name, output, kwargs):
 
 
 def _api_history(name, output, kwargs):
-    """ API: accepts output, value(=nzo_id), start, limit, search """
+    """ API: accepts output, value(=nzo_id), start, limit, search, sort, since
+        name=totals accepts from, to (as YYYY-MM-DD), cat
+    """
     value = kwargs.get('value', '')
     start = kwargs.get('start')
     limit = kwargs.get('limit')
     search = kwargs.get('search')
+    sort = kwargs.get('sort')
     failed_only = kwargs.get('failed_only')
+    since = int_conv(kwargs.get('since'))
 
     if name == 'delete':
         special = value.lower()
@@ -443,12 +456,37 @@ def _api_history(name, output, kwargs):
         else:
             return report(output, _MSG_NO_VALUE)
     elif not name:
+        revision = revisions.current()
+        if not_modified('h%s' % revision_tag(revision, kwargs)):
+            return ''
         history, pnfo_list, bytespersec = build_header(True)
         grand, month, week, day = BPSMeter.do.get_sums()
         history['total_size'], history['month_size'], history['week_size'], history['day_size'] = \
                to_units(grand), to_units(month), to_units(week), to_units(day)
-        history['slots'], fetched_items, history['noofslots'] = build_history(start=start, limit=limit, verbose=True, search=search, failed_only=failed_only)
+        history['slots'], fetched_items, history['noofslots'] = build_history(start=start, limit=limit, verbose=True, search=search, failed_only=failed_only, sort=sort)
+        history['revision'] = revision
+        history['delta'] = revisions.valid(since)
+        if history['delta']:
+            # Only the changed jobs and the ones still in post-processing,
+            # plus the order of the page so that clients can drop the others
+            active = [nzo.nzo_id for nzo in PostProcessor.do.get_queue()]
+            history['nzo_ids'] = [item['nzo_id'] for item in history['slots']]
+            history['slots'] = [item for item in history['slots'] if item['nzo_id'] in active or \
+                                revisions.changed('history', item['nzo_id'], since)]
         return report(output, keyword='history', data=remove_callable(history))
+    elif name == 'totals':
+        first = kwargs.get('from')
+        last = kwargs.get('to')
+        cat = kwargs.get('cat')
+        history_db = cherrypy.thread_data.history_db
+        total, jobs = history_db.get_totals(first, last, cat)
+        info = {'bytes' : total, 'size' : to_units(total), 'jobs' : jobs}
+        info['days'] = [{'day' : day, 'bytes' : size, 'jobs' : count}
+                        for day, size, count in history_db.get_daily_totals(first, last, cat)]
+        if cat is None:
+            info['categories'] = [{'cat' : category, 'bytes' : size, 'jobs' : count}
+                                  for category, size, count in history_db.get_category_totals(first, last)]
+        return report(output, keyword='totals', data=info)
     else:
         return report(output, _MSG_NOT_IMPLEMENTED)
 
@@ -532,6 +570,25 @@ def _api_warnings(name, output, kwargs):
     return report(output, keyword="warnings", data=sabnzbd.GUIHANDLER.content())
 
 
+def _api_events(name, output, kwargs):
+    """ API: accepts output, since, timeout (long-poll for events) """
+    since = kwargs.get('since')
+    if since is None:
+        # First call, only tell where the events start
+        return report(output, keyword='events', data={'last' : events.last(), 'reset' : False, 'events' : []})
+    since = int_conv(since)
+    timeout = min(max(int_conv(kwargs.get('timeout', 30)), 0), EVENT_POLL_TIMEOUT)
+    if timeout and events.watch():
+        try:
+            last, reset, lst = events.get(since, timeout)
+        finally:
+            events.unwatch()
+    else:
+        last, reset, lst = events.get(since)
+    return report(output, keyword='events', data={'last' : last, 'reset' : reset,
+                                                  'events' : [events.as_dict(event) for event in lst]})
+
+
 def _api_get_cats(name, output, kwargs):
     """ API: accepts output """
     return report(output, keyword="categories", data=list_cats(False))
@@ -775,6 +832,7 @@ _api_table = {
     'resume'          : _api_resume,
     'shutdown'        : _api_shutdown,
     'warnings'        : _api_warnings,
+    'events'          : _api_events,
     'config'          : _api_config,
     'get_cats'        : _api_get_cats,
     'get_scripts'     : _api_get_scripts,
@@ -878,6 +936,41 @@ def report(output, error=None, keyword='value', data=None, callback=None, compat
     return response
 
 
+def revision_tag(revision, kwargs):
+    """ Return tag for the output of a request with 'kwargs' at 'revision',
+        the header values that change without a new revision are part of it
+    """
+    return '%x-%x' % (revision, hash(repr((header_state(), sorted(kwargs.items())))) & 0xffffffff)
+
+
+def header_state():
+    """ Return the values shown by build_header that are not covered
+        by the queue revision
+    """
+    return (Downloader.do.paused, scheduler.pause_int(), sabnzbd.PAUSED_ALL,
+            Downloader.do.get_limit(), BPSMeter.do.get_bps() / KIBI,
+            sabnzbd.GUIHANDLER.count(), sabnzbd.GUIHANDLER.last(),
+            "%.2f" % diskfree(cfg.download_dir.get_path()),
+            "%.2f" % diskfree(cfg.complete_dir.get_path()),
+            "%.2f" % disktotal(cfg.download_dir.get_path()),
+            "%.2f" % disktotal(cfg.complete_dir.get_path()),
+            sabnzbd.RESTART_REQ, sabnzbd.QUEUECOMPLETE, sabnzbd.NEW_VERSION,
+            BPSMeter.do.quota, BPSMeter.do.left)
+
+
+def not_modified(tag):
+    """ Set 'tag' as ETag of the response, return True when the client
+        already has this version (response becomes '304 Not Modified')
+    """
+    etag = '"%s"' % tag
+    cherrypy.response.headers['ETag'] = etag
+    match = cherrypy.request.headers.get('If-None-Match', '')
+    if etag in [item.strip() for item in match.split(',')]:
+        cherrypy.response.status = 304
+        return True
+    return False
+
+
 #------------------------------------------------------------------------------
 class xml_factory(object):
     """
@@ -995,7 +1088,8 @@ def handle_cat_api(output, kwargs):
 
 #------------------------------------------------------------------------------
 def build_queue(web_dir=None, root=None, verbose=False, prim=True, webdir='', verbose_list=None,
-                dictionary=None, history=False, start=None, limit=None, dummy2=None, trans=False, output=None):
+                dictionary=None, history=False, start=None, limit=None, dummy2=None, trans=False, output=None,
+                since=None):
     if output:
         converter = unicoder
     else:
@@ -1038,6 +1132,10 @@ def build_queue(web_dir=None, root=None, verbose=False, prim=True, webdir='', ve
 
     limit = int_conv(limit)
     start = int_conv(start)
+    since = int_conv(since)
+    # Only send the jobs changed after revision 'since'
+    delta = revisions.valid(since)
+    page_ids = []
 
     if history:
         #Collect nzo's from the history that are downloaded but not finished (repairing, extracting)
@@ -1057,6 +1155,27 @@ def build_queue(web_dir=None, root=None, verbose=False, prim=True, webdir='', ve
         info['finish'] = info['noofslots']
 
     for pnfo in pnfo_list:
+        status = pnfo[PNFO_STATUS_FIELD]
+        in_page = not limit or start <= n < start + limit
+        if in_page:
+            page_ids.append(pnfo[PNFO_NZO_ID_FIELD])
+        # The downloading job is always sent, its ETA changes all the time
+        active = not Downloader.do.paused and status != 'Paused' and status != 'Fetching' and not found_active
+        if not in_page or (delta and not active and
+                           not revisions.changed('queue', pnfo[PNFO_NZO_ID_FIELD], since)):
+            # Only keep the running totals
+            if active:
+                found_active = True
+            if status not in (Status.PAUSED, Status.CHECKING):
+                bytesleft = pnfo[PNFO_BYTES_LEFT_FIELD]
+                running_bytes += bytesleft
+                try:
+                    datestart = datestart + datetime.timedelta(seconds=bytesleft / bytespersec)
+                except:
+                    datestart = datetime.datetime.now()
+            n += 1
+            continue
+
         repair = pnfo[PNFO_REPAIR_FIELD]
         unpack = pnfo[PNFO_UNPACK_FIELD]
         delete = pnfo[PNFO_DELETE_FIELD]
@@ -1199,8 +1318,7 @@ def build_queue(web_dir=None, root=None, verbose=False, prim=True, webdir='', ve
             slot['queued'] = queued
 
 
-        if (start <= n  and n < start + limit) or not limit:
-            slotinfo.append(slot)
+        slotinfo.append(slot)
         n += 1
 
     if slotinfo:
@@ -1208,6 +1326,9 @@ def build_queue(web_dir=None, root=None, verbose=False, prim=True, webdir='', ve
     else:
         info['slots'] = []
         verbose_list = []
+    info['delta'] = delta
+    if delta:
+        info['nzo_ids'] = page_ids
 
     #Paging of the queue using limit and/or start values
     if limit > 0:
@@ -1601,6 +1722,12 @@ def build_header(prim, webdir=''):
     header['cache_size'] = format_bytes(anfo[ANFO_CACHE_SIZE_FIELD])
     header['cache_max'] = str(anfo[ANFO_CACHE_LIMIT_FIELD])
 
+    queued, workers, busy, throttled = Downloader.do.decoder.info()
+    header['decode_queue'] = str(queued)
+    header['decode_workers'] = str(workers)
+    header['decode_busy'] = str(busy)
+    header['decode_throttled'] = str(throttled)
+
     header['nzb_quota'] = ''
 
     if sabnzbd.NEW_VERSION:
@@ -1624,7 +1751,7 @@ def build_header(prim, webdir=''):
 
 #------------------------------------------------------------------------------
 
-def build_history(start=None, limit=None, verbose=False, verbose_list=None, search=None, failed_only=0):
+def build_history(start=None, limit=None, verbose=False, verbose_list=None, search=None, failed_only=0, sort=None):
 
     if not verbose_list:
         verbose_list = []
@@ -1634,22 +1761,19 @@ def build_history(start=None, limit=None, verbose=False, verbose_list=None, sear
     start = int_conv(start)
     failed_only = int_conv(failed_only)
 
-    def matches_search(text, search_text):
+    # Grab any items that are active or queued in postproc
+    queue = PostProcessor.do.get_queue()
+
+    # Filter out any items that don't match the search
+    if search and queue:
         # Replace * with .* and ' ' with .
-        search_text = search_text.strip().replace('*','.*').replace(' ','.*') + '.*?'
+        search_text = search.strip().replace('*','.*').replace(' ','.*') + '.*?'
         try:
             re_search = re.compile(search_text, re.I)
+            queue = [nzo for nzo in queue if re_search.search(nzo.final_name)]
         except:
             logging.error(Ta('Failed to compile regex for search term: %s'), search_text)
-            return False
-        return re_search.search(text)
-
-    # Grab any items that are active or queued in postproc
-    queue = PostProcessor.do.get_queue()
-
-    # Filter out any items that don't match the search
-    if search:
-        queue = [nzo for nzo in queue if matches_search(nzo.final_name, search)]
+            queue = []
 
     # Multi-page support for postproc items
     full_queue_size = len(queue)
@@ -1679,11 +1803,11 @@ def build_history(start=None, limit=None, verbose=False, verbose_list=None, sear
 
     # Fetch history items
     if not h_limit:
-        items, fetched_items, total_items = history_db.fetch_history(h_start, 1, search, failed_only)
+        items, fetched_items, total_items = history_db.fetch_history(h_start, 1, search, failed_only, sort)
         items = []
         fetched_items = 0
     else:
-        items, fetched_items, total_items = history_db.fetch_history(h_start, h_limit, search, failed_only)
+        items, fetched_items, total_items = history_db.fetch_history(h_start, h_limit, search, failed_only, sort)
 
     # Fetch which items should show details from the cookie
     k = []
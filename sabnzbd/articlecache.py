@@ -19,11 +19,17 @@
 sabnzbd.articlecache - Article cache handling
 """
 
+import os
 import logging
 import threading
+from collections import OrderedDict
 
 import sabnzbd
 from sabnzbd.decorators import synchronized
+import sabnzbd.cfg as cfg
+
+# Maximum number of part files kept open for direct writing
+MAX_PART_FILES = 16
 
 
 ARTICLE_LOCK = threading.Lock()
@@ -34,13 +40,16 @@ class ArticleCache(object):
         self.__cache_limit = 0
         self.__cache_size = 0
 
-        self.__article_list = []    # List of buffered articles
-        self.__article_table = {}   # Dict of buffered articles
+        # Buffered articles, oldest first
+        self.__article_table = OrderedDict()
+
+        # Open part files for direct writing, least recently used first
+        self.__part_files = OrderedDict()
         ArticleCache.do = self
 
     @synchronized(ARTICLE_LOCK)
     def cache_info(self):
-        return (len(self.__article_list), self.__cache_size, self.__cache_limit)
+        return (len(self.__article_table), self.__cache_size, self.__cache_limit)
 
     @synchronized(ARTICLE_LOCK)
     def new_limit(self, limit):
@@ -60,10 +69,7 @@ class ArticleCache(object):
                 logging.debug("%s would be discarded", article)
             # return
 
-        saved_articles = article.nzf.nzo.saved_articles
-
-        if article not in saved_articles:
-            saved_articles.append(article)
+        nzo.saved_articles.add(article)
 
         if self.__cache_limit:
             if self.__cache_limit < 0:
@@ -73,10 +79,9 @@ class ArticleCache(object):
                 data_size = len(data)
 
                 while (self.__cache_size > (self.__cache_limit - data_size)) \
-                and self.__article_list:
+                and self.__article_table:
                     ## Flush oldest article in cache
-                    old_article = self.__article_list.pop(0)
-                    old_data = self.__article_table.pop(old_article)
+                    old_article, old_data = self.__article_table.popitem(last=False)
                     self.__cache_size -= len(old_data)
                     ## No need to flush if this is a refreshment article
                     if old_article != article:
@@ -92,45 +97,88 @@ class ArticleCache(object):
             self.__flush_article(article, data)
 
     @synchronized(ARTICLE_LOCK)
-    def load_article(self, article):
+    def load_article(self, article, remove=True):
+        """ Return the data of the article, 'remove' its disk copy """
         data = None
         nzo = article.nzf.nzo
 
-        if article in self.__article_list:
+        if article in self.__article_table:
             data = self.__article_table.pop(article)
-            self.__article_list.remove(article)
             self.__cache_size -= len(data)
             if sabnzbd.LOG_ALL:
                 logging.debug("Loaded %s from cache", article)
         elif article.art_id:
-            data = sabnzbd.load_data(article.art_id, nzo.workpath, remove=True,
+            data = sabnzbd.load_data(article.art_id, nzo.workpath, remove=remove,
                                      do_pickle=False, silent=True)
 
-        if article in nzo.saved_articles:
-            nzo.saved_articles.remove(article)
+        nzo.saved_articles.discard(article)
 
         return data
 
     @synchronized(ARTICLE_LOCK)
     def flush_articles(self):
         self.__cache_size = 0
-        while self.__article_list:
-            article = self.__article_list.pop(0)
-            data = self.__article_table.pop(article)
+        while self.__article_table:
+            article, data = self.__article_table.popitem(last=False)
             self.__flush_article(article, data)
+        while self.__part_files:
+            self.__part_files.popitem(last=False)[1].close()
 
     @synchronized(ARTICLE_LOCK)
     def purge_articles(self, articles):
         if sabnzbd.LOG_ALL:
             logging.debug("Purgable articles -> %s", articles)
         for article in articles:
-            if article in self.__article_list:
-                self.__article_list.remove(article)
-                data = self.__article_table.pop(article)
+            data = self.__article_table.pop(article, None)
+            if data is not None:
                 self.__cache_size -= len(data)
             if article.art_id:
                 sabnzbd.remove_data(article.art_id, article.nzf.nzo.workpath)
 
+    @synchronized(ARTICLE_LOCK)
+    def write_part(self, article, data):
+        """ Write article data in place, raises IOError on failure """
+        self.__write_part(article, data)
+
+    @synchronized(ARTICLE_LOCK)
+    def close_part(self, nzf):
+        """ Close part file of nzf, return its full path """
+        fout = self.__part_files.pop(nzf, None)
+        if fout:
+            fout.close()
+        return os.path.join(nzf.nzo.workpath, nzf.get_part_id())
+
+    @synchronized(ARTICLE_LOCK)
+    def close_parts(self, nzo):
+        """ Close all part files of the job """
+        for nzf in self.__part_files.keys():
+            if nzf.nzo is nzo:
+                self.__part_files.pop(nzf).close()
+
+    def __write_part(self, article, data):
+        """ Write the decoded data at its offset in the part file of the nzf """
+        nzf = article.nzf
+        fout = self.__part_files.pop(nzf, None)
+        try:
+            if not fout:
+                path = os.path.join(nzf.nzo.workpath, nzf.get_part_id())
+                fout = open(path, 'r+b')
+                if nzf.file_size and not os.fstat(fout.fileno()).st_size:
+                    # Reserve the full size, the parts fill it in any order
+                    fout.truncate(nzf.file_size)
+                while len(self.__part_files) >= MAX_PART_FILES:
+                    self.__part_files.popitem(last=False)[1].close()
+            fout.seek(article.offset)
+            fout.write(data)
+        except:
+            if fout:
+                fout.close()
+            raise
+        self.__part_files[nzf] = fout
+        nzf.set_part_done(article.partnum)
+        if sabnzbd.LOG_ALL:
+            logging.debug("Written %s in place", article)
+
     def __flush_article(self, article, data):
         nzf = article.nzf
         nzo = nzf.nzo
@@ -142,6 +190,16 @@ class ArticleCache(object):
                 logging.debug("%s would be discarded", article)
             # return
 
+        if nzf.write_direct() and article.offset is not None:
+            try:
+                self.__write_part(article, data)
+                nzo.saved_articles.discard(article)
+                return
+            except (IOError, OSError):
+                # Saved on its own, the assembler tries again
+                logging.error(Ta('Disk error on creating file %s'), nzf.part_id)
+                logging.info("Traceback: ", exc_info = True)
+
         art_id = article.get_art_id()
         if art_id:
             if sabnzbd.LOG_ALL:
@@ -154,9 +212,8 @@ class ArticleCache(object):
 
     def __add_to_cache(self, article, data):
         if article in self.__article_table:
+            # Refreshment keeps the original position in the cache
             self.__cache_size -= len(self.__article_table[article])
-        else:
-            self.__article_list.append(article)
 
         self.__article_table[article] = data
         self.__cache_size += len(data)
@@ -23,9 +23,9 @@ import os
 import Queue
 import binascii
 import logging
+import shutil
 import struct
-from threading import Thread
-from time import sleep
+from threading import Thread, Condition, Lock
 try:
     import hashlib
     new_md5 = hashlib.md5
@@ -36,7 +36,8 @@ except:
 import sabnzbd
 from sabnzbd.misc import get_filepath, sanitize_filename, get_unique_path, renamer, \
                          set_permissions, flag_file
-from sabnzbd.constants import QCHECK_FILE
+from sabnzbd.constants import QCHECK_FILE, ASSEMBLER_BATCH, MAX_ASSEMBLER_QUEUE
+from sabnzbd.decorators import NZBQUEUE_LOCK
 import sabnzbd.cfg as cfg
 from sabnzbd.articlecache import ArticleCache
 from sabnzbd.postproc import PostProcessor
@@ -46,23 +47,109 @@ from sabnzbd.encoding import latin1, unicoder, is_utf8
 
 
 #------------------------------------------------------------------------------
-class Assembler(Thread):
+class Assembler(object):
+    """ Pool of assembler threads
+        Articles are appended to the part file of their NzbFile as soon as they
+        are contiguous, the complete file only needs to be finished and renamed.
+        All work for one file is done by the same thread.
+    """
     do = None # Link to the instance of this method
 
-    def __init__ (self, queue = None):
-        Thread.__init__(self)
+    def __init__ (self):
+        workers = cfg.assembler_workers()
+        self.workers = [AssemblerWorker(self, n) for n in xrange(workers)]
+        self.max_backlog = MAX_ASSEMBLER_QUEUE * workers
 
-        if queue:
-            self.queue = queue
-        else:
-            self.queue = Queue.Queue()
+        self.cv = Condition(Lock())
+        self.backlog = 0    # Queued file jobs, used to hold back the decoder
+        self.jobs = {}      # Number of queued file jobs per nzo
+        self.post = []      # Jobs waiting for their files before post-processing
         Assembler.do = self
 
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
     def stop(self):
-        self.process(None)
+        for worker in self.workers:
+            worker.queue.put(None)
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+    def isAlive(self):
+        for worker in self.workers:
+            if not worker.isAlive():
+                return False
+        return True
 
     def process(self, job):
-        self.queue.put(job)
+        """ Queue a completed file (nzo, nzf) or the end of a job (nzo, None) """
+        nzo, nzf = job
+        if nzf:
+            self.__put(('file', nzo, nzf, None))
+        else:
+            self.cv.acquire()
+            try:
+                if self.jobs.get(nzo):
+                    # Post-processing has to wait for the files
+                    self.post.append(nzo)
+                    return
+            finally:
+                self.cv.release()
+            self.workers[0].queue.put(('post', nzo, None, None))
+
+    def stream(self, nzo, nzf, article):
+        """ Queue a registered article for writing, when it is contiguous """
+        self.__put(('stream', nzo, nzf, article))
+
+    def __put(self, job):
+        kind, nzo, nzf, article = job
+        self.cv.acquire()
+        try:
+            self.backlog += 1
+            self.jobs[nzo] = self.jobs.get(nzo, 0) + 1
+        finally:
+            self.cv.release()
+        self.workers[hash(nzf) % len(self.workers)].queue.put(job)
+
+    def job_done(self, nzo):
+        """ Called by the workers when a file job is finished """
+        self.cv.acquire()
+        try:
+            self.backlog -= 1
+            left = self.jobs.get(nzo, 1) - 1
+            if left:
+                self.jobs[nzo] = left
+            else:
+                self.jobs.pop(nzo, None)
+                if nzo in self.post:
+                    self.post.remove(nzo)
+                    self.workers[0].queue.put(('post', nzo, None, None))
+            self.cv.notifyAll()
+        finally:
+            self.cv.release()
+
+    def wait_for_room(self):
+        """ Block the calling thread while the disk cannot keep up """
+        self.cv.acquire()
+        try:
+            while self.backlog > self.max_backlog and self.isAlive():
+                self.cv.wait(1.0)
+        finally:
+            self.cv.release()
+
+
+class AssemblerWorker(Thread):
+    def __init__(self, pool, num):
+        Thread.__init__(self, name='Assembler-%d' % num)
+        self.pool = pool
+        self.queue = Queue.Queue()
+
+        self.pending = {}   # nzf -> {partnum: article} registered, but not yet written
+        self.partnums = {}  # nzf -> sorted partnums
+        self.md5s = {}      # nzf -> md5 of the data written so far
 
     def run(self):
         import sabnzbd.nzbqueue
@@ -72,50 +159,173 @@ class Assembler(Thread):
                 logging.info("Shutting down")
                 break
 
-            nzo, nzf = job
-
-            if nzf:
-                sabnzbd.CheckFreeSpace()
-                filename = sanitize_filename(nzf.filename)
-                nzf.filename = filename
-
-                dupe = nzo.check_for_dupe(nzf)
-
-                filepath = get_filepath(cfg.download_dir.get_path(), nzo, filename)
-
-                if filepath:
-                    logging.info('Decoding %s %s', filepath, nzf.type)
-                    try:
-                        filepath = _assemble(nzf, filepath, dupe)
-                    except IOError, (errno, strerror):
-                        # 28 == disk full => pause downloader
-                        if errno == 28:
-                            logging.error(Ta('Disk full! Forcing Pause'))
-                        else:
-                            logging.error(Ta('Disk error on creating file %s'), latin1(filepath))
-                        # Pause without saving
-                        sabnzbd.downloader.Downloader.do.pause(save=False)
-                    except:
-                        logging.error('Fatal error in Assembler', exc_info = True)
-                        break
-
-                    nzf.remove_admin()
-                    setname = nzf.setname
-                    if nzf.is_par2 and (nzo.md5packs.get(setname) is None):
-                        pack = GetMD5Hashes(filepath)[0]
-                        if pack:
-                            nzo.md5packs[setname] = pack
-                            logging.debug('Got md5pack for set %s', setname)
-
-                    if check_encrypted_rar(nzo, filepath):
-                        logging.warning(Ta('WARNING: Paused job "%s" because of encrypted RAR file'), latin1(nzo.final_name))
-                        nzo.pause()
-            else:
+            kind, nzo, nzf, article = job
+            if kind == 'post':
                 sabnzbd.nzbqueue.NzbQueue.do.remove(nzo.nzo_id, add_to_history=False, cleanup=False)
                 PostProcessor.do.process(nzo)
-
-
-def _assemble(nzf, path, dupe):
+                continue
+
+            try:
+                if kind == 'stream':
+                    self.stream(nzo, nzf, article)
+                else:
+                    self.finish(nzo, nzf)
+            except:
+                logging.error('Fatal error in Assembler', exc_info = True)
+                break
+            finally:
+                self.pool.job_done(nzo)
+
+    def stream(self, nzo, nzf, article):
+        """ Append the contiguous registered articles to the part file """
+        if nzo.deleted or nzf.deleted:
+            # Leave the rest to the file completion
+            return
+        if not article and nzf not in self.pending:
+            # Continuation queued before the file was finished
+            return
+
+        pending = self.pending.setdefault(nzf, {})
+        if article:
+            pending[article.partnum] = article
+
+        partnums = self.partnums.get(nzf)
+        if not partnums:
+            partnums = self.partnums[nzf] = sorted(nzf.decodetable)
+
+        start = nzf.assembled or 0
+        end = start
+        while end < len(partnums) and end - start < ASSEMBLER_BATCH and partnums[end] in pending:
+            end += 1
+        if end == start:
+            return
+
+        chunks = []
+        articles = []
+        for partnum in partnums[start:end]:
+            article = pending.pop(partnum)
+            articles.append(article)
+            # Saved copies stay until the new position is in the journal
+            data = _load_article(article, nzf.type, remove=False)
+            if data:
+                chunks.append(data)
+        data = ''.join(chunks)
+
+        if not nzf.assembled_size:
+            nzf.assembled_size = 0
+            if cfg.quick_check():
+                self.md5s[nzf] = new_md5()
+        try:
+            fout = open(os.path.join(nzo.workpath, nzf.get_part_id()), 'r+b')
+            fout.seek(nzf.assembled_size)
+            fout.write(data)
+            fout.close()
+        except IOError, (errno, strerror):
+            _disk_error(errno, nzf.get_part_id())
+            return
+        md5 = self.md5s.get(nzf)
+        if md5:
+            md5.update(data)
+        NZBQUEUE_LOCK.acquire()
+        try:
+            nzo.set_assembled(nzf, end, nzf.assembled_size + len(data))
+        finally:
+            NZBQUEUE_LOCK.release()
+        ArticleCache.do.purge_articles(articles)
+
+        if end < len(partnums) and partnums[end] in pending:
+            # Batch is full, continue after the other queued work
+            self.pool.stream(nzo, nzf, None)
+
+    def finish(self, nzo, nzf):
+        """ Complete the file and move it to its final name """
+        self.pending.pop(nzf, None)
+        self.partnums.pop(nzf, None)
+        md5 = self.md5s.pop(nzf, None)
+
+        sabnzbd.CheckFreeSpace()
+        filename = sanitize_filename(nzf.filename)
+        if filename != nzf.filename:
+            nzf.filename = filename
+            nzo.files_changed()
+
+        dupe = nzo.check_for_dupe(nzf)
+
+        filepath = get_filepath(cfg.download_dir.get_path(), nzo, filename)
+
+        if filepath:
+            logging.info('Decoding %s %s', filepath, nzf.type)
+            try:
+                filepath = _assemble(nzf, filepath, dupe, md5)
+            except IOError, (errno, strerror):
+                _disk_error(errno, filepath)
+
+            NZBQUEUE_LOCK.acquire()
+            try:
+                nzo.log_file_done(nzf)
+            finally:
+                NZBQUEUE_LOCK.release()
+            nzf.remove_admin()
+            setname = nzf.setname
+            if nzf.is_par2 and (nzo.md5packs.get(setname) is None):
+                pack = GetMD5Hashes(filepath)[0]
+                if pack:
+                    nzo.md5packs[setname] = pack
+                    logging.debug('Got md5pack for set %s', setname)
+
+            if check_encrypted_rar(nzo, filepath):
+                logging.warning(Ta('WARNING: Paused job "%s" because of encrypted RAR file'), latin1(nzo.final_name))
+                nzo.pause()
+
+
+def _disk_error(errno, filepath):
+    # 28 == disk full => pause downloader
+    if errno == 28:
+        logging.error(Ta('Disk full! Forcing Pause'))
+    else:
+        logging.error(Ta('Disk error on creating file %s'), latin1(filepath))
+    # Pause without saving
+    sabnzbd.downloader.Downloader.do.pause(save=False)
+
+
+def _load_article(article, _type, remove=True):
+    """ Return the decoded data of the article, None when missing """
+    data = ArticleCache.do.load_article(article, remove)
+
+    if not data:
+        logging.info(Ta('%s missing'), article)
+        return None
+
+    # need to decode uu data now
+    if _type == 'uu':
+        data = data.split('\r\n')
+
+        chunks = []
+        for line in data:
+            if not line:
+                continue
+
+            if line == '-- ' or line.startswith('Posted via '):
+                continue
+            try:
+                tmpdata = binascii.a2b_uu(line)
+                chunks.append(tmpdata)
+            except binascii.Error, msg:
+                ## Workaround for broken uuencoders by
+                ##/Fredrik Lundh
+                nbytes = (((ord(line[0])-32) & 63) * 4 + 5) / 3
+                try:
+                    tmpdata = binascii.a2b_uu(line[:nbytes])
+                    chunks.append(tmpdata)
+                except binascii.Error, msg:
+                    logging.info('Decode failed in part %s: %s', article.article, msg)
+        data = ''.join(chunks)
+
+    # yenc data already decoded
+    return data
+
+
+def _assemble(nzf, path, dupe, md5=None):
     if os.path.exists(path):
         unique_path = get_unique_path(path, create_dir = False)
         if dupe:
@@ -123,6 +333,9 @@ def _assemble(nzf, path, dupe):
         else:
             renamer(path, unique_path)
 
+    if nzf.part_id:
+        return _assemble_parts(nzf, path, md5)
+
     fout = open(path, 'ab')
 
     if cfg.quick_check():
@@ -130,48 +343,13 @@ def _assemble(nzf, path, dupe):
     else:
         md5 = None
 
-    _type = nzf.type
     decodetable = nzf.decodetable
 
-    for articlenum in decodetable:
-        sleep(0.01)
-        article = decodetable[articlenum]
-
-        data = ArticleCache.do.load_article(article)
-
-        if not data:
-            logging.info(Ta('%s missing'), article)
-        else:
-            # yenc data already decoded, flush it out
-            if _type == 'yenc':
-                fout.write(data)
-                if md5: md5.update(data)
-            # need to decode uu data now
-            elif _type == 'uu':
-                data = data.split('\r\n')
-
-                chunks = []
-                for line in data:
-                    if not line:
-                        continue
-
-                    if line == '-- ' or line.startswith('Posted via '):
-                        continue
-                    try:
-                        tmpdata = binascii.a2b_uu(line)
-                        chunks.append(tmpdata)
-                    except binascii.Error, msg:
-                        ## Workaround for broken uuencoders by
-                        ##/Fredrik Lundh
-                        nbytes = (((ord(line[0])-32) & 63) * 4 + 5) / 3
-                        try:
-                            tmpdata = binascii.a2b_uu(line[:nbytes])
-                            chunks.append(tmpdata)
-                        except binascii.Error, msg:
-                            logging.info('Decode failed in part %s: %s', article.article, msg)
-                data = ''.join(chunks)
-                fout.write(data)
-                if md5: md5.update(data)
+    for articlenum in sorted(decodetable):
+        data = _load_article(decodetable[articlenum], nzf.type)
+        if data:
+            fout.write(data)
+            if md5: md5.update(data)
 
     fout.flush()
     fout.close()
@@ -183,6 +361,90 @@ def _assemble(nzf, path, dupe):
     return path
 
 
+def _assemble_parts(nzf, path, md5):
+    """ Finish a file that was (partly) written by the ArticleCache or the
+        assembler threads, 'md5' covers the data appended so far
+    """
+    decodetable = nzf.decodetable
+    direct = nzf.direct or nzf.parts_done is not None
+    part_path = os.path.join(nzf.nzo.workpath, nzf.part_id)
+
+    if direct:
+        fout = None
+    else:
+        fout = open(part_path, 'r+b')
+        fout.seek(nzf.assembled_size or 0)
+
+    partnums = sorted(decodetable)
+    for n in xrange(nzf.assembled or 0, len(partnums)):
+        article = decodetable[partnums[n]]
+        if direct and nzf.part_done(article.partnum):
+            continue
+
+        # Still in the cache, or not streamed yet
+        data = _load_article(article, nzf.type)
+        if not data:
+            continue
+        if fout:
+            fout.write(data)
+            if md5: md5.update(data)
+            continue
+
+        if article.offset is None:
+            article.offset = _guess_offset(nzf, partnums, n, len(data))
+        if article.offset is None:
+            msg = Ta('%s => no position in the file known, discarding') % article
+            logging.warning(msg)
+            nzf.nzo.inc_log('missing_art_log', msg)
+        else:
+            # Errors go to the caller, like those of sequential writes
+            ArticleCache.do.write_part(article, data)
+
+    if fout:
+        fout.truncate()
+        fout.close()
+    else:
+        ArticleCache.do.close_part(nzf)
+        # Written out of order
+        md5 = None
+
+    try:
+        renamer(part_path, path)
+    except OSError:
+        # Old style cache can be on another file system
+        shutil.move(part_path, path)
+    set_permissions(path)
+
+    if cfg.quick_check():
+        if not md5:
+            md5 = new_md5()
+            fin = open(path, 'rb')
+            while 1:
+                data = fin.read(1024 * 1024)
+                if not data:
+                    break
+                md5.update(data)
+            fin.close()
+        nzf.md5sum = md5.digest()
+
+    return path
+
+
+def _guess_offset(nzf, partnums, n, size):
+    """ Position of article n without =ypart line, from the start
+        of the next article or the end of the file, None if unknown
+    """
+    if n == 0:
+        return 0
+    if n + 1 < len(partnums):
+        end = nzf.decodetable[partnums[n + 1]].offset
+    else:
+        end = nzf.file_size
+    if end is None or end < size:
+        return None
+    return end - size
+
+
 def file_has_articles(nzf):
     """ Do a quick check to see if any articles are present for this file.
         Destructive: only to be used to differentiate between unknown encoding and no articles.
@@ -190,7 +452,6 @@ def file_has_articles(nzf):
     has = False
     decodetable = nzf.decodetable
     for articlenum in decodetable:
-        sleep(0.01)
         article = decodetable[articlenum]
         data = ArticleCache.do.load_article(article)
         if data:
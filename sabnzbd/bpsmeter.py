@@ -24,8 +24,9 @@ import logging
 import re
 
 import sabnzbd
-from sabnzbd.constants import BYTES_FILE_NAME
+from sabnzbd.constants import BYTES_FILE_NAME, BANDWIDTH_MIN_READ
 import sabnzbd.cfg as cfg
+import sabnzbd.events as events
 
 DAY = float(24*60*60)
 WEEK = DAY * 7
@@ -97,6 +98,52 @@ def next_month(t):
     return time.mktime(ntime)
 
 
+class TokenBucket(object):
+    """ Bandwidth limiter
+        Tokens (bytes) flow in at 'rate' per second, up to the burst size.
+        A read may overdraw the bucket, the debt then delays the next read.
+    """
+    def __init__(self, rate=0):
+        self.rate = 0.0
+        self.burst = 0.0
+        self.refill = 0.0   # Tokens to wait for once the bucket is empty
+        self.tokens = 0.0
+        self.stamp = time.time()
+        self.set(rate)
+
+    def set(self, rate):
+        """ Set 'rate' in bytes/sec, 0 is unlimited """
+        self.rate = float(rate)
+        self.burst = max(self.rate * cfg.bandwidth_burst() / 1000.0, BANDWIDTH_MIN_READ)
+        self.refill = max(self.burst / 4, BANDWIDTH_MIN_READ)
+        self.tokens = min(self.tokens, self.burst)
+
+    def available(self, now):
+        """ Return the number of bytes that may be read at time 'now',
+            negative while in debt
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+    def delay(self, now):
+        """ Return seconds until reading may continue, 0 when it may now.
+            An empty bucket waits for a part of the burst, not for a single token,
+            otherwise every few bytes would cost a round through the download loop.
+        """
+        if not self.rate:
+            return 0.0
+        tokens = self.available(now)
+        if tokens > 0:
+            return 0.0
+        return (self.refill - tokens) / self.rate
+
+    def consume(self, size):
+        """ Take 'size' bytes out of the bucket """
+        if self.rate:
+            self.tokens -= size
+
+
 class BPSMeter(object):
     do = None
 
@@ -106,6 +153,7 @@ class BPSMeter(object):
         self.log_time = t
         self.last_update = t
         self.bps = 0.0
+        self.event_bps = 0.0              # Speed in the last speed event
 
         self.day_total = {}
         self.week_total = {}
@@ -246,9 +294,12 @@ class BPSMeter(object):
         if self.bps < 0.01:
             self.reset()
 
-        elif self.log_time < check_time:
-            logging.debug("bps: %s", self.bps)
-            self.log_time = t
+        else:
+            if abs(self.bps - self.event_bps) > 0.1 * self.event_bps and events.due('speed'):
+                self.post_speed()
+            if self.log_time < check_time:
+                logging.debug("bps: %s", self.bps)
+                self.log_time = t
 
 
     def reset(self):
@@ -257,6 +308,13 @@ class BPSMeter(object):
         self.log_time = t
         self.last_update = t
         self.bps = 0.0
+        if self.event_bps:
+            self.post_speed()
+
+    def post_speed(self):
+        """ Send the current speed to the live status watchers """
+        self.event_bps = self.bps
+        events.post('speed', {'kbpersec' : '%.2f' % (self.bps / 1024.0)})
 
     def get_sums(self):
         """ return tuple of grand, month, week, day totals """
@@ -186,6 +186,7 @@ username = OptionStr('misc', 'username')
 password = OptionPassword('misc', 'password')
 login_realm = OptionStr('misc', 'login_realm', 'SABnzbd')
 bandwidth_limit = OptionNumber('misc', 'bandwidth_limit', 0)
+bandwidth_burst = OptionNumber('misc', 'bandwidth_burst', 250, 0, 10000) # msec of the limit
 refresh_rate = OptionNumber('misc', 'refresh_rate', 0)
 rss_rate = OptionNumber('misc', 'rss_rate', 60, 15, 24*60)
 cache_limit = OptionStr('misc', 'cache_limit')
@@ -212,6 +213,10 @@ ssl_type = OptionStr('misc', 'ssl_type', 'v23')
 unpack_check = OptionBool('misc', 'unpack_check', True)
 no_penalties = OptionBool('misc', 'no_penalties', False)
 randomize_server_ip = OptionBool('misc', 'randomize_server_ip', False)
+poller = OptionStr('misc', 'poller', 'auto')
+decoder_workers = OptionNumber('misc', 'decoder_workers', 0, 0, 16)
+direct_write = OptionBool('misc', 'direct_write', False)
+assembler_workers = OptionNumber('misc', 'assembler_workers', 2, 1, 8)
 
 # Internal options, not saved in INI file
 debug_delay = OptionNumber('misc', 'debug_delay', 0, add=False)
@@ -345,6 +345,8 @@ class ConfigServer(object):
         self.enable = OptionBool(name, 'enable', True, add=False)
         self.optional = OptionBool(name, 'optional', False, add=False)
         self.retention = OptionNumber(name, 'retention', add=False)
+        self.pipelining = OptionNumber(name, 'pipelining', 1, 1, 20, add=False)
+        self.bandwidth_limit = OptionNumber(name, 'bandwidth_limit', 0, 0, add=False)
 
         self.set_dict(values)
         add_to_database('servers', self.__name, self)
@@ -352,7 +354,8 @@ class ConfigServer(object):
     def set_dict(self, values):
         """ Set one or more fields, passed as dictionary """
         for kw in ('host', 'port', 'timeout', 'username', 'password', 'connections',
-                   'fillserver', 'ssl', 'enable', 'optional', 'retention'):
+                   'fillserver', 'ssl', 'enable', 'optional', 'retention', 'pipelining',
+                   'bandwidth_limit'):
             try:
                 value = values[kw]
             except KeyError:
@@ -378,6 +381,8 @@ class ConfigServer(object):
         dict['enable'] = self.enable()
         dict['optional'] = self.optional()
         dict['retention'] = self.retention()
+        dict['pipelining'] = self.pipelining()
+        dict['bandwidth_limit'] = self.bandwidth_limit()
         return dict
 
     def delete(self):
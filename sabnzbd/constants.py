@@ -65,10 +65,17 @@ JOB_ADMIN = '__ADMIN__'
 VERIFIED_FILE = '__verified__'
 QCHECK_FILE = '__skip_qcheck__'
 ATTRIB_FILE = 'SABnzbd_attrib'
+SEGMENT_INDEX_FILE = 'SABnzbd_segments'
+JOURNAL_FILE = 'SABnzbd_journal'
 REPAIR_REQUEST = 'repair-all.sab'
 
 DB_HISTORY_VERSION = 1
+DB_HISTORY_SCHEMA = 3
 DB_QUEUE_VERSION = 1
+DB_TIMEOUT = 30
+DB_VACUUM_PAGES = 1000
+DB_VACUUM_INTERVAL = 600
+DECODER_SAMPLE_INTERVAL = 5
 
 DB_HISTORY_NAME = 'history%s.db' % DB_HISTORY_VERSION
 DB_QUEUE_NAME = 'queue%s.db' % DB_QUEUE_VERSION
@@ -105,7 +112,23 @@ DEF_SCANRATE     = 5
 DEF_QRATE        = 0
 MIN_DECODE_QUEUE = 5
 MAX_DECODE_QUEUE = 10
+MAX_ASSEMBLER_QUEUE = 100
+ASSEMBLER_BATCH  = 32
 MAX_WARNINGS     = 20
+NNTP_BUFFER_SIZE = 262144
+NNTP_CHUNK_SIZE  = 32768
+NNTP_MAX_CONNECTING = 8
+BANDWIDTH_MIN_READ = 4096
+NZB_PARSE_CHUNK  = 65536
+NZF_PRELOAD_ARTICLES = 50000
+JOURNAL_MIN_SIZE = 1048576
+QUEUE_LOAD_THREADS = 4
+MAX_REVISION_ITEMS = 10000
+MAX_EVENTS       = 1000
+MAX_EVENT_WATCHERS = 8
+EVENT_KEEPALIVE  = 15
+EVENT_POLL_TIMEOUT = 60
+EVENT_RATE       = 1.0
 
 REPAIR_PRIORITY = 3
 TOP_PRIORITY = 2
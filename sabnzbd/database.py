@@ -28,53 +28,96 @@ except:
         pass
 
 import os
+import re
 import time
 import datetime
 import zlib
+import struct
 import logging
+import threading
 
 import sabnzbd
 import sabnzbd.cfg
-from sabnzbd.constants import DB_HISTORY_NAME
+from sabnzbd.constants import DB_HISTORY_NAME, DB_HISTORY_SCHEMA, DB_TIMEOUT, DB_VACUUM_PAGES
 from sabnzbd.encoding import unicoder
 from sabnzbd.bpsmeter import this_week, this_month
 from sabnzbd.misc import format_source_url
+import sabnzbd.revisions as revisions
+import sabnzbd.events as events
 
 _HISTORY_DB = None        # Will contain full path to history database
-_DONE_CLEANING = False    # Ensure we only do one Vacuum per session
+_POOL = threading.local() # Connection of each thread
+_SCHEMA_LOCK = threading.Lock()
+_SCHEMA_CHECKED = False   # Ensure we only check the schema once per session
 
 def get_history_handle():
-    """ Get an instance of the history db hanlder """
+    """ Get the history db handler of the current thread,
+        the connection stays open for the lifetime of the thread
+    """
     global _HISTORY_DB
     if not _HISTORY_DB:
         _HISTORY_DB = os.path.join(sabnzbd.cfg.admin_dir.get_path(), DB_HISTORY_NAME)
-    return HistoryDB(_HISTORY_DB)
+    db = getattr(_POOL, 'history_db', None)
+    if not db or db.db_path != _HISTORY_DB:
+        db = _POOL.history_db = HistoryDB(_HISTORY_DB)
+    return db
+
+
+def vacuum_history():
+    """ Return a part of the free pages of the history database
+        to the file system, called by the scheduler
+    """
+    history_db = get_history_handle()
+    if history_db.execute('PRAGMA auto_vacuum'):
+        row = history_db.fetchone()
+        if row and row.get('auto_vacuum') != 2:
+            # Databases of older releases need a single full VACUUM,
+            # only then incremental vacuum can be used
+            logging.info('Converting history database to incremental vacuum')
+            history_db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            history_db.execute('VACUUM')
+            return
+    if history_db.execute('PRAGMA freelist_count'):
+        row = history_db.fetchone()
+        if row and row.get('freelist_count'):
+            logging.debug('Vacuum of history database, %s free pages', row.get('freelist_count'))
+            history_db.execute('PRAGMA incremental_vacuum(%d)' % DB_VACUUM_PAGES)
+            history_db.fetchall()
 
 
 # Note: Add support for execute return values
 
 class HistoryDB(object):
     def __init__(self, db_path):
-        global _DONE_CLEANING
+        global _SCHEMA_CHECKED
         #Thread.__init__(self)
+        self.db_path = db_path
         if not os.path.exists(db_path):
             create_table = True
         else:
             create_table = False
         if sabnzbd.WIN32 and isinstance(db_path, str):
-            self.con = sqlite3.connect(db_path.decode('latin-1').encode('utf-8'))
+            self.con = sqlite3.connect(db_path.decode('latin-1').encode('utf-8'), timeout=DB_TIMEOUT)
         else:
-            self.con = sqlite3.connect(db_path)
+            self.con = sqlite3.connect(db_path, timeout=DB_TIMEOUT)
         self.con.row_factory = dict_factory
+        self.con.create_function('history_rank', 1, history_rank)
         self.c = self.con.cursor()
+        # Readers and the writer don't block each other in WAL mode
+        self.execute('PRAGMA journal_mode = WAL')
+        self.fetchall()
+        self.execute('PRAGMA synchronous = NORMAL')
         if create_table:
+            self.execute('PRAGMA auto_vacuum = INCREMENTAL')
             self.create_history_db()
-        elif not _DONE_CLEANING:
-            # Run VACUUM on sqlite
-            # When an object (table, index, or trigger) is dropped from the database, it leaves behind empty space
-            # http://www.sqlite.org/lang_vacuum.html
-            _DONE_CLEANING = True
-            self.execute('VACUUM')
+        _SCHEMA_LOCK.acquire()
+        try:
+            if not _SCHEMA_CHECKED:
+                _SCHEMA_CHECKED = True
+                self.upgrade_history_db()
+        finally:
+            _SCHEMA_LOCK.release()
+        self.fts = self.has_search_index()
 
     def execute(self, command, args=(), save=False):
         ''' Wrapper for executing SQL commands '''
@@ -126,6 +169,118 @@ class HistoryDB(object):
         )
         """)
 
+    def upgrade_history_db(self):
+        """ Bring older history databases up to date """
+        version = 0
+        if self.execute('PRAGMA user_version'):
+            row = self.fetchone()
+            if row:
+                version = row.get('user_version', 0)
+        if version < 1:
+            logging.info('Adding indexes to history database')
+            self.execute('CREATE INDEX IF NOT EXISTS "idx_history_completed" ON "history" ("completed")')
+            self.execute('CREATE INDEX IF NOT EXISTS "idx_history_status" ON "history" ("status", "completed")')
+            self.execute('CREATE INDEX IF NOT EXISTS "idx_history_nzo_id" ON "history" ("nzo_id")')
+            self.execute('CREATE INDEX IF NOT EXISTS "idx_history_name" ON "history" ("name" COLLATE NOCASE)')
+        if version < 3:
+            self.create_totals()
+        if version < 2 and not self.create_search_index():
+            # Try again next session
+            self.execute('PRAGMA user_version = 1')
+            self.save()
+        elif version < DB_HISTORY_SCHEMA:
+            self.execute('PRAGMA user_version = %d' % DB_HISTORY_SCHEMA)
+            self.save()
+
+    def create_search_index(self):
+        """ Create the full text index of the history and the triggers
+            that keep it up to date, return False when sqlite lacks FTS4
+        """
+        try:
+            self.c.execute('CREATE VIRTUAL TABLE "history_fts" USING fts4(content="history", '
+                           'name, category, status, fail_message)')
+        except sqlite3.OperationalError:
+            logging.info('No full text search in sqlite %s, searching history will be slow', sqlite3.sqlite_version)
+            return False
+        logging.info('Building search index of history database')
+        self.execute('''CREATE TRIGGER "history_fts_bd" BEFORE DELETE ON "history" BEGIN
+            DELETE FROM "history_fts" WHERE docid = old.id;
+        END''')
+        self.execute('''CREATE TRIGGER "history_fts_bu" BEFORE UPDATE ON "history" BEGIN
+            DELETE FROM "history_fts" WHERE docid = old.id;
+        END''')
+        self.execute('''CREATE TRIGGER "history_fts_au" AFTER UPDATE ON "history" BEGIN
+            INSERT INTO "history_fts" (docid, name, category, status, fail_message)
+            VALUES (new.id, new.name, new.category, new.status, new.fail_message);
+        END''')
+        self.execute('''CREATE TRIGGER "history_fts_ai" AFTER INSERT ON "history" BEGIN
+            INSERT INTO "history_fts" (docid, name, category, status, fail_message)
+            VALUES (new.id, new.name, new.category, new.status, new.fail_message);
+        END''')
+        self.execute('''INSERT INTO "history_fts" ("history_fts") VALUES ('rebuild')''', save=True)
+        return True
+
+    def create_totals(self):
+        """ Create the table with the download totals per day and category
+            and the triggers that keep it up to date
+        """
+        logging.info('Building download totals of history database')
+        self.execute('''CREATE TABLE IF NOT EXISTS "totals" (
+            "day" TEXT NOT NULL,
+            "category" TEXT NOT NULL,
+            "bytes" INTEGER NOT NULL,
+            "jobs" INTEGER NOT NULL,
+            PRIMARY KEY ("day", "category")
+        )''')
+        self.execute('''CREATE TRIGGER IF NOT EXISTS "totals_ai" AFTER INSERT ON "history" BEGIN
+            INSERT OR IGNORE INTO "totals" VALUES
+                (date(new.completed, 'unixepoch', 'localtime'), coalesce(new.category, ''), 0, 0);
+            UPDATE "totals" SET bytes = bytes + coalesce(new.bytes, 0), jobs = jobs + 1
+                WHERE day = date(new.completed, 'unixepoch', 'localtime') AND category = coalesce(new.category, '');
+        END''')
+        self.execute('''CREATE TRIGGER IF NOT EXISTS "totals_ad" AFTER DELETE ON "history" BEGIN
+            UPDATE "totals" SET bytes = bytes - coalesce(old.bytes, 0), jobs = jobs - 1
+                WHERE day = date(old.completed, 'unixepoch', 'localtime') AND category = coalesce(old.category, '');
+            DELETE FROM "totals" WHERE jobs <= 0
+                AND day = date(old.completed, 'unixepoch', 'localtime') AND category = coalesce(old.category, '');
+        END''')
+        self.execute('''CREATE TRIGGER IF NOT EXISTS "totals_au" AFTER UPDATE OF completed, category, bytes ON "history" BEGIN
+            UPDATE "totals" SET bytes = bytes - coalesce(old.bytes, 0), jobs = jobs - 1
+                WHERE day = date(old.completed, 'unixepoch', 'localtime') AND category = coalesce(old.category, '');
+            DELETE FROM "totals" WHERE jobs <= 0
+                AND day = date(old.completed, 'unixepoch', 'localtime') AND category = coalesce(old.category, '');
+            INSERT OR IGNORE INTO "totals" VALUES
+                (date(new.completed, 'unixepoch', 'localtime'), coalesce(new.category, ''), 0, 0);
+            UPDATE "totals" SET bytes = bytes + coalesce(new.bytes, 0), jobs = jobs + 1
+                WHERE day = date(new.completed, 'unixepoch', 'localtime') AND category = coalesce(new.category, '');
+        END''')
+        self.execute('DELETE FROM "totals"')
+        self.execute('''INSERT INTO "totals"
+            SELECT date(completed, 'unixepoch', 'localtime'), coalesce(category, ''), sum(coalesce(bytes, 0)), count(*)
+            FROM "history" GROUP BY 1, 2''', save=True)
+
+    def has_search_index(self):
+        """ Return True when the full text index can be used """
+        try:
+            self.c.execute('SELECT docid FROM "history_fts" LIMIT 0')
+            self.c.fetchall()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def fetchone(self):
+        """ Return the first row of the last query or None,
+            reading all rows so that the query does not keep
+            a read snapshot open on the pooled connection
+        """
+        rows = self.c.fetchall()
+        if rows:
+            return rows[0]
+        return None
+
+    def fetchall(self):
+        return self.c.fetchall()
+
     def save(self):
         try:
             self.con.commit()
@@ -134,6 +289,8 @@ class HistoryDB(object):
             logging.info("Traceback: ", exc_info = True)
 
     def close(self):
+        if getattr(_POOL, 'history_db', None) is self:
+            _POOL.history_db = None
         try:
             self.c.close()
             self.con.close()
@@ -142,6 +299,7 @@ class HistoryDB(object):
             logging.info("Traceback: ", exc_info = True)
 
     def remove_completed(self):
+        revisions.bump('history')
         return self.execute("""DELETE FROM history WHERE status = 'Completed'""", save=True)
 
     def get_failed_paths(self):
@@ -153,6 +311,7 @@ class HistoryDB(object):
             return []
 
     def remove_failed(self):
+        revisions.bump('history')
         return self.execute("""DELETE FROM history WHERE status = 'Failed'""", save=True)
 
     def remove_history(self, jobs=None):
@@ -164,6 +323,7 @@ class HistoryDB(object):
 
             for job in jobs:
                 self.execute("""DELETE FROM history WHERE nzo_id=?""", (job,))
+                revisions.bump('history', job)
 
         self.save()
 
@@ -177,49 +337,97 @@ class HistoryDB(object):
         downloaded, completeness, fail_message, url_info, bytes)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", t):
             self.save()
+        revisions.bump('history', nzo.nzo_id)
+        events.post('history', {'nzo_id' : nzo.nzo_id, 'name' : nzo.final_name_pw_clean, 'status' : nzo.status})
 
-    def fetch_history(self, start=None, limit=None, search=None, failed_only=0):
+    def fetch_history(self, start=None, limit=None, search=None, failed_only=0, sort=None):
 
-        if not search:
-            # Default value
-            search = ''
-        else:
+        if not start:
+            start = 0
+
+        query = None
+        if search and self.fts:
+            query = search_query(search)
+        if query:
+            return self.search_history(start, limit, query, failed_only, sort)
+
+        # Only filter on what was asked for, so that the
+        # indexes on status and completed can be used
+        where = []
+        args = ()
+        if search:
             # Allow * for wildcard matching and space
             search = search.replace('*','%').replace(' ', '%')
 
-        # Allow ^ for start of string and $ for end of string
-        if search and search.startswith('^'):
-            search = search.replace('^','')
-            search += '%'
-        elif search and search.endswith('$'):
-            search = search.replace('$','')
-            search = '%' + search
+            # Allow ^ for start of string and $ for end of string
+            if search.startswith('^'):
+                search = search.replace('^','')
+                search += '%'
+            elif search.endswith('$'):
+                search = search.replace('$','')
+                search = '%' + search
+            else:
+                search = '%' + search + '%'
+            where.append('name LIKE ?')
+            args = (search,)
+        if failed_only:
+            where.append('status = "Failed"')
+        if where:
+            where = 'WHERE ' + ' AND '.join(where)
         else:
-            search = '%' + search + '%'
+            where = ''
 
         # Get the number of results
-        if failed_only:
-            res = self.execute('select count(*) from History WHERE name LIKE ? AND STATUS = "Failed"', (search,))
-        else:
-            res = self.execute('select count(*) from History WHERE name LIKE ?', (search,))
+        res = self.execute('SELECT count(*) FROM history %s' % where, args)
         total_items = -1
         if res:
             try:
-                total_items = self.c.fetchone().get('count(*)')
+                total_items = self.fetchone().get('count(*)')
             except AttributeError:
                 pass
 
-        if not start:
-            start = 0
         if not limit:
             limit = total_items
 
-        t = (search, start, limit)
+        t = args + (start, limit)
+        fetch_ok = self.execute('SELECT * FROM history %s ORDER BY completed desc LIMIT ?, ?' % where, t)
+
+        return self.unpack_items(fetch_ok, total_items)
+
+    def search_history(self, start, limit, query, failed_only=0, sort=None):
+        """ Fetch history items matching full text 'query',
+            newest first or with sort='rank' best match first
+        """
         if failed_only:
-            fetch_ok = self.execute('''SELECT * FROM history WHERE name LIKE ? AND STATUS = "Failed" ORDER BY completed desc LIMIT ?, ?''', t)
+            query += ' status:failed'
+
+        total_items = -1
+        if self.execute('SELECT count(*) FROM history_fts WHERE history_fts MATCH ?', (query,)):
+            try:
+                total_items = self.fetchone().get('count(*)')
+            except AttributeError:
+                pass
+
+        if not limit:
+            limit = total_items
+
+        t = (query, start, limit)
+        if sort == 'rank':
+            # Ranking needs all matches, so only on request
+            fetch_ok = self.execute('''SELECT history.* FROM history_fts JOIN history ON history.id = history_fts.docid
+                                       WHERE history_fts MATCH ?
+                                       ORDER BY history_rank(matchinfo(history_fts, 'pcx')) DESC, history.id DESC
+                                       LIMIT ?, ?''', t)
         else:
-            fetch_ok = self.execute('''SELECT * FROM history WHERE name LIKE ? ORDER BY completed desc LIMIT ?, ?''', t)
+            # The index delivers matches in docid order, which is the order of completion
+            fetch_ok = self.execute('''SELECT history.* FROM history JOIN
+                                       (SELECT docid FROM history_fts WHERE history_fts MATCH ? ORDER BY docid DESC LIMIT ?, ?) AS found
+                                       ON history.id = found.docid ORDER BY history.id DESC''', t)
+
+        return self.unpack_items(fetch_ok, total_items)
 
+    def unpack_items(self, fetch_ok, total_items):
+        """ Return (items, fetched_items, total_items) of the last query """
         if fetch_ok:
             items = self.c.fetchall()
         else:
@@ -238,45 +446,46 @@ class HistoryDB(object):
         Returns the total size of the history and
         amounts downloaded in the last month and week
         """
-        # Total Size of the history
-        total = 0
-        if self.execute('''SELECT sum(bytes) FROM history'''):
-            try:
-                total = self.c.fetchone().get('sum(bytes)')
-            except AttributeError:
-                pass
-
-        # Amount downloaded this month
-        #r = time.gmtime(time.time())
-        #month_timest = int(time.mktime((r.tm_year, r.tm_mon, 0, 0, 0, 1, r.tm_wday, r.tm_yday, r.tm_isdst)))
-        month_timest = int(this_month(time.time()))
-
-        month = 0
-        if self.execute('''SELECT sum(bytes) FROM history WHERE "completed">?''', (month_timest,)):
-            try:
-                month = self.c.fetchone().get('sum(bytes)')
-            except AttributeError:
-                pass
-
-        # Amount downloaded this week
-        week_timest = int(this_week(time.time()))
-
-        week = 0
-        if self.execute('''SELECT sum(bytes) FROM history WHERE "completed">?''', (week_timest,)):
-            try:
-                week = self.c.fetchone().get('sum(bytes)')
-            except AttributeError:
-                pass
-
+        now = time.time()
+        total = self.get_totals()[0]
+        month = self.get_totals(day_of(this_month(now)))[0]
+        week = self.get_totals(day_of(this_week(now)))[0]
         return (total, month, week)
 
+    def get_totals(self, first=None, last=None, cat=None):
+        """ Return (bytes, jobs) of the history from day 'first'
+            up to and including day 'last' (as 'YYYY-MM-DD'), optionally of one category
+        """
+        where, args = totals_filter(first, last, cat)
+        total = jobs = 0
+        if self.execute('SELECT sum(bytes), sum(jobs) FROM totals %s' % where, args):
+            row = self.fetchone()
+            if row:
+                total = row.get('sum(bytes)') or 0
+                jobs = row.get('sum(jobs)') or 0
+        return total, jobs
+
+    def get_daily_totals(self, first=None, last=None, cat=None):
+        """ Return list of (day, bytes, jobs) per day, see get_totals """
+        where, args = totals_filter(first, last, cat)
+        if self.execute('SELECT day, sum(bytes), sum(jobs) FROM totals %s GROUP BY day ORDER BY day' % where, args):
+            return [(row['day'], row['sum(bytes)'], row['sum(jobs)']) for row in self.fetchall()]
+        return []
+
+    def get_category_totals(self, first=None, last=None):
+        """ Return list of (category, bytes, jobs) per category, see get_totals """
+        where, args = totals_filter(first, last)
+        if self.execute('SELECT category, sum(bytes), sum(jobs) FROM totals %s GROUP BY category ORDER BY category' % where, args):
+            return [(row['category'], row['sum(bytes)'], row['sum(jobs)']) for row in self.fetchall()]
+        return []
+
 
     def get_script_log(self, nzo_id):
         data = ''
         t = (nzo_id,)
         if self.execute('SELECT script_log FROM history WHERE nzo_id=?', t):
             try:
-                data = zlib.decompress(self.c.fetchone().get('script_log'))
+                data = zlib.decompress(self.fetchone().get('script_log'))
             except:
                 pass
         return data
@@ -286,7 +495,7 @@ class HistoryDB(object):
         name = ''
         if self.execute('SELECT name FROM history WHERE nzo_id=?', t):
             try:
-                name = self.c.fetchone().get('name')
+                name = self.fetchone().get('name')
             except AttributeError:
                 pass
         return name
@@ -297,11 +506,76 @@ class HistoryDB(object):
         path = ''
         if self.execute('SELECT path FROM history WHERE nzo_id=?', t):
             try:
-                path = self.c.fetchone().get('path')
+                path = self.fetchone().get('path')
             except AttributeError:
                 pass
         return path
 
+def day_of(t):
+    """ Return the day of timestamp 't' as used in the totals table """
+    return time.strftime('%Y-%m-%d', time.localtime(t))
+
+
+def totals_filter(first=None, last=None, cat=None):
+    """ Return (where, args) selecting a range of days and a category of the totals table """
+    where = []
+    args = ()
+    if first:
+        where.append('day >= ?')
+        args += (first,)
+    if last:
+        where.append('day <= ?')
+        args += (last,)
+    if cat is not None:
+        where.append('category = ?')
+        args += (cat,)
+    if where:
+        return 'WHERE ' + ' AND '.join(where), args
+    return '', args
+
+
+_RE_SEARCH_TERM = re.compile(r'"([^"]*)"?|([^"]+)', re.U)
+_RE_SEARCH_WORD = re.compile(r'\w+', re.U)
+
+def search_query(search):
+    """ Convert the user's search into a full text query.
+        Words match the start of words in name, category, status or fail message,
+        "quoted words" must appear as a phrase and a leading ^ anchors to the start.
+        Return None for searches the index cannot answer (leading * or trailing $).
+    """
+    search = unicoder(search).strip()
+    if search.startswith('*') or search.endswith('$'):
+        return None
+    anchor = search.startswith('^')
+    terms = []
+    for phrase, words in _RE_SEARCH_TERM.findall(search.lstrip('^')):
+        if phrase:
+            words = _RE_SEARCH_WORD.findall(phrase)
+            if words:
+                terms.append(' '.join(words))
+        else:
+            terms.extend(_RE_SEARCH_WORD.findall(words))
+    if not terms:
+        return None
+    if anchor:
+        terms[0] = '^' + terms[0]
+    # Quoting keeps words like OR and NOT from being operators
+    return ' '.join(['"%s*"' % term for term in terms])
+
+
+def history_rank(info):
+    """ Rank of a match, from matchinfo(history_fts, 'pcx'):
+        per phrase and column the hits in this row relative to all rows
+    """
+    info = struct.unpack('%dI' % (len(info) / 4), str(info))
+    phrases, columns = info[0], info[1]
+    rank = 0.0
+    for x in xrange(2, 2 + 3 * phrases * columns, 3):
+        if info[x]:
+            rank += float(info[x]) / info[x + 1]
+    return rank
+
+
 def dict_factory(cursor, row):
     d = {}
     for idx, col in enumerate(cursor.description):
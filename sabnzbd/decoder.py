@@ -23,7 +23,8 @@ import Queue
 import binascii
 import logging
 import re
-from threading import Thread
+import time
+from threading import Thread, Lock
 try:
     import _yenc
     HAVE_YENC = True
@@ -34,6 +35,7 @@ except ImportError:
 import sabnzbd
 from sabnzbd.constants import MAX_DECODE_QUEUE, MIN_DECODE_QUEUE
 from sabnzbd.articlecache import ArticleCache
+from sabnzbd.assembler import Assembler
 import sabnzbd.downloader
 import sabnzbd.cfg as cfg
 from sabnzbd.encoding import name_fixer
@@ -54,129 +56,216 @@ class BadYenc(Exception):
 
 #-------------------------------------------------------------------------------
 
-class Decoder(Thread):
+def default_workers():
+    """ Number of decoder workers to use when not configured.
+        Only the _yenc module releases the GIL, the Python
+        decoder would not gain anything from more threads.
+    """
+    if not HAVE_YENC:
+        return 1
+    try:
+        import multiprocessing
+        return max(1, min(multiprocessing.cpu_count(), 4))
+    except (ImportError, NotImplementedError):
+        return 2
+
+
+class Decoder(object):
+    """ Pool of decoder threads
+        All articles of one file go to the same worker, so the order in which
+        they are saved and registered per file is the same as with one thread.
+    """
     def __init__(self, servers):
-        Thread.__init__(self)
-
-        self.queue = Queue.Queue()
-        self.servers = servers
+        workers = cfg.decoder_workers() or default_workers()
+        self.workers = [DecoderWorker(self, servers, n) for n in xrange(workers)]
+        self.max_queue = MAX_DECODE_QUEUE * workers
+        self.min_queue = MIN_DECODE_QUEUE * workers
+        self.throttled = 0      # Number of times the downloader was delayed
+        self.__lock = Lock()
+        self.__sample = (time.time(), 0.0)
+        self.usage = 0          # Busy percentage of the last sample
+        logging.info('Using %s decoder thread(s)', workers)
 
     def decode(self, article, lines):
-        self.queue.put((article, lines))
-        if self.queue.qsize() > MAX_DECODE_QUEUE:
-            sabnzbd.downloader.Downloader.do.delay()
+        worker = self.workers[hash(article.nzf) % len(self.workers)]
+        worker.queue.put((article, lines))
+        if self.qsize() > self.max_queue:
+            downloader = sabnzbd.downloader.Downloader.do
+            if not downloader.delayed:
+                self.throttled += 1
+                downloader.delay()
+
+    def check_undelay(self):
+        """ Let the downloader continue when the queues have drained enough """
+        downloader = sabnzbd.downloader.Downloader.do
+        if downloader.delayed and self.qsize() < self.min_queue:
+            downloader.undelay()
+
+    def qsize(self):
+        return sum([worker.queue.qsize() for worker in self.workers])
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
 
     def stop(self):
-        self.queue.put(None)
+        for worker in self.workers:
+            worker.queue.put(None)
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+    def sample(self):
+        """ Measure the busy percentage since the previous sample,
+            called by the scheduler every DECODER_SAMPLE_INTERVAL seconds
+        """
+        self.__lock.acquire()
+        try:
+            now = time.time()
+            busy = sum([worker.busy_time for worker in self.workers])
+            then, last_busy = self.__sample
+            self.__sample = (now, busy)
+        finally:
+            self.__lock.release()
+        elapsed = (now - then) * len(self.workers)
+        if elapsed > 0:
+            self.usage = min(100, int(100.0 * (busy - last_busy) / elapsed))
+        else:
+            self.usage = 0
+
+    def info(self):
+        """ Return (queued articles, #workers, busy percentage, #throttles)
+            The busy percentage is that of the last sample, so all clients see the same.
+        """
+        return self.qsize(), len(self.workers), self.usage, self.throttled
+
+
+class DecoderWorker(Thread):
+    def __init__(self, pool, servers, num):
+        Thread.__init__(self, name='Decoder-%d' % num)
+
+        self.pool = pool
+        self.queue = Queue.Queue()
+        self.servers = servers
+        self.busy_time = 0.0
 
     def run(self):
-        from sabnzbd.nzbqueue import NzbQueue
         while 1:
             art_tup = self.queue.get()
             if not art_tup:
                 break
 
-            if self.queue.qsize() < MIN_DECODE_QUEUE and sabnzbd.downloader.Downloader.do.delayed:
-                sabnzbd.downloader.Downloader.do.undelay()
+            self.pool.check_undelay()
 
-            article, lines = art_tup
-            nzf = article.nzf
-            nzo = nzf.nzo
+            # Hold back when the assembler cannot keep up with the disk
+            Assembler.do.wait_for_room()
 
-            data = None
+            start = time.time()
+            self.process(*art_tup)
+            self.busy_time += time.time() - start
 
-            register = True  # Finish article
-            found = False    # Proper article found
+    def process(self, article, lines):
+        from sabnzbd.nzbqueue import NzbQueue
+        nzf = article.nzf
+        nzo = nzf.nzo
 
-            if lines:
-                logme = None
-                try:
-                    if nzo.precheck:
-                        raise BadYenc
-                    register = True
-                    logging.debug("Decoding %s", article)
+        data = None
 
-                    data = decode(article, lines)
-                    nzf.article_count += 1
-                    found = True
-                except IOError, e:
-                    logme = Ta('Decoding %s failed') % article
-                    logging.info(logme)
-                    sabnzbd.downloader.Downloader.do.pause()
+        register = True  # Finish article
+        found = False    # Proper article found
 
-                    article.fetcher = None
+        if lines:
+            logme = None
+            try:
+                if nzo.precheck:
+                    raise BadYenc
+                register = True
+                logging.debug("Decoding %s", article)
 
-                    NzbQueue.do.reset_try_lists(nzf, nzo)
+                data = decode(article, lines)
+                nzf.article_count += 1
+                found = True
+            except IOError, e:
+                logme = Ta('Decoding %s failed') % article
+                logging.info(logme)
+                sabnzbd.downloader.Downloader.do.pause()
 
-                    register = False
+                article.fetcher = None
 
-                except CrcError, e:
-                    logme = Ta('CRC Error in %s (%s -> %s)') % (article, e.needcrc, e.gotcrc)
-                    logging.info(logme)
+                NzbQueue.do.reset_try_lists(nzf, nzo)
 
-                    data = e.data
+                register = False
 
-                    if cfg.fail_on_crc():
-                        new_server_found = self.__search_new_server(article)
-                        if new_server_found:
-                            register = False
-                            logme = None
+            except CrcError, e:
+                logme = Ta('CRC Error in %s (%s -> %s)') % (article, e.needcrc, e.gotcrc)
+                logging.info(logme)
 
-                except BadYenc:
-                    # Handles precheck and badly formed articles
-                    killed = False
-                    found = False
-                    if nzo.precheck and lines and lines[0].startswith('223 '):
-                        # STAT was used, so we only get a status code
-                        found = True
-                    else:
-                        # Examine headers (for precheck) or body (for download)
-                        # And look for DMCA clues (while skipping "X-" headers)
-                        for line in lines:
-                            if not line.startswith('X-') and match_str(line.lower(), ('dmca', 'removed', 'cancel', 'blocked')):
-                                logging.info('Article removed from server (%s)', article)
-                                killed = True
-                                break
-                    if nzo.precheck:
-                        if found or not killed:
-                            # Pre-check, proper article found, just register
-                            logging.debug('Server has article %s', article)
-                            register = True
-                    elif not killed and not found:
-                        logme = Ta('Badly formed yEnc article in %s') % article
-                        logging.info(logme)
-
-                    if not found:
-                        new_server_found = self.__search_new_server(article)
-                        if new_server_found:
-                            register = False
-                            logme = None
-
-                except:
-                    logme = Ta('Unknown Error while decoding %s') % article
+                data = e.data
+
+                if cfg.fail_on_crc():
+                    new_server_found = self.__search_new_server(article)
+                    if new_server_found:
+                        register = False
+                        logme = None
+
+            except BadYenc:
+                # Handles precheck and badly formed articles
+                killed = False
+                found = False
+                if isinstance(lines, str):
+                    lines = lines.split('\r\n')
+                if nzo.precheck and lines and lines[0].startswith('223 '):
+                    # STAT was used, so we only get a status code
+                    found = True
+                else:
+                    # Examine headers (for precheck) or body (for download)
+                    # And look for DMCA clues (while skipping "X-" headers)
+                    for line in lines:
+                        if not line.startswith('X-') and match_str(line.lower(), ('dmca', 'removed', 'cancel', 'blocked')):
+                            logging.info('Article removed from server (%s)', article)
+                            killed = True
+                            break
+                if nzo.precheck:
+                    if found or not killed:
+                        # Pre-check, proper article found, just register
+                        logging.debug('Server has article %s', article)
+                        register = True
+                elif not killed and not found:
+                    logme = Ta('Badly formed yEnc article in %s') % article
                     logging.info(logme)
-                    logging.info("Traceback: ", exc_info = True)
 
+                if not found:
                     new_server_found = self.__search_new_server(article)
                     if new_server_found:
                         register = False
                         logme = None
 
-                if logme:
-                    article.nzf.nzo.inc_log('bad_art_log', logme)
+            except:
+                logme = Ta('Unknown Error while decoding %s') % article
+                logging.info(logme)
+                logging.info("Traceback: ", exc_info = True)
 
-            else:
                 new_server_found = self.__search_new_server(article)
                 if new_server_found:
                     register = False
-                elif nzo.precheck:
-                    found = False
+                    logme = None
 
-            if data:
-                ArticleCache.do.save_article(article, data)
+            if logme:
+                article.nzf.nzo.inc_log('bad_art_log', logme)
+
+        else:
+            new_server_found = self.__search_new_server(article)
+            if new_server_found:
+                register = False
+            elif nzo.precheck:
+                found = False
 
-            if register:
-                NzbQueue.do.register_article(article, found)
+        if data:
+            ArticleCache.do.save_article(article, data)
+
+        if register:
+            NzbQueue.do.register_article(article, found)
 
     def __search_new_server(self, article):
         from sabnzbd.nzbqueue import NzbQueue
@@ -222,11 +311,16 @@ class Decoder(Thread):
 
 YDEC_TRANS = ''.join([chr((i + 256 - 42) % 256) for i in xrange(256)])
 def decode(article, data):
-    data = strip(data)
+    if isinstance(data, str):
+        # Contiguous article body as received by the NewsWrapper
+        yenc, data = yCheckBuffer(data)
+    else:
+        data = strip(data)
+        if data:
+            yenc, data = yCheck(data)
     ## No point in continuing if we don't have any data left
     if data:
         nzf = article.nzf
-        yenc, data = yCheck(data)
         ybegin, ypart, yend = yenc
         decoded_data = None
 
@@ -260,12 +354,22 @@ def decode(article, data):
                 logging.debug("Possible corrupt header detected " + \
                               "=> ybegin: %s", ybegin)
             nzf.type = 'yenc'
+            # Remember where the data goes, for writing in place
+            try:
+                if ypart:
+                    article.offset = int(ypart['begin']) - 1
+                elif 'part' not in ybegin:
+                    article.offset = 0
+                nzf.file_size = int(ybegin['size'])
+            except (KeyError, ValueError):
+                article.offset = None
             # Decode data
+            if isinstance(data, list):
+                data = ''.join(data)
             if HAVE_YENC:
-                decoded_data, crc = _yenc.decode_string(''.join(data))[:2]
+                decoded_data, crc = _yenc.decode_string(data)[:2]
                 partcrc = '%08X' % ((crc ^ -1) & 2**32L - 1)
             else:
-                data = ''.join(data)
                 for i in (0, 9, 10, 13, 27, 32, 46, 61):
                     j = '=%c' % (i + 64)
                     data = data.replace(j, chr(i))
@@ -331,6 +435,50 @@ def yCheck(data):
 
     return ((ybegin, ypart, yend), data)
 
+def yCheckBuffer(data):
+    """ Locate the yEnc header and trailer in a contiguous article body.
+        The yEnc data is returned as one string with the line breaks still in,
+        _yenc skips them while decoding. Falls back to the line based yCheck()
+        for anything else.
+    """
+    if HAVE_YENC:
+        raw = data
+        # Undo the NNTP dot-stuffing, strip() does this for the fallback
+        if data.startswith('..'):
+            data = data[1:]
+        data = data.replace('\r\n..', '\r\n.')
+
+        begin = data.find('=ybegin ')
+        end = data.rfind('\r\n=yend ')
+        if begin >= 0 and end > begin and (begin == 0 or data[begin-1] == '\n'):
+            eol = data.find('\r\n', begin)
+            line = data[begin:eol]
+            splits = 3
+            if line.find(' part=') > 0:
+                splits += 1
+            if line.find(' total=') > 0:
+                splits += 1
+            ybegin = ySplit(line, splits)
+
+            ypart = None
+            if data.startswith('=ypart ', eol+2):
+                start = data.find('\r\n', eol+2)
+                ypart = ySplit(data[eol+2:start])
+            else:
+                start = eol
+
+            tail = data.find('\r\n', end+2)
+            if tail < 0:
+                tail = len(data)
+            yend = ySplit(data[end+2:tail])
+            return ((ybegin, ypart, yend), data[start:end])
+        data = raw
+
+    data = strip(data.split('\r\n'))
+    if data:
+        return yCheck(data)
+    return ((None, None, None), data)
+
 # Example: =ybegin part=1 line=128 size=123 name=-=DUMMY=- abc.par
 YSPLIT_RE = re.compile(r'([a-zA-Z0-9]+)=')
 def ySplit(line, splits = None):
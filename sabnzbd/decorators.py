@@ -44,4 +44,12 @@ def synchronized_CV(func):
         finally:
             CV.notifyAll()
             CV.release()
+            wakeup_downloader()
     return call_func
+
+
+def wakeup_downloader():
+    """ The downloader waits in its poller, not on the CV """
+    from sabnzbd.downloader import Downloader
+    if Downloader.do:
+        Downloader.do.wakeup()
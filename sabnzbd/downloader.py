@@ -20,23 +20,26 @@ sabnzbd.downloader - download engine
 """
 
 import time
-import select
+import sys
 import logging
 from threading import Thread, RLock
 from nntplib import NNTPPermanentError
 import socket
 import random
+import heapq
+import itertools
+from collections import deque
 
 import sabnzbd
 from sabnzbd.decorators import synchronized, synchronized_CV, CV
 from sabnzbd.decoder import Decoder
 from sabnzbd.newswrapper import NewsWrapper, request_server_info
+from sabnzbd.poller import create_poller
 import sabnzbd.growler as growler
 from sabnzbd.constants import *
 import sabnzbd.config as config
 import sabnzbd.cfg as cfg
-from sabnzbd.bpsmeter import BPSMeter
-import sabnzbd.scheduler
+from sabnzbd.bpsmeter import BPSMeter, TokenBucket
 
 #------------------------------------------------------------------------------
 # Timeout penalty in minutes for each cause
@@ -53,7 +56,7 @@ TIMER_LOCK = RLock()
 #------------------------------------------------------------------------------
 class Server(object):
     def __init__(self, id, host, port, timeout, threads, fillserver, ssl, username = None,
-                 password = None, optional=False, retention=0):
+                 password = None, optional=False, retention=0, pipelining=1, bandwidth_limit=0):
         self.id = id
         self.newid = None
         self.restart = False
@@ -65,12 +68,16 @@ class Server(object):
         self.ssl = ssl
         self.optional = optional
         self.retention = retention
+        self.pipelining = max(1, pipelining) # Max number of outstanding articles per connection
+        self.bandwidth = TokenBucket(bandwidth_limit * 1024)
+        self.throttled = {}  # Connections that stopped reading for the bandwidth limit, nw -> fileno
 
         self.username = username
         self.password = password
 
         self.busy_threads = []
         self.idle_threads = []
+        self.resting = []    # Idle connections in their back-off after a reset
         self.active = True
         self.bad_cons = 0
         self.errormsg = ''
@@ -94,18 +101,18 @@ class Server(object):
             ip = self.host
         return ip
 
-    def stop(self, readers, writers):
-        for nw in self.idle_threads:
+    def stop(self, poller):
+        for nw in self.idle_threads + self.resting:
             try:
                 fno = nw.nntp.sock.fileno()
             except:
                 fno = None
-            if fno and fno in readers:
-                readers.pop(fno)
-            if fno and fno in writers:
-                writers.pop(fno)
+            if fno:
+                poller.unregister(fno)
             nw.terminate(quit=True)
         self.idle_threads = []
+        self.resting = []
+        self.throttled = {}
 
     def __repr__(self):
         return "%s:%s" % (self.host, self.port)
@@ -128,7 +135,9 @@ class Downloader(Thread):
 
         #used for throttling bandwidth and scheduling bandwidth changes
         self.bandwidth_limit = cfg.bandwidth_limit()
+        self.bandwidth = TokenBucket(self.bandwidth_limit * 1024)
         cfg.bandwidth_limit.callback(self.speed_set)
+        cfg.bandwidth_burst.callback(self.speed_set)
 
         # Used for reducing speed
         self.delayed = False
@@ -143,12 +152,22 @@ class Downloader(Thread):
 
         self.force_disconnect = False
 
-        self.read_fds = {}
-        self.write_fds = {}
+        # Sockets are registered once in the poller, which
+        # tracks the read/write interest of each connection
+        self.poller = create_poller(cfg.poller())
+        logging.info('Using %s for socket polling', self.poller.name)
 
         self.servers = []
         self._timers = {}
 
+        # All deadlines of the download loop in one heap of
+        # (time, sequence, kind, item), only used by the downloader thread
+        self._heap = []
+        self._sequence = itertools.count()
+        self._watched = {}      # Connection -> time of its timeout entry in the heap
+        self._failed = deque()  # Connections that failed to connect
+        self._buffered = set()  # Filenos of SSL connections with decrypted data left
+
         for server in config.get_servers():
             self.init_server(None, server)
 
@@ -180,6 +199,8 @@ class Downloader(Thread):
             password = srv.password()
             optional = srv.optional()
             retention = float(srv.retention() * 24 * 3600) # days ==> seconds
+            pipelining = srv.pipelining()
+            bandwidth_limit = srv.bandwidth_limit()
             create = True
 
         if oldserver:
@@ -194,7 +215,8 @@ class Downloader(Thread):
 
         if create and enabled and host and port and threads:
             self.servers.append(Server(newserver, host, port, timeout, threads, fillserver, ssl,
-                                            username, password, optional, retention))
+                                            username, password, optional, retention, pipelining,
+                                            bandwidth_limit))
 
         return primary
 
@@ -245,10 +267,12 @@ class Downloader(Thread):
 
     def disconnect(self):
         self.force_disconnect = True
+        self.wakeup()
 
     @synchronized_CV
     def limit_speed(self, value):
         self.bandwidth_limit = int(value)
+        self.bandwidth.set(self.bandwidth_limit * 1024)
         logging.info("Bandwidth limit set to %s", value)
 
     def get_limit(self):
@@ -256,6 +280,10 @@ class Downloader(Thread):
 
     def speed_set(self):
         self.bandwidth_limit = cfg.bandwidth_limit()
+        self.bandwidth.set(self.bandwidth_limit * 1024)
+        for server in self.servers:
+            server.bandwidth.set(server.bandwidth.rate)
+        self.wakeup()
 
     def is_paused(self):
         from sabnzbd.nzbqueue import NzbQueue
@@ -278,7 +306,7 @@ class Downloader(Thread):
         from sabnzbd.nzbqueue import NzbQueue
         if server.optional and server.active and (server.bad_cons/server.threads) > 3:
             # Optional and active server had too many problems,
-            # disable it now and send a re-enable plan to the scheduler
+            # disable it now and plan to re-enable it
             server.bad_cons = 0
             server.active = False
             server.errormsg = T('Server %s will be ignored for %s minutes') % ('', _PENALTY_TIMEOUT)
@@ -302,20 +330,21 @@ class Downloader(Thread):
         BPSMeter.do.update()
 
         while 1:
+            while self._failed:
+                nw = self._failed.popleft()
+                if nw.nntp and nw.nntp.error_msg and nw in nw.server.busy_threads:
+                    self.__reset_nw(nw, "", warn=False)
+                    nw.server.bad_cons += 1
+                    self.maybe_block_server(nw.server)
+
+            self.run_timers()
+
             for server in self.servers:
                 assert isinstance(server, Server)
-                for nw in server.busy_threads[:]:
-                    if (nw.nntp and nw.nntp.error_msg) or (nw.timeout and time.time() > nw.timeout):
-                        if (nw.nntp and nw.nntp.error_msg):
-                            self.__reset_nw(nw, "", warn=False)
-                        else:
-                            self.__reset_nw(nw, "timed out")
-                        server.bad_cons += 1
-                        self.maybe_block_server(server)
                 if server.restart:
                     if not server.busy_threads:
                         newid = server.newid
-                        server.stop(self.read_fds, self.write_fds)
+                        server.stop(self.poller)
                         self.servers.remove(server)
                         if newid:
                             self.init_server(None, newid)
@@ -328,20 +357,24 @@ class Downloader(Thread):
                         continue
 
                 assert isinstance(server, Server)
-                if not server.idle_threads or server.restart or self.is_paused() or self.shutdown or self.delayed or self.postproc:
+                if server.restart or self.is_paused() or self.shutdown or self.delayed or self.postproc:
+                    continue
+
+                if not (server.idle_threads or server.pipelining > 1):
                     continue
 
                 if not (server.active and NzbQueue.do.has_articles_for(server)):
                     continue
 
+                if server.pipelining > 1 and not cfg.send_group():
+                    self.__fill_pipeline(server)
+
+                # Open only a few connections at a time, so that reconnecting
+                # after a network problem doesn't swamp the server
+                connecting = len([nw for nw in server.busy_threads if nw.nntp and nw.nntp.connecting])
+
                 for nw in server.idle_threads[:]:
                     assert isinstance(nw, NewsWrapper)
-                    if nw.timeout:
-                        if time.time() < nw.timeout:
-                            continue
-                        else:
-                            nw.timeout = None
-
                     if not server.active:
                         break
 
@@ -350,6 +383,9 @@ class Downloader(Thread):
                         request_server_info(server)
                         break
 
+                    if not nw.connected and connecting >= NNTP_MAX_CONNECTING:
+                        continue
+
                     article = NzbQueue.do.get_article(server)
 
                     if not article:
@@ -370,10 +406,12 @@ class Downloader(Thread):
                     if nw.connected:
                         self.__request_article(nw)
                     else:
+                        connecting += 1
                         try:
                             logging.info("%s@%s:%s: Initiating connection",
                                               nw.thrdnum, server.host, server.port)
-                            nw.init_connect(self.write_fds)
+                            nw.init_connect(self.poller)
+                            self.watch(nw)
                         except:
                             logging.error(Ta('Failed to initialize %s@%s:%s'),
                                               nw.thrdnum, server.host,
@@ -394,7 +432,8 @@ class Downloader(Thread):
                     self.decoder.join()
 
                     for server in self.servers:
-                        server.stop(self.read_fds, self.write_fds)
+                        server.stop(self.poller)
+                    self.poller.close()
 
                     logging.info("Shutting down")
                     break
@@ -409,53 +448,62 @@ class Downloader(Thread):
 
                 self.force_disconnect = False
 
-            # => Select
-            readkeys = self.read_fds.keys()
-            writekeys = self.write_fds.keys()
-
-            if readkeys or writekeys:
-                read, write, error = select.select(readkeys, writekeys, (), 1.0)
-
-            else:
-                read, write, error = ([], [], [])
-
+            # => Poll
+            self.throttle()
+            if self.poller.empty() and not [server for server in self.servers if server.throttled]:
+                # No connections
                 BPSMeter.do.reset()
-
-                time.sleep(1.0)
-
-                CV.acquire()
-                while (NzbQueue.do.is_empty() or self.is_paused() or self.delayed or self.postproc) and not \
+                if (NzbQueue.do.is_empty() or self.is_paused() or self.delayed or self.postproc) and not \
                        self.shutdown and not self.__restart:
-                    CV.wait()
-                CV.release()
-
+                    # Nothing to do until a wakeup() or a timer
+                    read, write = self.poller.poll(self.next_timer(None))
+                else:
+                    read, write = self.poller.poll(self.next_timer(1.0))
                 self.force_disconnect = False
+            elif self._buffered:
+                read, write = self.poller.poll(0)
+            else:
+                read, write = self.poller.poll(self.next_timer(1.0))
 
-            for selected in write:
-                nw = self.write_fds[selected]
-
-                fileno = nw.nntp.sock.fileno()
-
-                if fileno not in self.read_fds:
-                    self.read_fds[fileno] = nw
+            if self._buffered:
+                # Data that the SSL layer already holds doesn't make the socket readable
+                read = list(set(read).union([fileno for fileno in self._buffered if self.poller.reading(fileno)]))
+                self._buffered = set()
 
-                if fileno in self.write_fds:
-                    self.write_fds.pop(fileno)
+            for selected in write:
+                nw = self.poller.lookup(selected)
+                if nw:
+                    self.__proceed(nw, selected)
 
             if not read:
                 BPSMeter.do.update()
                 continue
 
             for selected in read:
-                nw = self.read_fds[selected]
+                nw = self.poller.lookup(selected)
+                if not nw:
+                    continue
+                if nw.nntp and nw.nntp.connecting:
+                    # SSL handshake waiting for the server
+                    self.__proceed(nw, selected)
+                    continue
                 article = nw.article
                 server = nw.server
+                nzo = None
 
                 if article:
                     nzo = article.nzf.nzo
 
+                limit = None
+                if self.bandwidth.rate or server.bandwidth.rate:
+                    limit = self.budget(server)
+                    if limit <= 0:
+                        # Over budget, reading stops before the next poll
+                        continue
+                    limit = max(int(limit), BANDWIDTH_MIN_READ)
+
                 try:
-                    bytes, done, skip = nw.recv_chunk()
+                    bytes, done, skip = nw.recv_chunk(limit=limit)
                 except:
                     bytes, done, skip = (0, False, False)
 
@@ -468,169 +516,333 @@ class Downloader(Thread):
                     continue
 
                 else:
-                    if self.bandwidth_limit:
-                        bps = BPSMeter.do.get_bps()
-                        bps += bytes
-                        limit = self.bandwidth_limit * 1024
-                        if bps > limit:
-                            while BPSMeter.do.get_bps() > limit:
-                                time.sleep(0.05)
-                                BPSMeter.do.update()
+                    self.bandwidth.consume(bytes)
+                    server.bandwidth.consume(bytes)
                     BPSMeter.do.update(server.id, bytes)
 
                     if nzo:
                         nzo.bytes_downloaded += bytes
                         nzo.update_avg_kbs(BPSMeter.do.get_bps())
 
-                if len(nw.lines) == 1:
-                    code = nw.lines[0][:3]
-                    if not nw.connected or code == '480':
-                        done = False
+                # With pipelining, the buffer can hold more than one response
+                while self.__process_response(nw, done):
+                    done = nw.check_response()
+
+                if nw.ssl and nw.buffered():
+                    self._buffered.add(selected)
 
+    def budget(self, server):
+        """ Return the number of bytes a connection of 'server'
+            may read now, according to the global and server limit
+        """
+        now = time.time()
+        budget = None
+        for bucket in (self.bandwidth, server.bandwidth):
+            if bucket.rate:
+                tokens = bucket.available(now)
+                if budget is None or tokens < budget:
+                    budget = tokens
+        return budget
+
+    def throttle(self):
+        """ Stop reading from the connections of servers that used up
+            their bandwidth, a timer resumes them when there is bandwidth again.
+            Unread data stays in the socket buffers, so the servers slow down.
+        """
+        now = time.time()
+        first = self.bandwidth.delay(now)
+        for server in self.servers:
+            delay = max(first, server.bandwidth.delay(now))
+            if delay:
+                pending = bool(server.throttled)
+                for nw in server.busy_threads:
+                    if nw not in server.throttled and nw.nntp:
                         try:
-                            nw.finish_connect(code)
-                            if sabnzbd.LOG_ALL:
-                                logging.debug("%s@%s:%s last message -> %s", nw.thrdnum, nw.server.host,
-                                              nw.server.port, nw.lines[0])
-                            nw.lines = []
-                            nw.data = ''
-                        except NNTPPermanentError, error:
-                            # Handle login problems
-                            block = False
-                            penalty = 0
-                            msg = error.response
-                            ecode = msg[:3]
-                            display_msg = ' [%s]' % msg
-                            logging.debug('Server login problem: %s, %s', ecode, msg)
-                            if ((ecode in ('502', '400')) and clues_too_many(msg)) or \
-                                (ecode == '481' and clues_too_many(msg)):
-                                # Too many connections: remove this thread and reduce thread-setting for server
-                                # Plan to go back to the full number after a penalty timeout
-                                if server.active:
-                                    server.errormsg = Ta('Too many connections to server %s:%s') % ('', display_msg)
-                                    logging.error(Ta('Too many connections to server %s:%s'), server.host, server.port)
-                                    self.__reset_nw(nw, None, warn=False, destroy=True, quit=True)
-                                    self.plan_server(server.id, _PENALTY_TOOMANY)
-                                    server.threads -= 1
-                            elif ecode in ('502', '481') and clues_too_many_ip(msg):
-                                # Account sharing?
-                                if server.active:
-                                    server.errormsg = Ta('Probable account sharing') + display_msg
-                                    name = ' (%s:%s)' % (server.host, server.port)
-                                    logging.error(Ta('Probable account sharing') + name)
-                                    penalty = _PENALTY_SHARE
-                            elif ecode in ('481', '482', '381') or (ecode == '502' and clues_login(msg)):
-                                # Cannot login, block this server
-                                if server.active:
-                                    server.errormsg = Ta('Failed login for server %s') % display_msg
-                                    logging.error(Ta('Failed login for server %s'), '%s:%s' % (server.host, server.port))
-                                penalty = _PENALTY_PERM
-                                block = True
-                            elif ecode == '502':
-                                # Cannot connect (other reasons), block this server
-                                if server.active:
-                                    server.errormsg = Ta('Cannot connect to server %s [%s]') % ('', display_msg)
-                                    logging.warning(Ta('Cannot connect to server %s [%s]'), '%s:%s' % (server.host, server.port), msg)
-                                if clues_pay(msg):
-                                    penalty = _PENALTY_PERM
-                                else:
-                                    penalty = _PENALTY_502
-                                block = True
-                            else:
-                                # Unknown error, just keep trying
-                                if server.active:
-                                    server.errormsg = Ta('Cannot connect to server %s [%s]') % ('', display_msg)
-                                    logging.error(Ta('Cannot connect to server %s [%s]'),  '%s:%s' % (server.host, server.port), msg)
-                                    penalty = _PENALTY_UNKNOWN
-                            if block or (penalty and server.optional):
-                                if server.active:
-                                    server.active = False
-                                    if (not server.optional) and cfg.no_penalties():
-                                        penalty = _PENALTY_SHORT
-                                    if penalty and (block or server.optional):
-                                        logging.info('Server %s ignored for %s minutes', server.id, penalty)
-                                        self.plan_server(server.id, penalty)
-                                    NzbQueue.do.reset_all_try_lists()
-                                self.__reset_nw(nw, None, warn=False, quit=True)
-                            continue
+                            fileno = nw.nntp.sock.fileno()
                         except:
-                            logging.error(Ta('Connecting %s@%s:%s failed, message=%s'),
-                                              nw.thrdnum,
-                                              nw.server.host, nw.server.port, nw.lines[0])
-                            # No reset-warning needed, above logging is sufficient
-                            self.__reset_nw(nw, None, warn=False)
-
-                        if nw.connected:
-                            logging.info("Connecting %s@%s:%s finished",
-                                         nw.thrdnum, nw.server.host,
-                                         nw.server.port)
-                            self.__request_article(nw)
-
-                    elif code == '223':
-                        done = True
-                        logging.debug('Article <%s> is present', article.article)
-                        self.decoder.decode(article, nw.lines)
-
-                    elif code == '211':
-                        done = False
-
-                        logging.debug("group command ok -> %s",
-                                      nw.lines)
-                        nw.group = nw.article.nzf.nzo.group
-                        nw.lines = []
-                        nw.data = ''
-                        self.__request_article(nw)
+                            continue
+                        if self.poller.reading(fileno):
+                            self.poller.unregister(fileno)
+                            server.throttled[nw] = fileno
+                if server.throttled and not pending:
+                    self.add_timer(now + delay, 'bandwidth', server)
+
+    def unthrottle(self, server):
+        """ Resume reading for 'server' when there is bandwidth again """
+        now = time.time()
+        delay = max(self.bandwidth.delay(now), server.bandwidth.delay(now))
+        if delay:
+            if server.throttled:
+                self.add_timer(now + delay, 'bandwidth', server)
+        elif server.throttled:
+            for nw, fileno in server.throttled.iteritems():
+                nw.timeout = now + server.timeout
+                self.poller.register(fileno, nw)
+                if nw.ssl and nw.buffered():
+                    self._buffered.add(fileno)
+            server.throttled = {}
 
-                    elif code in ('411', '423', '430'):
-                        done = True
-                        nw.lines = None
+    #------------------------------------------------------------------------------
+    # Timers of the download loop: connection timeouts and back-offs,
+    # the end of a bandwidth pause and server penalties.
+    # A connection has one entry in the heap for its earliest deadline.
+    # Reading data moves nw.timeout forward without touching the heap, when
+    # the entry fires before the current nw.timeout it is simply re-added.
+    # A deadline that moves earlier gets its own entry, the later one
+    # then finds nothing to do.
+    # Reset connections wait in server.resting until their back-off
+    # timer fires, so the download loop never looks at them.
+
+    def add_timer(self, when, kind, item):
+        heapq.heappush(self._heap, (when, self._sequence.next(), kind, item))
+
+    def watch(self, nw):
+        """ Make sure the timeout of connection 'nw' will be checked """
+        if nw.timeout and (nw not in self._watched or nw.timeout < self._watched[nw]):
+            self._watched[nw] = nw.timeout
+            self.add_timer(nw.timeout, 'nw', nw)
+
+    def next_timer(self, limit):
+        """ Return seconds until the first timer, at most 'limit' (None is no limit) """
+        if self._heap:
+            wait = max(0.0, self._heap[0][0] - time.time())
+            if limit is None or wait < limit:
+                return wait
+        return limit
+
+    def run_timers(self):
+        """ Handle all expired timers """
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            when, seq, kind, item = heapq.heappop(self._heap)
+            if kind == 'nw':
+                if self._watched.get(item) == when:
+                    del self._watched[item]
+                self.check_timeout(item, now)
+            elif kind == 'bandwidth':
+                self.unthrottle(item)
+            elif kind == 'server':
+                self.trigger_server(*item)
+
+    def check_timeout(self, nw, now):
+        """ Handle timer of connection 'nw' """
+        if not nw.timeout:
+            return
+        server = nw.server
+        if nw.timeout > now:
+            # Still active, check again at the new deadline
+            self.watch(nw)
+        elif nw in server.throttled:
+            # Not reading, so no timeout either
+            nw.timeout = now + server.timeout
+            self.watch(nw)
+        elif nw in server.busy_threads:
+            self.__reset_nw(nw, "timed out")
+            server.bad_cons += 1
+            self.maybe_block_server(server)
+        elif nw in server.resting:
+            # Back-off ended, the loop can use the connection again
+            server.resting.remove(nw)
+            nw.timeout = None
+            server.idle_threads.append(nw)
 
-                        logging.info('Thread %s@%s:%s: Article ' + \
-                                        '%s missing (error=%s)',
-                                        nw.thrdnum, nw.server.host,
-                                        nw.server.port, article.article, code)
+    def connect_failed(self, nw):
+        """ Called for failed connects, handled at the top of the download loop """
+        self._failed.append(nw)
 
-                    elif code == '480':
+    def __proceed(self, nw, fileno):
+        """ Continue the connect of 'nw' now that its socket is ready """
+        try:
+            if nw.nntp.proceed():
+                # Connected, from now on only interested in reading
+                self.poller.register(fileno, nw)
+            else:
+                self.poller.register(fileno, nw, write=nw.nntp.want_write)
+        except:
+            self.poller.unregister(fileno)
+            nw.nntp.error(sys.exc_info()[1])
+
+    def __process_response(self, nw, done):
+        """ Handle the (partial) response of the current article of 'nw'
+            Return True when a next pipelined response may already be buffered
+        """
+        from sabnzbd.nzbqueue import NzbQueue
+        article = nw.article
+        server = nw.server
+
+        if not done and len(nw.lines) == 1:
+            code = nw.lines[0][:3]
+            if not nw.connected or code == '480':
+                done = False
+
+                try:
+                    nw.finish_connect(code)
+                    if sabnzbd.LOG_ALL:
+                        logging.debug("%s@%s:%s last message -> %s", nw.thrdnum, nw.server.host,
+                                      nw.server.port, nw.lines[0])
+                    nw.lines = []
+                except NNTPPermanentError, error:
+                    # Handle login problems
+                    block = False
+                    penalty = 0
+                    msg = error.response
+                    ecode = msg[:3]
+                    display_msg = ' [%s]' % msg
+                    logging.debug('Server login problem: %s, %s', ecode, msg)
+                    if ((ecode in ('502', '400')) and clues_too_many(msg)) or \
+                        (ecode == '481' and clues_too_many(msg)):
+                        # Too many connections: remove this thread and reduce thread-setting for server
+                        # Plan to go back to the full number after a penalty timeout
+                        if server.active:
+                            server.errormsg = Ta('Too many connections to server %s:%s') % ('', display_msg)
+                            logging.error(Ta('Too many connections to server %s:%s'), server.host, server.port)
+                            self.__reset_nw(nw, None, warn=False, destroy=True, quit=True)
+                            self.plan_server(server.id, _PENALTY_TOOMANY)
+                            server.threads -= 1
+                    elif ecode in ('502', '481') and clues_too_many_ip(msg):
+                        # Account sharing?
+                        if server.active:
+                            server.errormsg = Ta('Probable account sharing') + display_msg
+                            name = ' (%s:%s)' % (server.host, server.port)
+                            logging.error(Ta('Probable account sharing') + name)
+                            penalty = _PENALTY_SHARE
+                    elif ecode in ('481', '482', '381') or (ecode == '502' and clues_login(msg)):
+                        # Cannot login, block this server
+                        if server.active:
+                            server.errormsg = Ta('Failed login for server %s') % display_msg
+                            logging.error(Ta('Failed login for server %s'), '%s:%s' % (server.host, server.port))
+                        penalty = _PENALTY_PERM
+                        block = True
+                    elif ecode == '502':
+                        # Cannot connect (other reasons), block this server
+                        if server.active:
+                            server.errormsg = Ta('Cannot connect to server %s [%s]') % ('', display_msg)
+                            logging.warning(Ta('Cannot connect to server %s [%s]'), '%s:%s' % (server.host, server.port), msg)
+                        if clues_pay(msg):
+                            penalty = _PENALTY_PERM
+                        else:
+                            penalty = _PENALTY_502
+                        block = True
+                    else:
+                        # Unknown error, just keep trying
+                        if server.active:
+                            server.errormsg = Ta('Cannot connect to server %s [%s]') % ('', display_msg)
+                            logging.error(Ta('Cannot connect to server %s [%s]'),  '%s:%s' % (server.host, server.port), msg)
+                            penalty = _PENALTY_UNKNOWN
+                    if block or (penalty and server.optional):
                         if server.active:
                             server.active = False
-                            server.errormsg = T('Server %s requires user/password') % ''
-                            self.plan_server(server.id, 0)
+                            if (not server.optional) and cfg.no_penalties():
+                                penalty = _PENALTY_SHORT
+                            if penalty and (block or server.optional):
+                                logging.info('Server %s ignored for %s minutes', server.id, penalty)
+                                self.plan_server(server.id, penalty)
                             NzbQueue.do.reset_all_try_lists()
-                        msg = T('Server %s requires user/password') % ('%s:%s' % (nw.server.host, nw.server.port))
-                        self.__reset_nw(nw, msg, quit=True)
+                        self.__reset_nw(nw, None, warn=False, quit=True)
+                    return False
+                except:
+                    logging.error(Ta('Connecting %s@%s:%s failed, message=%s'),
+                                      nw.thrdnum,
+                                      nw.server.host, nw.server.port, nw.lines[0])
+                    # No reset-warning needed, above logging is sufficient
+                    self.__reset_nw(nw, None, warn=False)
+
+                if nw.connected:
+                    logging.info("Connecting %s@%s:%s finished",
+                                 nw.thrdnum, nw.server.host,
+                                 nw.server.port)
+                    self.__request_article(nw)
+
+            elif code == '223':
+                done = True
+                logging.debug('Article <%s> is present', article.article)
+                self.decoder.decode(article, nw.lines)
+
+            elif code == '211':
+                done = False
+
+                logging.debug("group command ok -> %s",
+                              nw.lines)
+                nw.group = nw.article.nzf.nzo.group
+                nw.lines = []
+                self.__request_article(nw)
+
+            elif code in ('411', '423', '430'):
+                done = True
+                nw.lines = None
+
+                logging.info('Thread %s@%s:%s: Article ' + \
+                                '%s missing (error=%s)',
+                                nw.thrdnum, nw.server.host,
+                                nw.server.port, article.article, code)
+
+            elif code == '480':
+                if server.active:
+                    server.active = False
+                    server.errormsg = T('Server %s requires user/password') % ''
+                    self.plan_server(server.id, 0)
+                    NzbQueue.do.reset_all_try_lists()
+                msg = T('Server %s requires user/password') % ('%s:%s' % (nw.server.host, nw.server.port))
+                self.__reset_nw(nw, msg, quit=True)
+
+        if done:
+            server.bad_cons = 0 # Succesful data, clear "bad" counter
+            if sabnzbd.LOG_ALL:
+                logging.debug('Thread %s@%s:%s: %s done', nw.thrdnum, server.host,
+                               server.port, article.article)
+            self.decoder.decode(article, nw.lines)
+
+            if nw.pipeline:
+                # Continue with the next article on this connection,
+                # its response may already be in the buffer
+                nw.next_article()
+                return True
 
-                if done:
-                    server.bad_cons = 0 # Succesful data, clear "bad" counter
+            nw.soft_reset()
+            server.busy_threads.remove(nw)
+            server.idle_threads.append(nw)
+        return False
+
+    def __fill_pipeline(self, server):
+        """ Request extra articles on busy connections of 'server',
+            up to the server's pipelining depth
+        """
+        from sabnzbd.nzbqueue import NzbQueue
+        for nw in server.busy_threads[:]:
+            if not (nw.connected and nw.article):
+                continue
+            while len(nw.pipeline) + 1 < server.pipelining:
+                article = NzbQueue.do.get_article(server)
+                if not article:
+                    return
+
+                if server.retention and article.nzf.nzo.avg_stamp < time.time() - server.retention:
+                    # Article too old for the server, treat as missing
+                    self.decoder.decode(article, None)
+                    return
+
+                nw.pipeline.append(article)
+                try:
                     if sabnzbd.LOG_ALL:
-                        logging.debug('Thread %s@%s:%s: %s done', nw.thrdnum, server.host,
-                                       server.port, article.article)
-                    self.decoder.decode(article, nw.lines)
-
-                    nw.soft_reset()
-                    server.busy_threads.remove(nw)
-                    server.idle_threads.append(nw)
-
-    def __lookup_nw(self, nw):
-        ''' Find the fileno matching the nw, needed for closed connections '''
-        for f in self.read_fds:
-            if self.read_fds[f] == nw:
-                return f
-        for f in self.write_fds:
-            if self.read_fds[f] == nw:
-                return f
-        return None
+                        logging.debug('Thread %s@%s:%s: BODY %s (pipelined)', nw.thrdnum, server.host,
+                                      server.port, article.article)
+                    nw.body(article.nzf.nzo.precheck, article)
+                except:
+                    logging.info('Looks like server closed connection', exc_info=True)
+                    self.__reset_nw(nw, "server broke off connection", quit=False)
+                    break
 
     def __reset_nw(self, nw, errormsg, warn=True, wait=True, destroy=False, quit=False):
         from sabnzbd.nzbqueue import NzbQueue
         server = nw.server
-        article = nw.article
+        articles = [nw.article] + nw.pipeline
         fileno = None
 
         if nw.nntp:
             try:
                 fileno = nw.nntp.sock.fileno()
             except:
-                fileno = self.__lookup_nw(nw)
+                fileno = self.poller.find(nw)
                 destroy = True
             nw.nntp.error_msg = None
 
@@ -642,17 +854,19 @@ class Downloader(Thread):
             logging.info('Thread %s@%s:%s: ' + errormsg,
                              nw.thrdnum, server.host, server.port)
 
+        server.throttled.pop(nw, None)
         if nw in server.busy_threads:
             server.busy_threads.remove(nw)
-        if not (destroy or nw in server.idle_threads):
+        if not (destroy or nw in server.idle_threads or nw in server.resting):
             server.idle_threads.append(nw)
 
-        if fileno and fileno in self.write_fds:
-            self.write_fds.pop(fileno)
-        if fileno and fileno in self.read_fds:
-            self.read_fds.pop(fileno)
+        if fileno:
+            self.poller.unregister(fileno)
 
-        if article:
+        # Requeue the current article and all pipelined ones
+        for article in articles:
+            if not article:
+                continue
             if article.tries > cfg.max_art_tries() and (article.fetcher.optional or not cfg.max_art_opt()):
                 # Too many tries on this server, consider article missing
                 self.decoder.decode(article, None)
@@ -670,6 +884,10 @@ class Downloader(Thread):
             nw.terminate(quit=quit)
         else:
             nw.hard_reset(wait, quit=quit)
+            if nw in server.idle_threads:
+                server.idle_threads.remove(nw)
+                server.resting.append(nw)
+            self.watch(nw)
 
     def __request_article(self, nw):
         try:
@@ -685,10 +903,11 @@ class Downloader(Thread):
                     logging.debug('Thread %s@%s:%s: BODY %s', nw.thrdnum, nw.server.host,
                                   nw.server.port, nw.article.article)
                 nw.body(nzo.precheck)
+            self.watch(nw)
 
             fileno = nw.nntp.sock.fileno()
-            if fileno not in self.read_fds:
-                self.read_fds[fileno] = nw
+            if not (self.poller.reading(fileno) or nw in nw.server.throttled):
+                self.poller.register(fileno, nw)
         except socket.error, err:
             logging.info('Looks like server closed connection: %s', err)
             self.__reset_nw(nw, "server broke off connection", quit=False)
@@ -713,11 +932,11 @@ class Downloader(Thread):
         stamp = time.time() + 60.0 * interval
         self._timers[server_id].append(stamp)
         if interval:
-            sabnzbd.scheduler.plan_server(self.trigger_server, [server_id, stamp], interval)
+            self.add_timer(stamp, 'server', (server_id, stamp))
 
     @synchronized(TIMER_LOCK)
     def trigger_server(self, server_id, timestamp):
-        """ Called by scheduler, start server if timer still valid """
+        """ Called by the timers, start server if timer still valid """
         logging.debug('Trigger planned server resume %s', server_id)
         if server_id in self._timers:
             if timestamp in self._timers[server_id]:
@@ -768,14 +987,15 @@ class Downloader(Thread):
     def update_server(self, oldserver, newserver):
         self.init_server(oldserver, newserver)
 
-    @synchronized_CV
     def wakeup(self):
-        """ Just rattle the semaphore
+        """ Interrupt the wait for socket events, so that
+            changes of queue, pause state or servers are seen at once
         """
-        pass
+        self.poller.wake()
 
     def stop(self):
         self.shutdown = True
+        self.wakeup()
         growler.send_notification("SABnzbd",T('Shutting down'), 'startup')
 
 
@@ -0,0 +1,148 @@
+#!/usr/bin/python -OO
+# Copyright 2008-2012 The SABnzbd-Team <team@sabnzbd.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+sabnzbd.events - event bus behind the live status channel
+"""
+
+import time
+from threading import Lock, Condition
+
+import sabnzbd
+from sabnzbd.constants import MAX_EVENTS, MAX_EVENT_WATCHERS, EVENT_KEEPALIVE, EVENT_RATE
+from sabnzbd.utils.json import JsonWriter
+
+#------------------------------------------------------------------------------
+# Producers (queue, post-processor, bpsmeter, warnings) post events,
+# any number of watchers wait on one condition for new ones.
+# Events are numbered, a watcher asks for everything after the last
+# number it has seen, so one list serves all watchers.
+
+__CV = Condition(Lock())
+
+# Start beyond any number handed out before a restart, so that an old
+# number is recognized as unknown and the client can start over
+__LAST = int(time.time() * 1000)
+__EVENTS = []       # List of (number, time, type, data)
+__DUE = {}          # Type -> earliest time for the next rate limited event
+__WATCHERS = 0      # Clients waiting for events
+
+
+def post(kind, data):
+    """ Add event of type 'kind' with dictionary 'data' and wake the watchers """
+    global __LAST
+    __CV.acquire()
+    try:
+        __LAST += 1
+        __EVENTS.append((__LAST, time.time(), kind, data))
+        if len(__EVENTS) > MAX_EVENTS:
+            del __EVENTS[:len(__EVENTS) - MAX_EVENTS]
+        __CV.notifyAll()
+    finally:
+        __CV.release()
+
+
+def due(kind):
+    """ Return True when rate limited event 'kind' may be posted now,
+        so that producers only build the event when it's going out
+    """
+    now = time.time()
+    if now < __DUE.get(kind, 0):
+        return False
+    __DUE[kind] = now + EVENT_RATE
+    return True
+
+
+def last():
+    """ Return the number of the latest event """
+    return __LAST
+
+
+def get(since, timeout=0):
+    """ Return (last, reset, events) with the events after number 'since',
+        waiting at most 'timeout' seconds for them.
+        'reset' is True when events after 'since' were already dropped.
+    """
+    __CV.acquire()
+    try:
+        if timeout and since == __LAST:
+            __CV.wait(timeout)
+        reset = since > __LAST or \
+                (since < __LAST and (not __EVENTS or since < __EVENTS[0][0] - 1))
+        events = [event for event in __EVENTS if event[0] > since]
+        return __LAST, reset, events
+    finally:
+        __CV.release()
+
+
+def watch():
+    """ Register a waiting client, return False when there are
+        too many already (each one occupies a web server thread)
+    """
+    global __WATCHERS
+    __CV.acquire()
+    try:
+        if __WATCHERS >= MAX_EVENT_WATCHERS:
+            return False
+        __WATCHERS += 1
+        return True
+    finally:
+        __CV.release()
+
+
+def unwatch():
+    """ Unregister a waiting client """
+    global __WATCHERS
+    __CV.acquire()
+    try:
+        __WATCHERS -= 1
+    finally:
+        __CV.release()
+
+
+def as_dict(event):
+    """ Return API representation of an event """
+    number, stamp, kind, data = event
+    info = {'id' : number, 'time' : int(stamp), 'type' : kind}
+    info.update(data)
+    return info
+
+
+def stream(since):
+    """ Generator of server-sent events after number 'since',
+        a comment line is sent as keep-alive and to detect closed connections
+    """
+    if not watch():
+        yield 'event: busy\ndata: {}\n\n'
+        return
+    try:
+        writer = JsonWriter()
+        if since is None:
+            since = __LAST
+        while not sabnzbd.__SHUTTING_DOWN__:
+            since, reset, events = get(since, EVENT_KEEPALIVE)
+            lines = []
+            if reset:
+                lines.append('event: reset\ndata: {}\n\n')
+            for event in events:
+                lines.append('id: %s\nevent: %s\ndata: %s\n\n' % (event[0], event[2], writer.write(as_dict(event))))
+            if lines:
+                yield ''.join(lines)
+            else:
+                yield ': keep-alive\n\n'
+    finally:
+        unwatch()
@@ -30,6 +30,7 @@ from xml.sax.saxutils import escape
 from sabnzbd.utils.rsslib import RSS, Item
 import sabnzbd
 import sabnzbd.rss
+import sabnzbd.events
 import sabnzbd.scheduler as scheduler
 
 from Cheetah.Template import Template
@@ -151,6 +152,10 @@ def set_auth(conf):
                      '/m/api':{'tools.basic_auth.on' : False},
                      '/sabnzbd/api':{'tools.basic_auth.on' : False},
                      '/sabnzbd/m/api':{'tools.basic_auth.on' : False},
+                     '/events':{'tools.basic_auth.on' : False},
+                     '/m/events':{'tools.basic_auth.on' : False},
+                     '/sabnzbd/events':{'tools.basic_auth.on' : False},
+                     '/sabnzbd/m/events':{'tools.basic_auth.on' : False},
                      })
     else:
         conf.update({'tools.basic_auth.on':False})
@@ -403,6 +408,20 @@ class MainPage(object):
             if msg: return msg
         return api_handler(kwargs)
 
+    @cherrypy.expose
+    def events(self, **kwargs):
+        """ Live status as server-sent events, requires the api key
+        """
+        msg = check_apikey(kwargs)
+        if msg: return msg
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        # A reconnecting browser tells where it was
+        since = cherrypy.request.headers.get('Last-Event-ID', kwargs.get('since'))
+        if since is not None:
+            since = int_conv(since)
+        return sabnzbd.events.stream(since)
+
     @cherrypy.expose
     def scriptlog(self, **kwargs):
         """ Duplicate of scriptlog of History, needed for some skins """
@@ -0,0 +1,164 @@
+#!/usr/bin/python -OO
+# Copyright 2008-2012 The SABnzbd-Team <team@sabnzbd.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+sabnzbd.journal - changes of a job since its last snapshot
+"""
+
+import os
+import struct
+import zlib
+import logging
+import cPickle
+from threading import RLock
+
+from sabnzbd.constants import JOURNAL_FILE
+from sabnzbd.decorators import synchronized
+
+# The pickled NzbObject is the snapshot of a job, the journal next to it
+# holds the changes made since. Saving a change costs the same for any
+# size of job, only writing a new snapshot does not.
+#
+# Layout of the journal file:
+#   header: magic, generation of the snapshot it belongs to
+#   record: length and crc32 of the data, followed by the data,
+#           which is a pickled list of entries
+# A journal of another generation than the snapshot is stale and ignored.
+# Reading stops at the first incomplete or damaged record.
+
+MAGIC = 'SABJRNL1'
+HEADER = struct.Struct('<8sI')
+RECORD = struct.Struct('<II')
+
+# Changes are logged from several threads, all journals share this lock
+JOURNAL_LOCK = RLock()
+
+
+class Journal(object):
+    """ Append-only log of the changes of one job """
+    def __init__(self):
+        self.pending = []       # Entries not yet on disk
+        self.held = {}          # nzf_id -> entries kept back until the file is on disk
+        self.names = {}         # Last logged (filename, type) per nzf_id
+        self.size = 0           # Size of the journal file, 0 means to start a new one
+        self.snapshot_size = 0  # Size of the last snapshot
+        self.active = True      # Accept new entries
+
+    @synchronized(JOURNAL_LOCK)
+    def add(self, entry, hold=None):
+        """ Log one entry, a tuple starting with the kind of change
+            Entries with 'hold' set wait for release(hold).
+        """
+        if self.active:
+            if hold is None:
+                self.pending.append(entry)
+            else:
+                self.held.setdefault(hold, []).append(entry)
+
+    @synchronized(JOURNAL_LOCK)
+    def release(self, nzf_id):
+        """ Pass the held entries of file 'nzf_id' to the next flush """
+        entries = self.held.pop(nzf_id, None)
+        if entries:
+            self.pending.extend(entries)
+
+    @synchronized(JOURNAL_LOCK)
+    def add_name(self, nzf_id, filename, _type, direct=None):
+        """ Log filename, type and write mode of a file, when changed """
+        name = (filename, _type, direct)
+        if self.names.get(nzf_id) != name:
+            self.names[nzf_id] = name
+            self.add(('name', nzf_id, filename, _type, direct))
+
+    @synchronized(JOURNAL_LOCK)
+    def flush(self, path, gen):
+        """ Append the pending entries to the journal file in 'path' """
+        if not self.pending:
+            return
+        data = cPickle.dumps(self.pending, 2)
+        self.pending = []
+        name = os.path.join(path, JOURNAL_FILE)
+        try:
+            if self.size:
+                f = open(name, 'ab')
+            else:
+                f = open(name, 'wb')
+                f.write(HEADER.pack(MAGIC, gen))
+                self.size = HEADER.size
+            f.write(RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff))
+            f.write(data)
+            f.close()
+            self.size += RECORD.size + len(data)
+        except (IOError, OSError):
+            # Next flush starts a new file, the snapshot still stands
+            self.size = 0
+            logging.error(Ta('Saving %s failed'), name)
+            logging.info("Traceback: ", exc_info = True)
+
+    @synchronized(JOURNAL_LOCK)
+    def reset(self, path, gen, snapshot_size):
+        """ Start an empty journal after a snapshot of generation 'gen' """
+        self.pending = []
+        self.held = {}
+        self.size = 0
+        self.snapshot_size = snapshot_size
+        name = os.path.join(path, JOURNAL_FILE)
+        try:
+            f = open(name, 'wb')
+            f.write(HEADER.pack(MAGIC, gen))
+            f.close()
+            self.size = HEADER.size
+        except (IOError, OSError):
+            logging.error(Ta('Saving %s failed'), name)
+            logging.info("Traceback: ", exc_info = True)
+
+    @synchronized(JOURNAL_LOCK)
+    def load(self, path, gen):
+        """ Return the entries logged after snapshot 'gen'
+            A damaged tail is cut off, so that new records follow the last good one.
+        """
+        entries = []
+        self.size = 0
+        name = os.path.join(path, JOURNAL_FILE)
+        try:
+            f = open(name, 'r+b')
+        except IOError:
+            return entries
+        try:
+            try:
+                data = f.read()
+                if len(data) < HEADER.size or HEADER.unpack_from(data, 0) != (MAGIC, gen):
+                    logging.info('Ignoring stale journal %s', name)
+                    return entries
+                pos = HEADER.size
+                while pos + RECORD.size <= len(data):
+                    length, crc = RECORD.unpack_from(data, pos)
+                    record = data[pos + RECORD.size:pos + RECORD.size + length]
+                    if len(record) < length or zlib.crc32(record) & 0xffffffff != crc:
+                        break
+                    entries.extend(cPickle.loads(record))
+                    pos += RECORD.size + length
+                if pos < len(data):
+                    logging.info('Cutting damaged tail of journal %s', name)
+                    f.truncate(pos)
+                self.size = pos
+            except:
+                logging.error(Ta('Loading %s failed'), name)
+                logging.info("Traceback: ", exc_info = True)
+        finally:
+            f.close()
+        return entries
@@ -19,6 +19,7 @@
 sabnzbd.newswrapper
 """
 
+import os
 import errno
 import socket
 from threading import Thread
@@ -29,23 +30,43 @@ import logging
 import sabnzbd
 from sabnzbd.constants import *
 
+# The standard ssl module is used when it has contexts (Python 2.7.9 and up),
+# otherwise pyOpenSSL
+_ssl = None
+_pyopenssl = None
 try:
-    from OpenSSL import SSL
-    _ssl = SSL
-    WantReadError = _ssl.WantReadError
-    del SSL
-    HAVE_SSL = True
-
-except ImportError:
-    _ssl = None
-    HAVE_SSL = False
-
-    # Dummy class so this exception is ignored by clients without ssl installed
-    class WantReadError(Exception):
-        def __init__(self, value):
-            self.parameter = value
-        def __str__(self):
-            return repr(self.parameter)
+    import ssl
+    ssl.SSLContext
+    _ssl = ssl
+    WantReadError = ssl.SSLWantReadError
+    WantWriteError = ssl.SSLWantWriteError
+    SSLError = ssl.SSLError
+    HAVE_SSL = 'ssl, %s' % ssl.OPENSSL_VERSION
+    del ssl
+except (ImportError, AttributeError):
+    try:
+        from OpenSSL import SSL
+        _pyopenssl = SSL
+        WantReadError = SSL.WantReadError
+        WantWriteError = SSL.WantWriteError
+        SSLError = SSL.Error
+        HAVE_SSL = 'pyOpenSSL'
+        del SSL
+    except ImportError:
+        HAVE_SSL = False
+
+        # Dummy classes so these exceptions are ignored by clients without ssl installed
+        class WantReadError(Exception):
+            def __init__(self, value):
+                self.parameter = value
+            def __str__(self):
+                return repr(self.parameter)
+
+        class WantWriteError(WantReadError):
+            pass
+
+        class SSLError(WantReadError):
+            pass
 
 import threading
 _RLock = threading.RLock
@@ -56,6 +77,12 @@ import select
 
 socket.setdefaulttimeout(DEF_TIMEOUT)
 
+# Response codes that are followed by a multi-line data block
+MULTILINE_CODES = ('220', '221', '222')
+
+# Results of connect_ex() for a non-blocking connect that is under way
+CONNECT_PENDING = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
 
 #------------------------------------------------------------------------------
 # getaddrinfo() can be very slow. In some situations this can lead
@@ -75,6 +102,54 @@ def _retrieve_info(server):
     sabnzbd.downloader.Downloader.do.wakeup()
 
 
+#------------------------------------------------------------------------------
+# SSL contexts are shared by all connections with the same ssl_type
+
+_CONTEXTS = {}
+
+def ssl_context(ssl_type):
+    """ Return SSL context for 'ssl_type' ('v2', 'v3' or the default 'v23').
+        Certificates are not verified, like before the ssl module was used.
+    """
+    ctx = _CONTEXTS.get(ssl_type)
+    if ctx is None:
+        if _ssl:
+            protocol = _ssl.PROTOCOL_SSLv23
+            if ssl_type == 'v2':
+                protocol = getattr(_ssl, 'PROTOCOL_SSLv2', protocol)
+            elif ssl_type == 'v3':
+                protocol = getattr(_ssl, 'PROTOCOL_SSLv3', protocol)
+            ctx = _ssl.SSLContext(protocol)
+            if protocol == _ssl.PROTOCOL_SSLv23:
+                # Negotiate the best TLS version, broken SSL versions only when asked for
+                if ssl_type != 'v2':
+                    ctx.options |= _ssl.OP_NO_SSLv2
+                if ssl_type not in ('v2', 'v3'):
+                    ctx.options |= _ssl.OP_NO_SSLv3
+            ctx.options |= getattr(_ssl, 'OP_NO_COMPRESSION', 0)
+            ctx.verify_mode = _ssl.CERT_NONE
+        else:
+            if ssl_type == 'v2':
+                ctx = _pyopenssl.Context(_pyopenssl.SSLv2_METHOD)
+            elif ssl_type == 'v3':
+                ctx = _pyopenssl.Context(_pyopenssl.SSLv3_METHOD)
+            else:
+                ctx = _pyopenssl.Context(_pyopenssl.SSLv23_METHOD)
+        _CONTEXTS[ssl_type] = ctx
+    return ctx
+
+
+def ssl_socket(sock, hostname):
+    """ Return SSL wrapper for unconnected socket 'sock' of server 'hostname' """
+    ctx = ssl_context(sabnzbd.cfg.ssl_type())
+    if _ssl:
+        if not _ssl.HAS_SNI:
+            hostname = None
+        return ctx.wrap_socket(sock, do_handshake_on_connect=False, server_hostname=hostname)
+    else:
+        return SSLConnection(ctx, sock)
+
+
 def request_server_info(server):
     """ Launch async request to resolve server address
     """
@@ -103,89 +178,54 @@ def GetServerParms(host, port):
             return None
 
 
-def con(sock, host, port, sslenabled, write_fds, nntp):
-    assert isinstance(nntp, NNTP)
-    try:
-        sock.connect((host, port))
-        sock.setblocking(0)
-        if sslenabled and _ssl:
-            while True:
-                try:
-                    sock.do_handshake()
-                    break
-                except WantReadError:
-                    select.select([sock], [], [], 1.0)
-
-        # Now it's safe to add the socket to the list of active sockets.
-        # 'write_fds' is an attribute of the Downloader singleton.
-        # This direct access is needed to prevent multi-threading sync problems.
-        if write_fds is not None:
-            write_fds[sock.fileno()] = nntp.nw
-
-    except socket.error, e:
-        try:
-            # socket.error can either return a string or a tuple
-            if isinstance(e, tuple):
-                (_errno, strerror) = e
-            else:
-                # Are we safe to hardcode the ETIMEDOUT error?
-                (_errno, strerror) = (errno.ETIMEDOUT, str(e))
-                e = (_errno, strerror)
-            #expected, do nothing
-            if _errno == errno.EINPROGRESS:
-                pass
-        finally:
-            nntp.error(e)
-
-    except _ssl.Error, e:
-        nntp.error(e)
-
 class NNTP(object):
-    def __init__(self, host, port, info, sslenabled, nw, user=None, password=None, block=False, write_fds=None):
+    def __init__(self, host, port, info, sslenabled, nw, user=None, password=None, block=False, poller=None):
         assert isinstance(nw, NewsWrapper)
         self.host = host
         self.port = port
         self.nw = nw
         self.blocking = block
+        self.sslenabled = bool(sslenabled and HAVE_SSL)
         self.error_msg = None
+        self.connecting = False     # Non-blocking connect under way
+        self.handshaking = False    # SSL handshake under way
+        self.want_write = True      # The next step needs a writable socket
         if not info:
             if block:
                 info = GetServerParms(host, port)
             else:
                 raise socket.error(errno.EADDRNOTAVAIL, "Address not available - Check for internet or DNS problems")
 
-        af, socktype, proto, canonname, sa = info[0]
-
-        if sslenabled and _ssl:
-            # Some users benefit from SSLv2 not being capped.
-            ssl_type = sabnzbd.cfg.ssl_type.get()
-            if ssl_type == 'v2':
-                ctx = _ssl.Context(_ssl.SSLv2_METHOD)
-            elif ssl_type == 'v3':
-                ctx = _ssl.Context(_ssl.SSLv3_METHOD)
-            else:
-                ctx = _ssl.Context(_ssl.SSLv23_METHOD)
+        # Use the resolved address of 'host', connecting by name would wait for DNS
+        for af, socktype, proto, canonname, sa in info:
+            if sa[0] == host:
+                break
+        else:
+            af, socktype, proto, canonname, sa = info[0]
 
-            self.sock = SSLConnection(ctx, socket.socket(af, socktype, proto))
-        elif sslenabled and not _ssl:
+        if sslenabled and HAVE_SSL:
+            self.sock = ssl_socket(socket.socket(af, socktype, proto), nw.server.host)
+        elif sslenabled:
             logging.error(Ta('Error importing OpenSSL module. Connecting with NON-SSL'))
             self.sock = socket.socket(af, socktype, proto)
         else:
             self.sock = socket.socket(af, socktype, proto)
 
         try:
-            # Windows must do the connection in a seperate thread due to non-blocking issues
-            # If the server wants to be blocked (for testing) then use the linux route
             if not block:
-                Thread(target=con, args=(self.sock, self.host, self.port, sslenabled, write_fds, self)).start()
+                # The download loop continues with proceed() when the socket is ready
+                self.sock.setblocking(0)
+                _errno = self.sock.connect_ex(sa)
+                if _errno not in CONNECT_PENDING:
+                    raise socket.error(_errno, os.strerror(_errno))
+                self.connecting = True
+                if poller is not None:
+                    poller.register(self.sock.fileno(), nw, write=True)
             else:
-                # if blocking (server test) only wait for 4 seconds during connect until timeout
-                if block:
-                    self.sock.settimeout(10)
+                # if blocking (server test) only wait for 10 seconds during connect until timeout
+                self.sock.settimeout(10)
                 self.sock.connect((self.host, self.port))
-                if not block:
-                    self.sock.setblocking(0)
-                if sslenabled and _ssl:
+                if self.sslenabled:
                     while True:
                         try:
                             self.sock.do_handshake()
@@ -208,11 +248,35 @@ class NNTP(object):
             finally:
                 self.error(e)
 
-        except _ssl.Error, e:
+        except SSLError, e:
             self.error(e)
 
+    def proceed(self):
+        """ Continue the non-blocking connect and SSL handshake when the socket is ready,
+            return True when done, otherwise 'want_write' tells what to wait for.
+            Failures raise socket or SSL errors.
+        """
+        if not self.handshaking:
+            _errno = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if _errno:
+                raise socket.error(_errno, os.strerror(_errno))
+            if not self.sslenabled:
+                self.connecting = False
+                return True
+            self.handshaking = True
+        try:
+            self.sock.do_handshake()
+        except WantWriteError:
+            self.want_write = True
+            return False
+        except WantReadError:
+            self.want_write = False
+            return False
+        self.connecting = self.handshaking = False
+        return True
+
     def error(self, error):
-        if 'SSL23_GET_SERVER_HELLO' in str(error):
+        if 'SSL23_GET_SERVER_HELLO' in str(error) or 'WRONG_VERSION_NUMBER' in str(error):
             error = 'This server does not allow SSL on this port'
         msg = "Failed to connect: %s" % (str(error))
         msg = "%s %s@%s:%s" % (msg, self.nw.thrdnum, self.host, self.port)
@@ -222,6 +286,7 @@ class NNTP(object):
         else:
             logging.info(msg)
             self.nw.server.warning = msg
+            sabnzbd.downloader.Downloader.do.connect_failed(self.nw)
 
 class NewsWrapper(object):
     def __init__(self, server, thrdnum, block=False):
@@ -231,11 +296,20 @@ class NewsWrapper(object):
 
         self.timeout = None
         self.article = None
-        self.data = ''
         self.lines = []
 
+        self.pipeline = []      # Articles requested after the current one
+
+        # Receive buffer, filled in place by recv_into()
+        self.buffer = bytearray(NNTP_BUFFER_SIZE)
+        self.buf_start = 0      # Start of the unprocessed response
+        self.buf_end = 0        # End of the received data
+        self.scan_pos = 0       # Search start for the terminator
+
         self.nntp = None
         self.recv = None
+        self.recv_into = None
+        self.ssl = False
 
         self.connected = False
 
@@ -248,10 +322,14 @@ class NewsWrapper(object):
         self.pass_ok = False
         self.force_login = False
 
-    def init_connect(self, write_fds):
+    def init_connect(self, poller):
         self.nntp = NNTP(self.server.hostip, self.server.port, self.server.info, self.server.ssl, self,
-                         self.server.username, self.server.password, self.blocking, write_fds)
+                         self.server.username, self.server.password, self.blocking, poller)
         self.recv = self.nntp.sock.recv
+        # pyOpenSSL connections have no recv_into(), they use recv() and a copy
+        self.recv_into = getattr(self.nntp.sock, 'recv_into', None)
+        # A non-blocking SSL read returns at most one record, the rest is read in the same go
+        self.ssl = self.nntp.sslenabled and not self.blocking
 
         self.timeout = time.time() + self.server.timeout
 
@@ -307,14 +385,17 @@ class NewsWrapper(object):
 
         self.timeout = time.time() + self.server.timeout
 
-    def body(self, precheck):
+    def body(self, precheck, article=None):
+        """ Request the current article or, when pipelining, 'article' """
+        if article is None:
+            article = self.article
         self.timeout = time.time() + self.server.timeout
         if precheck:
-            command = 'STAT <%s>\r\n' % (self.article.article)
+            command = 'STAT <%s>\r\n' % (article.article)
         elif self.server.oddball:
-            command = 'ARTICLE <%s>\r\n' % (self.article.article)
+            command = 'ARTICLE <%s>\r\n' % (article.article)
         else:
-            command = 'BODY <%s>\r\n' % (self.article.article)
+            command = 'BODY <%s>\r\n' % (article.article)
         self.nntp.sock.sendall(command)
 
     def send_group(self, group):
@@ -322,13 +403,24 @@ class NewsWrapper(object):
         command = 'GROUP %s\r\n' % (group)
         self.nntp.sock.sendall(command)
 
-    def recv_chunk(self, block=False):
-        """ Receive data, return #bytes, done, skip
+    def recv_chunk(self, block=False, limit=None):
+        """ Receive at most 'limit' bytes, return #bytes, done, skip
         """
         self.timeout = time.time() + self.server.timeout
+        self.__make_room()
         while 1:
             try:
-                chunk = self.recv(32768)
+                if self.recv_into:
+                    view = memoryview(self.buffer)[self.buf_end:]
+                    if limit:
+                        view = view[:limit]
+                    size = self.recv_into(view)
+                    if self.ssl:
+                        size += self.__recv_more(view, size)
+                else:
+                    chunk = self.recv(min(NNTP_CHUNK_SIZE, limit or NNTP_CHUNK_SIZE))
+                    size = len(chunk)
+                    self.buffer[self.buf_end:self.buf_end + size] = chunk
                 break
             except WantReadError:
                 # SSL connections will block until they are ready.
@@ -340,28 +432,101 @@ class NewsWrapper(object):
                 else:
                     return (0, False, True)
 
-        self.data += chunk
-        new_lines = self.data.split('\r\n')
-        # See if incorrect newline-only was used
-        # Do this as a special case to prevent using extra memory
-        # for normal articles
-        if len(new_lines) == 1 and '\r' not in self.data:
-            new_lines = self.data.split('\n')
+        self.buf_end += size
+        return (size, self.check_response(), False)
 
-        self.data = new_lines.pop()
-        self.lines.extend(new_lines)
+    def buffered(self):
+        """ Return True when the SSL layer holds data that was not read yet """
+        try:
+            return self.nntp.sock.pending() > 0
+        except:
+            return False
 
-        if self.lines and self.lines[-1] == '.':
-            self.lines = self.lines[1:-1]
-            return (len(chunk), True, False)
+    def __recv_more(self, view, size):
+        """ Read the SSL records that are available after the first 'size' bytes,
+            return the number of extra bytes
+        """
+        extra = 0
+        try:
+            while size + extra < len(view):
+                got = self.recv_into(view[size + extra:])
+                if not got:
+                    break
+                extra += got
+        except WantReadError:
+            pass
+        return extra
+
+    def __make_room(self):
+        """ Move pending data to the start of the buffer and
+            make sure at least one chunk fits behind it
+        """
+        if self.buf_start:
+            if self.buf_start == self.buf_end:
+                self.buf_end = self.scan_pos = 0
+            else:
+                pending = self.buf_end - self.buf_start
+                self.buffer[:pending] = self.buffer[self.buf_start:self.buf_end]
+                self.buf_end = pending
+                self.scan_pos = max(0, self.scan_pos - self.buf_start)
+            self.buf_start = 0
+        if len(self.buffer) - self.buf_end < NNTP_CHUNK_SIZE:
+            self.buffer.extend(bytearray(len(self.buffer)))
+
+    def check_response(self):
+        """ Return True when the multi-line response for the current article is complete,
+            it is then available as a single string in self.lines.
+            A single-line response is returned as the list self.lines, the caller handles it.
+            When pipelining, the buffer can hold further responses after the current one.
+        """
+        buf = self.buffer
+        start = self.buf_start
+        end = self.buf_end
+        eol = buf.find('\n', start, end)
+        if eol < 0:
+            # Status line not complete yet
+            return False
+
+        status = str(buf[start:eol]).rstrip('\r')
+        if status[:3] not in MULTILINE_CODES:
+            self.lines = [status]
+            self.buf_start = self.scan_pos = eol + 1
+            return False
+
+        # Look for the terminator in the newly received data only,
+        # servers that use plain newlines need a different one
+        if buf[eol - 1] == 13:
+            term = '\r\n.\r\n'
+        else:
+            term = '\n.\n'
+        pos = buf.find(term, max(eol + 1 - len(term) // 2, self.scan_pos), end)
+        if pos < 0:
+            self.lines = []
+            self.scan_pos = max(eol - 1, end - len(term) + 1)
+            return False
+
+        body = eol + 1
+        if pos > body:
+            self.lines = memoryview(buf)[body:pos].tobytes()
+            if term == '\n.\n':
+                self.lines = self.lines.replace('\n', '\r\n')
         else:
-            return (len(chunk), False, False)
+            self.lines = ''
+        self.buf_start = self.scan_pos = pos + len(term)
+        return True
+
+    def next_article(self):
+        """ Make the first pipelined article the current one """
+        self.article = self.pipeline.pop(0)
+        self.lines = []
+        self.timeout = time.time() + self.server.timeout
 
     def soft_reset(self):
         self.timeout = None
         self.article = None
-        self.data = ''
         self.lines = []
+        self.pipeline = []
+        self.buf_start = self.buf_end = self.scan_pos = 0
 
     def hard_reset(self, wait=True, quit=True):
         if self.nntp:
@@ -398,7 +563,7 @@ class NewsWrapper(object):
 
 class SSLConnection(object):
     def __init__(self, *args):
-        self._ssl_conn = apply(_ssl.Connection, args)
+        self._ssl_conn = apply(_pyopenssl.Connection, args)
         self._lock = _RLock()
 
     for f in ('get_context', 'pending', 'send', 'write', 'recv', 'read',
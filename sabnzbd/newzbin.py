@@ -42,6 +42,7 @@ from sabnzbd.encoding import name_fixer
 import sabnzbd.newswrapper
 import sabnzbd.cfg as cfg
 import sabnzbd.growler as growler
+import sabnzbd.revisions as revisions
 
 
 ################################################################################
@@ -82,6 +83,7 @@ class MSGIDGrabber(Thread):
         ''' Add job to the waiting queue, 'when' gives delay in seconds '''
         if when:
             nzo.wait = time.time() + when
+            revisions.bump('queue', nzo.nzo_id)
         self.queue.put((msgid, nzo))
 
     def stop(self):
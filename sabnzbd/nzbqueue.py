@@ -23,24 +23,30 @@ import os
 import logging
 import time
 import datetime
+import Queue
+from threading import Thread, Lock, Condition
 
 import sabnzbd
 from sabnzbd.trylist import TryList
+import sabnzbd.trylist as trylist
 from sabnzbd.nzbstuff import NzbObject
 from sabnzbd.misc import exit_sab, cat_to_opts, flag_file, \
                          get_admin_path, remove_all, globber
 from sabnzbd.panic import panic_queue
 import sabnzbd.database as database
-from sabnzbd.decorators import NZBQUEUE_LOCK, synchronized, synchronized_CV
+from sabnzbd.decorators import NZBQUEUE_LOCK, synchronized, synchronized_CV, wakeup_downloader
 from sabnzbd.constants import QUEUE_FILE_NAME, QUEUE_VERSION, FUTURE_Q_FOLDER, JOB_ADMIN, \
                               LOW_PRIORITY, NORMAL_PRIORITY, HIGH_PRIORITY, TOP_PRIORITY, \
                               REPAIR_PRIORITY, STOP_PRIORITY, VERIFIED_FILE, \
-                              PNFO_BYTES_FIELD, PNFO_BYTES_LEFT_FIELD, Status
+                              PNFO_BYTES_FIELD, PNFO_BYTES_LEFT_FIELD, PNFO_AVG_DATE_FIELD, \
+                              PNFO_STATUS_FIELD, JOURNAL_MIN_SIZE, QUEUE_LOAD_THREADS, MEBI, Status
 import sabnzbd.cfg as cfg
 from sabnzbd.articlecache import ArticleCache
 import sabnzbd.downloader
 from sabnzbd.assembler import Assembler, file_has_articles
 import sabnzbd.growler as growler
+import sabnzbd.revisions as revisions
+import sabnzbd.events as events
 from sabnzbd.encoding import latin1, platform_encode
 from sabnzbd.bpsmeter import BPSMeter
 
@@ -56,8 +62,21 @@ class NzbQueue(TryList):
         self.__top_only = False #cfg.top_only()
         self.__top_nzo = None
 
+        # Per server: index in self.__nzo_list before which no job has articles for it
+        self.__ready_pos = {}
+        self.__ready_epoch = trylist.current_epoch()
+
         self.__nzo_list = []
         self.__nzo_table = {}
+        # Jobs of the queue file not loaded yet, as (nzo_id, summary)
+        self.__pending = []
+        self.__loaders = []
+        # Position in the queue file of each job, while loading
+        self.__order = {}
+        # Jobs a loader is reading and jobs read but not added yet
+        self.__claimed = set()
+        self.__results = {}
+        self.__load_cv = Condition(Lock())
 
         NzbQueue.do = self
 
@@ -66,14 +85,18 @@ class NzbQueue(TryList):
             0 = no repairs
             1 = use existing queue, add missing "incomplete" folders
             2 = Discard all queue admin, reconstruct from "incomplete" folders
+            Without repair, the jobs are loaded in the background, in queue order.
+            Until then, the summaries from the queue file stand in for them.
         """
+        start = time.time()
         nzo_ids = []
+        summaries = []
         if repair < 2:
             # Read the queue from the saved files
             data = sabnzbd.load_admin(QUEUE_FILE_NAME)
             if data:
                 try:
-                    queue_vers, nzo_ids, dummy = data
+                    queue_vers, nzo_ids, summaries = data
                     if not queue_vers == QUEUE_VERSION:
                         nzo_ids = []
                         logging.error(Ta('Incompatible queuefile found, cannot proceed'))
@@ -87,20 +110,24 @@ class NzbQueue(TryList):
                     if not repair:
                         return
 
+        if not repair:
+            # Queue files of older releases have no summaries
+            if len(summaries) != len(nzo_ids):
+                summaries = [None] * len(nzo_ids)
+            self.__pending = zip(nzo_ids, summaries)
+            for n in xrange(len(nzo_ids)):
+                self.__order[os.path.split(nzo_ids[n])[1]] = n
+            self.__start_loader(self.__load_jobs, nzo_ids, start)
+            return
+
         # First handle jobs in the queue file
         folders = []
         for nzo_id in nzo_ids:
-            folder, _id = os.path.split(nzo_id)
-            # Try as normal job
-            path = get_admin_path(bool(folder), folder, False)
-            nzo = sabnzbd.load_data(_id, path, remove=False)
-            if not nzo:
-                # Try as future job
-                path = get_admin_path(bool(folder), folder, True)
-                nzo = sabnzbd.load_data(_id, path)
+            folder, nzo = load_job(nzo_id)
             if nzo:
                 self.add(nzo, save=False, quiet=True)
                 folders.append(folder)
+        logging.info('Loaded %s jobs in %.2f seconds', len(folders), time.time() - start)
 
         # Scan for any folders in "incomplete" that are not yet in the queue
         if repair:
@@ -114,6 +141,155 @@ class NzbQueue(TryList):
                         self.add(nzo, save=True)
 
 
+    def __start_loader(self, target, *args):
+        """ Run 'target' in a thread that is stopped at shutdown """
+        thread = Thread(target=target, args=args)
+        thread.setDaemon(True)
+        self.__loaders.append(thread)
+        thread.start()
+
+    def stop_loading(self):
+        """ Wait for the loader threads, they stop at shutdown
+            Jobs not loaded yet stay in the queue file.
+        """
+        for thread in self.__loaders:
+            thread.join()
+        self.__loaders = []
+
+    def __load_jobs(self, nzo_ids, start):
+        """ Load the pending jobs and add them to the queue in their order.
+            A few threads read ahead, so disk waits overlap.
+        """
+        todo = Queue.Queue()
+        for nzo_id in nzo_ids:
+            todo.put(nzo_id)
+        cv = self.__load_cv
+
+        def reader():
+            while not _shutting_down():
+                try:
+                    nzo_id = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                if self.__claim(nzo_id):
+                    self.__store(nzo_id, self.__read(nzo_id))
+
+        for i in xrange(min(QUEUE_LOAD_THREADS, len(nzo_ids))):
+            self.__start_loader(reader)
+
+        first = None
+        count = 0
+        for nzo_id in nzo_ids:
+            cv.acquire()
+            while nzo_id not in self.__results and self.__is_pending(nzo_id) and not _shutting_down():
+                cv.wait(1.0)
+            ready = nzo_id in self.__results
+            cv.release()
+            if not ready:
+                if not self.__is_pending(nzo_id):
+                    # Already fetched on demand
+                    continue
+                logging.info('Stopped loading the queue')
+                return
+            if self.__add_loaded(nzo_id):
+                count += 1
+                if first is None:
+                    first = time.time() - start
+        logging.info('Loaded %s jobs in %.2f seconds, first job after %.2f seconds',
+                     count, time.time() - start, first or 0.0)
+
+    def __read(self, nzo_id):
+        """ Read a pending job, return nzo or None """
+        try:
+            return load_job(nzo_id)[1]
+        except:
+            logging.info("Traceback: ", exc_info = True)
+            return None
+
+    def __claim(self, nzo_id):
+        """ Reserve the reading of a pending job, False when it's taken """
+        self.__load_cv.acquire()
+        try:
+            if nzo_id in self.__claimed:
+                return False
+            self.__claimed.add(nzo_id)
+            return True
+        finally:
+            self.__load_cv.release()
+
+    def __store(self, nzo_id, nzo):
+        """ Hand a read job to whoever waits for it """
+        self.__load_cv.acquire()
+        self.__results[nzo_id] = nzo
+        self.__load_cv.notifyAll()
+        self.__load_cv.release()
+
+    def __is_pending(self, nzo_id):
+        for tup in self.__pending:
+            if tup[0] == nzo_id:
+                return True
+        return False
+
+    @synchronized(NZBQUEUE_LOCK)
+    def __add_loaded(self, nzo_id):
+        """ Replace the summary of a pending job by the job read for it,
+            return the job or None
+        """
+        self.__load_cv.acquire()
+        nzo = self.__results.pop(nzo_id, None)
+        self.__load_cv.release()
+        if not self.__is_pending(nzo_id):
+            return None
+        self.__pending = [tup for tup in self.__pending if tup[0] != nzo_id]
+        if nzo and self.add(nzo, save=False, quiet=True) and not cfg.auto_sort():
+            self.__place_loaded(nzo)
+        if not self.__pending:
+            self.__order = {}
+        return nzo
+
+    def __place_loaded(self, nzo):
+        """ Move a job of the queue file back to its place in that file:
+            behind its predecessors, ahead of jobs added since startup
+            unless these have a higher priority
+        """
+        n = self.__order.get(nzo.nzo_id)
+        if n is None or nzo not in self.__nzo_list:
+            return
+        self.__nzo_list.remove(nzo)
+        pos = 0
+        for item in self.__nzo_list:
+            i = self.__order.get(item.nzo_id)
+            if i is None:
+                if item.priority <= nzo.priority:
+                    break
+            elif i > n:
+                break
+            pos += 1
+        self.__nzo_list.insert(pos, nzo)
+        self.reset_try_list()
+
+    def __fetch(self, nzo_id):
+        """ Make sure a job that is still pending is loaded now,
+            so that changes to it are not lost
+        """
+        if not self.__pending:
+            return
+        for tup in self.__pending:
+            if os.path.split(tup[0])[1] == nzo_id:
+                nzo_id = tup[0]
+                break
+        else:
+            return
+        if self.__claim(nzo_id):
+            self.__store(nzo_id, self.__read(nzo_id))
+        else:
+            # A loader is reading it, wait for the result
+            self.__load_cv.acquire()
+            while nzo_id not in self.__results:
+                self.__load_cv.wait(1.0)
+            self.__load_cv.release()
+        self.__add_loaded(nzo_id)
+
     def scan_jobs(self, all=False, action=True):
         """ Scan "incomplete" for mssing folders,
             'all' is True: Include active folders
@@ -176,22 +352,29 @@ class NzbQueue(TryList):
         logging.info("Saving queue")
 
         nzo_ids = []
+        summaries = []
         # Aggregate nzo_ids and save each nzo
         for nzo in self.__nzo_list:
             if nzo.new_caching:
                 nzo_ids.append(os.path.join(nzo.work_name, nzo.nzo_id))
             else:
                 nzo_ids.append(nzo.nzo_id)
+            summaries.append(nzo.gather_summary())
             if save_nzo is None or nzo is save_nzo:
-                sabnzbd.save_data(nzo, nzo.nzo_id, nzo.workpath)
+                nzo.save_snapshot()
                 if not nzo.futuretype:
                     nzo.save_attribs()
+        # Jobs that are still being loaded
+        for nzo_id, summary in self.__pending:
+            nzo_ids.append(nzo_id)
+            summaries.append(summary)
 
-        sabnzbd.save_admin((QUEUE_VERSION, nzo_ids, []), QUEUE_FILE_NAME)
+        sabnzbd.save_admin((QUEUE_VERSION, nzo_ids, summaries), QUEUE_FILE_NAME)
 
     @synchronized(NZBQUEUE_LOCK)
     def set_top_only(self, value):
         self.__top_only = value
+        self.reset_try_list()
 
     @synchronized(NZBQUEUE_LOCK)
     def generate_future(self, msg, pp=None, script=None, cat=None, url=None, priority=NORMAL_PRIORITY, nzbname=None):
@@ -228,6 +411,7 @@ class NzbQueue(TryList):
                 try:
                     future.__init__(filename, msgid, pp, scr, nzb=data, futuretype=False, cat=categ, priority=priority, nzbname=nzbname, nzo_info=nzo_info)
                     future.nzo_id = nzo_id
+                    revisions.bump('queue', nzo_id)
                     self.save(future)
                 except ValueError:
                     self.remove(nzo_id, False)
@@ -254,18 +438,22 @@ class NzbQueue(TryList):
     @synchronized(NZBQUEUE_LOCK)
     def change_opts(self, nzo_ids, pp):
         for nzo_id in [item.strip() for item in nzo_ids.split(',')]:
+            self.__fetch(nzo_id)
             if nzo_id in self.__nzo_table:
                 self.__nzo_table[nzo_id].set_pp(pp)
 
     @synchronized(NZBQUEUE_LOCK)
     def change_script(self, nzo_ids, script):
         for nzo_id in [item.strip() for item in nzo_ids.split(',')]:
+            self.__fetch(nzo_id)
             if nzo_id in self.__nzo_table:
                 self.__nzo_table[nzo_id].script = script
+                revisions.bump('queue', nzo_id)
 
     @synchronized(NZBQUEUE_LOCK)
     def change_cat(self, nzo_ids, cat):
         for nzo_id in [item.strip() for item in nzo_ids.split(',')]:
+            self.__fetch(nzo_id)
             if nzo_id in self.__nzo_table:
                 nzo = self.__nzo_table[nzo_id]
                 nzo.cat, pp, nzo.script, prio = cat_to_opts(cat)
@@ -274,6 +462,7 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def change_name(self, nzo_id, name):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             nzo = self.__nzo_table[nzo_id]
             if not nzo.futuretype:
@@ -281,9 +470,11 @@ class NzbQueue(TryList):
             else:
                 # Reset url fetch wait time
                 nzo.wait = None
+                revisions.bump('queue', nzo_id)
 
     @synchronized(NZBQUEUE_LOCK)
     def get_nzo(self, nzo_id):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             return self.__nzo_table[nzo_id]
         else:
@@ -335,22 +526,30 @@ class NzbQueue(TryList):
                 else:
                     #if the queue is empty then simple append the item to the bottom
                     self.__nzo_list.append(nzo)
+            revisions.bump('queue', nzo.nzo_id)
             if save:
                 self.save(nzo)
 
+            if not quiet:
+                events.post('added', {'nzo_id' : nzo.nzo_id, 'filename' : nzo.final_name_pw_clean})
             if not (quiet or nzo.status in ('Fetching',)):
                 growler.send_notification(T('NZB added to queue'), nzo.filename, 'download')
 
         if cfg.auto_sort():
             self.sort_by_avg_age()
+        wakeup_downloader()
         return nzo.nzo_id
 
     @synchronized(NZBQUEUE_LOCK)
     def remove(self, nzo_id, add_to_history = True, save=True, cleanup=True, keep_basic=False, del_files=False):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             nzo = self.__nzo_table.pop(nzo_id)
             nzo.deleted = True
             self.__nzo_list.remove(nzo)
+            self.reset_try_list()
+            revisions.bump('queue', nzo_id)
+            events.post('removed', {'nzo_id' : nzo_id})
 
             sabnzbd.remove_data(nzo_id, nzo.workpath)
 
@@ -360,7 +559,6 @@ class NzbQueue(TryList):
                 # Add the nzo to the database. Only the path, script and time taken is passed
                 # Other information is obtained from the nzo
                 history_db.add_history_db(nzo, '', '', 0, '', '')
-                history_db.close()
 
             elif cleanup:
                 self.cleanup_nzo(nzo, keep_basic, del_files)
@@ -378,6 +576,8 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def remove_all(self):
+        for nzo_id, summary in self.__pending[:]:
+            self.__fetch(os.path.split(nzo_id)[1])
         lst = []
         for nzo_id in self.__nzo_table:
             lst.append(nzo_id)
@@ -388,16 +588,21 @@ class NzbQueue(TryList):
             sabnzbd.remove_data(nzo_id, nzo.workpath)
             self.cleanup_nzo(nzo)
         del lst
+        self.reset_try_list()
+        revisions.bump('queue')
         self.save()
 
     @synchronized(NZBQUEUE_LOCK)
     def remove_nzf(self, nzo_id, nzf_id):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             nzo = self.__nzo_table[nzo_id]
             nzf = nzo.get_nzf_by_id(nzf_id)
 
             if nzf:
                 post_done = nzo.remove_nzf(nzf)
+                nzo.log_change('remove', nzf_id)
+                nzo.save_journal()
                 if post_done:
                     keep_basic = nzo.finished_files
                     if keep_basic:
@@ -412,6 +617,7 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def pause_nzo(self, nzo_id):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             nzo = self.__nzo_table[nzo_id]
             nzo.pause()
@@ -424,15 +630,19 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def resume_nzo(self, nzo_id):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             nzo = self.__nzo_table[nzo_id]
             nzo.resume()
             nzo.reset_all_try_lists()
             logging.debug("Resumed nzo: %s", nzo_id)
         self.reset_try_list()
+        wakeup_downloader()
 
     @synchronized(NZBQUEUE_LOCK)
     def switch(self, item_id_1, item_id_2):
+        self.__fetch(item_id_1)
+        self.__fetch(item_id_2)
         try:
             # Allow an index as second parameter, easier for some skins
             i = int(item_id_2)
@@ -472,6 +682,12 @@ class NzbQueue(TryList):
                 item = self.__nzo_list[item_id_pos1]
                 del self.__nzo_list[item_id_pos1]
                 self.__nzo_list.insert(item_id_pos2, item)
+                self.reset_try_list()
+                revisions.bump('queue', item_id_1)
+                nzo1.log_change('priority', nzo1.priority)
+                nzo1.save_journal()
+                # Save with invalid nzo_id, so that only queue file is saved
+                self.save('x')
                 return (item_id_pos2, nzo1.priority)
         # If moving failed/no movement took place
         return (-1, nzo1.priority)
@@ -485,38 +701,52 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def move_up_bulk(self, nzo_id, nzf_ids):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             self.__nzo_table[nzo_id].move_up_bulk(nzf_ids)
+            self.__nzo_table[nzo_id].log_order()
 
     @synchronized(NZBQUEUE_LOCK)
     def move_top_bulk(self, nzo_id, nzf_ids):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             self.__nzo_table[nzo_id].move_top_bulk(nzf_ids)
+            self.__nzo_table[nzo_id].log_order()
 
     @synchronized(NZBQUEUE_LOCK)
     def move_down_bulk(self, nzo_id, nzf_ids):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             self.__nzo_table[nzo_id].move_down_bulk(nzf_ids)
+            self.__nzo_table[nzo_id].log_order()
 
     @synchronized(NZBQUEUE_LOCK)
     def move_bottom_bulk(self, nzo_id, nzf_ids):
+        self.__fetch(nzo_id)
         if nzo_id in self.__nzo_table:
             self.__nzo_table[nzo_id].move_bottom_bulk(nzf_ids)
+            self.__nzo_table[nzo_id].log_order()
 
     @synchronized(NZBQUEUE_LOCK)
     def sort_by_avg_age(self, reverse=False):
         logging.info("Sorting by average date...(reversed:%s)", reverse)
         self.__nzo_list = sort_queue_function(self.__nzo_list, _nzo_date_cmp, reverse)
+        self.reset_try_list()
+        revisions.bump('queue')
 
     @synchronized(NZBQUEUE_LOCK)
     def sort_by_name(self, reverse=False):
         logging.info("Sorting by name...(reversed:%s)", reverse)
         self.__nzo_list = sort_queue_function(self.__nzo_list, _nzo_name_cmp, reverse)
+        self.reset_try_list()
+        revisions.bump('queue')
 
     @synchronized(NZBQUEUE_LOCK)
     def sort_by_size(self, reverse=False):
         logging.info("Sorting by size...(reversed:%s)", reverse)
         self.__nzo_list = sort_queue_function(self.__nzo_list, _nzo_size_cmp, reverse)
+        self.reset_try_list()
+        revisions.bump('queue')
 
 
     @synchronized(NZBQUEUE_LOCK)
@@ -536,11 +766,14 @@ class NzbQueue(TryList):
             self.sort_by_avg_age(reverse)
         else:
             logging.debug("Sort: %s not recognised", field)
+            return
+        self.save('x')
 
     def __set_priority(self, nzo_id, priority):
         """ Sets the priority on the nzo and places it in the queue at the approrioate position """
         try:
             priority = int(priority)
+            self.__fetch(nzo_id)
             nzo = self.__nzo_table[nzo_id]
             nzo_id_pos1 = -1
             pos = -1
@@ -561,10 +794,14 @@ class NzbQueue(TryList):
                 return nzo_id_pos1
 
             nzo.priority = priority
+            revisions.bump('queue', nzo_id)
             nzo.save_attribs()
+            nzo.log_change('priority', priority)
+            nzo.save_journal()
 
             if nzo_id_pos1 != -1:
                 del self.__nzo_list[nzo_id_pos1]
+                self.reset_try_list()
                 if priority == TOP_PRIORITY:
                     #A top priority item (usually a completed download fetching pars)
                     #is added to the top of the queue
@@ -608,6 +845,7 @@ class NzbQueue(TryList):
             n = -1
             for nzo_id in [item.strip() for item in nzo_ids.split(',')]:
                 n = self.__set_priority(nzo_id, priority)
+            self.save('x')
             return n
         except:
             return -1
@@ -622,9 +860,16 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def reset_all_try_lists(self):
-        for nzo in self.__nzo_list:
-            nzo.reset_all_try_lists()
-        self.reset_try_list()
+        # Starting a new epoch clears every try list in the queue
+        trylist.new_epoch()
+
+    def reset_try_list(self):
+        """ Clear the list of visited servers, to be called after
+            any change of the order or the state of the jobs
+        """
+        self.__ready_pos = {}
+        self.__ready_epoch = trylist.current_epoch()
+        TryList.reset_try_list(self)
 
 
     @synchronized(NZBQUEUE_LOCK)
@@ -660,12 +905,24 @@ class NzbQueue(TryList):
                             return article
 
         else:
-            for nzo in self.__nzo_list:
+            # Jobs before the position of this server have nothing for it,
+            # until a reset of a try list or a change of the job list
+            if self.__ready_epoch != trylist.current_epoch():
+                # All try lists were reset
+                self.__ready_pos = {}
+                self.__ready_epoch = trylist.current_epoch()
+            nzo_list = self.__nzo_list
+            pos = self.__ready_pos.get(server, 0)
+            while pos < len(nzo_list):
+                nzo = nzo_list[pos]
                 # Don't try to get an article if server is in try_list of nzo
                 if not nzo.server_in_try_list(server) and nzo.status not in (Status.PAUSED, Status.GRABBING):
                     article = nzo.get_article(server)
                     if article:
+                        self.__ready_pos[server] = pos
                         return article
+                pos += 1
+            self.__ready_pos[server] = pos
 
             # No articles for this server, block server (until reset issued)
             self.add_to_try_list(server)
@@ -679,21 +936,34 @@ class NzbQueue(TryList):
             logging.debug("Discarding article %s, no longer in queue", article.article)
             return
 
+        direct = nzf.write_direct()
         file_done, post_done, reset = nzo.remove_article(article, found)
+        nzo.log_article(article, found)
+        if events.due('progress'):
+            events.post('progress', {'nzo_id' : nzo.nzo_id,
+                                     'mbleft' : '%.2f' % (nzo.remaining() / MEBI),
+                                     'mb' : '%.2f' % (nzo.bytes / MEBI)})
 
         filename = nzf.filename
 
         if reset:
             self.reset_try_list()
 
+        if not (file_done or nzo.precheck or nzf.deleted or direct) and filename and nzf.type:
+            # Write the article to disk as soon as it is contiguous
+            Assembler.do.stream(nzo, nzf, article)
+
         if file_done:
-            if nzo.next_save is None or time.time() > nzo.next_save:
-                sabnzbd.save_data(nzo, nzo.nzo_id, nzo.workpath)
-                BPSMeter.do.save()
-                if nzo.save_timeout is None:
-                    nzo.next_save = None
-                else:
-                    nzo.next_save = time.time() + nzo.save_timeout
+            if nzo.precheck or not (filename and nzf.type):
+                # Not assembled, so nothing to wait for
+                nzo.journal.release(nzf.nzf_id)
+            # Only the changes are written, the whole job just
+            # once the journal has outgrown the last snapshot
+            nzo.log_change('bytes', nzo.bytes_downloaded)
+            nzo.save_journal()
+            if nzo.journal.size > max(JOURNAL_MIN_SIZE, nzo.journal.snapshot_size):
+                nzo.save_snapshot()
+            BPSMeter.do.save()
 
             if not nzo.precheck:
                 _type = nzf.type
@@ -751,6 +1021,19 @@ class NzbQueue(TryList):
             n += 1
             if max_jobs and n >= max_jobs:
                 break
+        # Jobs that are still being loaded, as far as known
+        for nzo_id, pnfo in self.__pending:
+            if not pnfo or (max_jobs and n >= max_jobs):
+                continue
+            if for_cli:
+                pnfo = list(pnfo)
+                pnfo[PNFO_AVG_DATE_FIELD] = time.mktime(pnfo[PNFO_AVG_DATE_FIELD].timetuple())
+                pnfo = tuple(pnfo)
+            if pnfo[PNFO_STATUS_FIELD] != 'Paused':
+                bytes += pnfo[PNFO_BYTES_FIELD]
+                bytes_left += pnfo[PNFO_BYTES_LEFT_FIELD]
+            pnfo_list.append(pnfo)
+            n += 1
         return (bytes, bytes_left, pnfo_list)
 
 
@@ -776,6 +1059,7 @@ class NzbQueue(TryList):
 
     @synchronized(NZBQUEUE_LOCK)
     def cleanup_nzo(self, nzo, keep_basic=False, del_files=False):
+        ArticleCache.do.close_parts(nzo)
         nzo.purge_data(keep_basic, del_files)
 
         ArticleCache.do.purge_articles(nzo.saved_articles)
@@ -806,6 +1090,24 @@ class NzbQueue(TryList):
 
 #-------------------------------------------------------------------------------
 
+def load_job(nzo_id):
+    """ Load job 'nzo_id' of the queue file, return (folder, nzo) """
+    folder, _id = os.path.split(nzo_id)
+    # Try as normal job
+    path = get_admin_path(bool(folder), folder, False)
+    nzo = sabnzbd.load_data(_id, path, remove=False)
+    if not nzo:
+        # Try as future job
+        path = get_admin_path(bool(folder), folder, True)
+        nzo = sabnzbd.load_data(_id, path)
+    if nzo and nzo.replay_journal():
+        # Fold the changes into a new snapshot
+        nzo.save_snapshot()
+    return folder, nzo
+
+def _shutting_down():
+    return sabnzbd.__SHUTTING_DOWN__
+
 def _nzo_date_cmp(nzo1, nzo2):
     avg_date1 = nzo1.avg_date
     avg_date2 = nzo2.avg_date
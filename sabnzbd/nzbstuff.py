@@ -24,26 +24,28 @@ import time
 import re
 import logging
 import datetime
-import xml.sax
-import xml.sax.handler
-import xml.sax.xmlreader
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import weakref
+import xml.parsers.expat
+from threading import Lock
 
 # SABnzbd modules
 import sabnzbd
-from sabnzbd.constants import sample_match, GIGI, ATTRIB_FILE, JOB_ADMIN, \
+from sabnzbd.constants import sample_match, ATTRIB_FILE, JOB_ADMIN, \
                               DEFAULT_PRIORITY, LOW_PRIORITY, NORMAL_PRIORITY, \
                               HIGH_PRIORITY, PAUSED_PRIORITY, TOP_PRIORITY, DUP_PRIORITY, \
-                              Status
+                              NZB_PARSE_CHUNK, NZF_PRELOAD_ARTICLES, SEGMENT_INDEX_FILE, \
+                              JOURNAL_FILE, Status
 from sabnzbd.misc import to_units, cat_to_opts, cat_convert, sanitize_foldername, \
                          get_unique_path, get_admin_path, remove_all, format_source_url, \
                          sanitize_filename, globber, sanitize_foldername, int_conv, \
                          set_permissions
 import sabnzbd.cfg as cfg
-from sabnzbd.trylist import TryList
+from sabnzbd.trylist import TryList, SlotTryList, current_epoch
+from sabnzbd.segmentindex import SegmentIndex, load_segments
+from sabnzbd.journal import Journal, JOURNAL_LOCK
+from sabnzbd.decorators import synchronized
+import sabnzbd.revisions as revisions
+import sabnzbd.events as events
 from sabnzbd.encoding import unicoder, platform_encode, latin1, name_fixer
 
 __all__ = ['Article', 'NzbFile', 'NzbObject']
@@ -65,14 +67,21 @@ ArticleMapper = (
     ('art_id',    'art_id'),
     ('bytes',     'bytes'),
     ('partnum',   'partnum'),
-    ('nzf',       'nzf')
+    ('nzf',       'nzf'),
+    ('offset',    'offset')
 )
 
-class Article(TryList):
+class Article(SlotTryList):
     """ Representation of one article
+        Huge NZB files have millions of these, so the attributes
+        are kept in slots instead of a per-object dictionary.
     """
-    def __init__ (self, article, bytes, partnum, nzf):
-        TryList.__init__(self)
+    __slots__ = ('fetcher', 'allow_fill_server', 'article', 'art_id', 'bytes',
+                 'partnum', 'tries', 'nzf', 'offset')
+
+    def __init__ (self, article=None, bytes=None, partnum=None, nzf=None):
+        # The defaults are needed to unpickle queues of older releases
+        SlotTryList.__init__(self)
 
         self.fetcher = None
         self.allow_fill_server = False
@@ -83,6 +92,7 @@ class Article(TryList):
         self.partnum = partnum
         self.tries = 0 # Try count
         self.nzf = nzf
+        self.offset = None # Position of the decoded data in the file
 
     def get_article(self, server):
         """ Return article when appropriate for specified server """
@@ -103,21 +113,23 @@ class Article(TryList):
         return self.art_id
 
     def __getstate__(self):
-        """ Save to pickle file, translating attributes """
-        dict_ = {}
-        for tup in ArticleMapper:
-            dict_[tup[0]] = self.__dict__[tup[1]]
-        return dict_
+        """ Save to pickle file, as a tuple in the order of ArticleMapper """
+        return tuple([getattr(self, tup[1]) for tup in ArticleMapper])
 
-    def __setstate__(self, dict_):
+    def __setstate__(self, state):
         """ Load from pickle file, translating attributes """
-        for tup in ArticleMapper:
-            try:
-                self.__dict__[tup[1]] = dict_[tup[0]]
-            except KeyError:
-                # Handle new attributes
-                self.__dict__[tup[1]] = None
-        TryList.__init__(self)
+        if isinstance(state, dict):
+            # Queues of older releases store a dictionary
+            for tup in ArticleMapper:
+                setattr(self, tup[1], state.get(tup[0]))
+        else:
+            for n in xrange(len(ArticleMapper)):
+                try:
+                    setattr(self, ArticleMapper[n][1], state[n])
+                except IndexError:
+                    # Handle new attributes
+                    setattr(self, ArticleMapper[n][1], None)
+        SlotTryList.__init__(self)
         self.fetcher = None
         self.allow_fill_server = False
         self.tries = 0
@@ -130,6 +142,26 @@ class Article(TryList):
 ################################################################################
 # NzbFile                                                                      #
 ################################################################################
+# Files that keep their articles in memory until finish_import,
+# all jobs together stay within NZF_PRELOAD_ARTICLES
+_PRELOADED = weakref.WeakKeyDictionary()
+_PRELOAD_LOCK = Lock()
+
+def _preload(nzf, article_db):
+    """ Keep article_db in nzf when the shared budget allows it """
+    _PRELOAD_LOCK.acquire()
+    try:
+        for other in _PRELOADED.keys():
+            if other.article_db is None:
+                del _PRELOADED[other]
+        if sum(_PRELOADED.values()) + len(article_db) > NZF_PRELOAD_ARTICLES:
+            return False
+        nzf.article_db = article_db
+        _PRELOADED[nzf] = len(article_db)
+        return True
+    finally:
+        _PRELOAD_LOCK.release()
+
 NzbFileMapper = (
     # Pickle name                    Internal name
     ('_NzbFile__date',               'date'),
@@ -154,16 +186,31 @@ NzbFileMapper = (
     ('import_finished',              'import_finished'),
     ('md5sum',                       'md5sum'),
     ('valid',                        'valid'),
+    ('part_id',                      'part_id'),
+    ('parts_done',                   'parts_done'),
+    ('file_size',                    'file_size'),
+    ('assembled',                    'assembled'),
+    ('assembled_size',               'assembled_size'),
+    ('seg_offset',                   'seg_offset'),
+    ('direct',                       'direct'),
 )
 
 
 class NzbFile(TryList):
     """ Representation of one file consisting of multiple articles
     """
-    def __init__(self, date, subject, article_db, bytes, nzo):
-        """ Setup object """
+    def __init__(self, date, subject, article_db, bytes, nzo, index=None):
+        """ Setup object
+            article_db is stored in the segment index of the job.
+            While the preload budget allows, it is also kept in memory
+            until finish_import, so that it needs no disk read.
+        """
         TryList.__init__(self)
 
+        # Per server: index in self.articles before which nothing is available
+        self.ready_pos = {}
+        self.ready_epoch = current_epoch()
+
         self.date = date
         self.subject = subject
         self.filename = None
@@ -189,7 +236,7 @@ class NzbFile(TryList):
         self.article_count = 0
 
         self.nzo = nzo
-        self.nzf_id = sabnzbd.get_new_id("nzf", nzo.workpath)
+        self.nzf_id = nzo.new_nzf_id()
         self.deleted = False
 
         self.valid = False
@@ -197,16 +244,37 @@ class NzbFile(TryList):
 
         self.md5sum = None
 
+        # File written in place when using direct_write
+        self.part_id = None
+        self.parts_done = None  # Bitmap of the written partnums
+        self.direct = None      # Written in place, fixed by the first written article
+        self.file_size = None
+        # Progress of the assembler, in sorted partnums and bytes
+        self.assembled = None
+        self.assembled_size = None
+
         self.valid = bool(article_db)
+        self.article_db = None
+        # Position in the segment index, None for files of older
+        # releases, which have their own SABnzbd_nzf_<id> file
+        self.seg_offset = None
 
-        if self.valid and self.nzf_id:
-            sabnzbd.save_data(article_db, self.nzf_id, nzo.workpath)
+        if self.valid and index:
+            self.seg_offset = index.append(article_db)
+            _preload(self, article_db)
 
     def finish_import(self):
-        """ Load the article objects from disk """
+        """ Create the article objects, from memory or from disk """
         logging.debug("Finishing import on %s", self.subject)
 
-        article_db = sabnzbd.load_data(self.nzf_id, self.nzo.workpath, remove=False)
+        article_db = self.article_db
+        self.article_db = None
+        if article_db:
+            pass
+        elif self.seg_offset is not None:
+            article_db = load_segments(self.nzo.workpath, self.seg_offset)
+        else:
+            article_db = sabnzbd.load_data(self.nzf_id, self.nzo.workpath, remove=False)
         if article_db:
             for partnum in article_db:
                 art_id = article_db[partnum][0]
@@ -223,10 +291,18 @@ class NzbFile(TryList):
 
     def remove_article(self, article, found):
         """ Handle completed article, possibly end of file """
-        if article in self.articles:
-            self.articles.remove(article)
+        try:
+            pos = self.articles.index(article)
+        except ValueError:
+            pos = None
+        if pos is not None:
+            del self.articles[pos]
             if found:
                 self.bytes_left -= article.bytes
+            # Keep the scan positions on the same articles
+            for server, ready in self.ready_pos.items():
+                if ready > pos:
+                    self.ready_pos[server] = ready - 1
 
         reset = False
         if article.partnum == self.lowest_partnum and self.articles:
@@ -256,13 +332,35 @@ class NzbFile(TryList):
                 return article
 
         else:
-            for article in self.articles:
-                article = article.get_article(server)
+            # Articles before the position of this server are either in
+            # progress or were tried already. They only become available
+            # again through a reset of the try list.
+            if self.ready_epoch != current_epoch():
+                # All try lists were reset
+                self.ready_pos = {}
+                self.ready_epoch = current_epoch()
+            articles = self.articles
+            pos = self.ready_pos.get(server, 0)
+            while pos < len(articles):
+                article = articles[pos].get_article(server)
+                pos += 1
                 if article:
+                    self.ready_pos[server] = pos
                     return article
+            self.ready_pos[server] = pos
 
         self.add_to_try_list(server)
 
+    def reset_try_list(self):
+        """ Clear the list of visited servers, articles may be available again,
+            so also in the job
+        """
+        self.ready_pos = {}
+        self.ready_epoch = current_epoch()
+        TryList.reset_try_list(self)
+        if self.nzo:
+            self.nzo.reset_try_list()
+
     def reset_all_try_lists(self):
         """ Clear all lists of visited servers """
         for art in self.articles:
@@ -279,12 +377,45 @@ class NzbFile(TryList):
         """ Get lowest article number of this file """
         return min(self.decodetable)
 
+    def get_part_id(self):
+        """ Return storage name of the file that is being assembled, create if needed """
+        if not self.part_id:
+            self.part_id = sabnzbd.get_new_id("part", self.nzo.workpath)
+        return self.part_id
+
+    def write_direct(self):
+        """ Is the file written in place? Decided once, when its first
+            article is written, so that one file never mixes both layouts
+        """
+        if self.direct is None and self.type:
+            self.direct = bool(cfg.direct_write() and self.type == 'yenc')
+        return bool(self.direct)
+
+    def set_part_done(self, partnum):
+        """ Mark article 'partnum' as written to the part file """
+        if self.parts_done is None:
+            self.parts_done = bytearray()
+        pos = partnum >> 3
+        if pos >= len(self.parts_done):
+            self.parts_done.extend(bytearray(pos + 1 - len(self.parts_done)))
+        self.parts_done[pos] |= 1 << (partnum & 7)
+
+    def part_done(self, partnum):
+        """ Is article 'partnum' already in the part file? """
+        pos = partnum >> 3
+        if self.parts_done is None or pos >= len(self.parts_done):
+            return False
+        return bool(self.parts_done[pos] & (1 << (partnum & 7)))
+
     def remove_admin(self):
-        """ Remove article database from disk (sabnzbd_nzf_<id>)"""
-        try:
-            os.remove(os.path.join(self.nzo.workpath, self.nzf_id))
-        except:
-            pass
+        """ Remove article database from disk (sabnzbd_nzf_<id>)
+            Only files of older releases have one.
+        """
+        if self.seg_offset is None:
+            try:
+                os.remove(os.path.join(self.nzo.workpath, self.nzf_id))
+            except:
+                pass
 
     def __getstate__(self):
         """ Save to pickle file, translating attributes """
@@ -302,6 +433,9 @@ class NzbFile(TryList):
                 # Handle new attributes
                 self.__dict__[tup[1]] = None
         TryList.__init__(self)
+        self.ready_pos = {}
+        self.ready_epoch = current_epoch()
+        self.article_db = None
 
     def __repr__(self):
         return "<NzbFile: filename=%s, type=%s>" % (self.filename, self.type)
@@ -310,8 +444,10 @@ class NzbFile(TryList):
 ################################################################################
 # NzbParser                                                                    #
 ################################################################################
-class NzbParser(xml.sax.handler.ContentHandler):
-    """ Forgiving parser for NZB's """
+class NzbParser(object):
+    """ Forgiving parser for NZB's, driven directly by expat
+        Each file is added to the job as soon as its </file> is seen.
+    """
     def __init__ (self, nzo, remove_samples=False):
         self.nzo = nzo
         assert isinstance(self.nzo, NzbObject)
@@ -329,9 +465,29 @@ class NzbParser(xml.sax.handler.ContentHandler):
         self.groups = []
         self.filter = remove_samples
         self.now = time.time()
+        self.index = None
 
-    def startDocument(self):
-        pass
+    def parse(self, data):
+        """ Parse NZB text, raises xml.parsers.expat.ExpatError on bad XML
+            No handler for external entities is set, so a DTD
+            referred to by the NZB is never fetched.
+        """
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        self.index = SegmentIndex(self.nzo.workpath)
+        try:
+            # Feed in chunks, so the first files are done without
+            # expat having to take in the whole text first
+            for n in xrange(0, len(data), NZB_PARSE_CHUNK):
+                parser.Parse(data[n:n + NZB_PARSE_CHUNK], False)
+            parser.Parse('', True)
+        finally:
+            # Files parsed before an error are kept, so always complete the index
+            self.index.close()
+        self.endDocument()
 
     def startElement(self, name, attrs):
         if name == 'segment' and self.in_nzb and self.in_file and self.in_segments:
@@ -381,14 +537,15 @@ class NzbParser(xml.sax.handler.ContentHandler):
             self.in_nzb = True
 
     def characters (self, content):
-        if self.in_group:
-            self.group_name.append(content)
-        elif self.in_segment:
+        if self.in_segment:
             self.article_id.append(content)
+        elif self.in_group:
+            self.group_name.append(content)
 
     def endElement(self, name):
         if name == 'group' and self.in_group:
-            group = str(''.join(self.group_name))
+            # Many files share a few groups, keep one copy of each name
+            group = intern(str(''.join(self.group_name)))
             if group not in self.groups:
                 self.groups.append(group)
             self.in_group = False
@@ -424,7 +581,8 @@ class NzbParser(xml.sax.handler.ContentHandler):
             except:
                 tm = datetime.datetime.fromtimestamp(self.now)
                 self.file_date = self.now
-            nzf = NzbFile(tm, self.filename, self.article_db, self.file_bytes, self.nzo)
+            nzf = NzbFile(tm, self.filename, self.article_db, self.file_bytes, self.nzo,
+                          self.index)
             if nzf.valid and nzf.nzf_id:
                 logging.info('File %s added to queue', self.filename)
                 self.nzo.files.append(nzf)
@@ -435,8 +593,6 @@ class NzbParser(xml.sax.handler.ContentHandler):
                 self.nzf_list.append(nzf)
             else:
                 logging.info('Error importing %s, skipping', self.filename)
-                if nzf.nzf_id:
-                    sabnzbd.remove_data(nzf.nzf_id, self.nzo.workpath)
                 self.skipped_files += 1
 
         elif name == 'nzb':
@@ -504,7 +660,8 @@ NzbObjectMapper = (
     ('oversized',                    'oversized'),     # Was detected as oversized
     ('create_group_folder',          'create_group_folder'),
     ('precheck',                     'precheck'),
-    ('incomplete',                   'incomplete')     # Was detected as incomplete
+    ('incomplete',                   'incomplete'),    # Was detected as incomplete
+    ('journal_gen',                  'journal_gen')    # Generation of this snapshot
 )
 
 class NzbObject(TryList):
@@ -580,7 +737,7 @@ class NzbObject(TryList):
 
         self.dupe_table = {}
 
-        self.saved_articles = []
+        self.saved_articles = set()
 
         self.nzo_id = None
 
@@ -618,6 +775,12 @@ class NzbObject(TryList):
         self.encrypted = 0
         self.wait = None
         self.pp_active = False  # Signals active post-processing (not saved)
+        self.journal_gen = 0
+        self.journal = Journal()  # Changes since the last save (not saved)
+        self.info_cache = {}      # Cached file lists for gather_info (not saved)
+        # Per server: index in self.files before which nothing is available
+        self.ready_pos = {}
+        self.ready_epoch = current_epoch()
 
         self.create_group_folder = cfg.create_group_folders()
 
@@ -647,7 +810,10 @@ class NzbObject(TryList):
 
         if reuse:
             remove_all(adir, 'SABnzbd_nz?_*')
+            sabnzbd.remove_data(SEGMENT_INDEX_FILE, adir)
+            sabnzbd.remove_data(JOURNAL_FILE, adir)
             remove_all(adir, 'SABnzbd_article_*')
+            remove_all(adir, 'SABnzbd_part_*')
         else:
             wdir = get_unique_path(wdir, create_dir=True)
             set_permissions(wdir)
@@ -658,30 +824,23 @@ class NzbObject(TryList):
         dummy, self.work_name = os.path.split(wdir)
         self.created = True
 
-        # Must create a lower level XML parser because we must
-        # disable the reading of the DTD file from newzbin.com
-        # by setting "feature_external_ges" to 0.
+        # The parser must not read the DTD file from newzbin.com,
+        # expat skips external entities unless asked for them.
 
         if nzb and '<nzb' in nzb:
             if 'A&A)' in nzb:
                 # Fix needed to compensate for some dumb NZB posters
                 nzb = nzb.replace('A&A)', 'A&amp;A)')
             handler = NzbParser(self, cfg.ignore_samples() == 2 and not reuse)
-            parser = xml.sax.make_parser()
-            parser.setFeature(xml.sax.handler.feature_external_ges, 0)
-            parser.setContentHandler(handler)
-            parser.setErrorHandler(xml.sax.handler.ErrorHandler())
-            inpsrc = xml.sax.xmlreader.InputSource()
-            inpsrc.setByteStream(StringIO(nzb))
             try:
-                parser.parse(inpsrc)
-            except xml.sax.SAXParseException, err:
+                handler.parse(nzb)
+            except xml.parsers.expat.ExpatError, err:
                 self.incomplete = True
                 if '</nzb>' not in nzb:
                     logging.warning(Ta('Incomplete NZB file %s'), filename)
                 else:
                     logging.warning(Ta('Invalid NZB file %s, skipping (reason=%s, line=%s)'),
-                                    filename, err.getMessage(), err.getLineNumber())
+                                    filename, xml.parsers.expat.ErrorString(err.code), err.lineno)
             except Exception, err:
                 self.incomplete = True
                 logging.warning(Ta('Invalid NZB file %s, skipping (reason=%s, line=%s)'), filename, err, 0)
@@ -782,9 +941,6 @@ class NzbObject(TryList):
         else:
             self.files.sort(cmp=nzf_cmp_name)
 
-        # Set nzo save-delay to 6 sec per GB with a max of 5 min
-        self.save_timeout = min(6.0 * float(self.bytes) / GIGI, 300.0)
-
 
     def check_for_dupe(self, nzf):
         filename = nzf.filename
@@ -809,9 +965,12 @@ class NzbObject(TryList):
     def remove_nzf(self, nzf):
         if nzf in self.files:
             self.files.remove(nzf)
+            self.reset_ready()
             self.finished_files.append(nzf)
             nzf.import_finished = True
+            nzf.article_db = None
             nzf.deleted = True
+            self.files_changed()
         return not bool(self.files)
 
     def reset_all_try_lists(self):
@@ -819,6 +978,22 @@ class NzbObject(TryList):
             nzf.reset_all_try_lists()
         self.reset_try_list()
 
+    def reset_try_list(self):
+        """ Clear the list of visited servers, files may be available again,
+            so also in the queue
+        """
+        self.reset_ready()
+        TryList.reset_try_list(self)
+        if sabnzbd.NzbQueue.do:
+            sabnzbd.NzbQueue.do.reset_try_list()
+
+    def reset_ready(self):
+        """ Forget the scan positions, to be called after any change of
+            the order of self.files
+        """
+        self.ready_pos = {}
+        self.ready_epoch = current_epoch()
+
     def postpone_pars(self, nzf, parset):
         """ Move all vol-par files matching 'parset' to the extrapars table """
         self.partable[parset] = nzf
@@ -835,6 +1010,8 @@ class NzbObject(TryList):
                     xnzf.set_par2(parset, vol, block)
                     self.extrapars[parset].append(xnzf)
                     self.files.remove(xnzf)
+        self.reset_ready()
+        self.files_changed()
 
     def handle_par2(self, nzf, file_done):
         """ Check if file is a par2 and build up par2 collection
@@ -859,6 +1036,7 @@ class NzbObject(TryList):
                         and self.partable[head] in self.files:
                             self.partable[head].reset_try_list()
                             self.files.remove(self.partable[head])
+                            self.reset_ready()
                             self.extrapars[head].append(self.partable[head])
                             self.partable[head] = nzf
 
@@ -866,7 +1044,9 @@ class NzbObject(TryList):
                         ## or initialparfile is already decoded
                         else:
                             if file_done:
-                                if nzf in self.files: self.files.remove(nzf)
+                                if nzf in self.files:
+                                    self.files.remove(nzf)
+                                    self.reset_ready()
                                 if nzf not in self.extrapars[head]: self.extrapars[head].append(nzf)
                             else:
                                 nzf.reset_try_list()
@@ -896,6 +1076,7 @@ class NzbObject(TryList):
 
         if file_done:
             self.handle_par2(nzf, file_done)
+        self.files_changed()
 
         post_done = False
         if not self.files:
@@ -948,6 +1129,7 @@ class NzbObject(TryList):
         except:
             logging.debug('Bad NZB handling')
             logging.info("Traceback: ", exc_info = True)
+        self.files_changed()
 
     @property
     def pp(self):
@@ -958,6 +1140,7 @@ class NzbObject(TryList):
 
     def set_pp(self, value):
         self.repair, self.unpack, self.delete = sabnzbd.pp_to_opts(value)
+        revisions.bump('queue', self.nzo_id)
 
     @property
     def final_name_pw(self):
@@ -990,16 +1173,21 @@ class NzbObject(TryList):
         if isinstance(name, str):
             name, self.password = scan_password(platform_encode(name))
             self.final_name = sanitize_foldername(name)
+            revisions.bump('queue', self.nzo_id)
             self.save_attribs()
 
     def pause(self):
         self.status = 'Paused'
+        revisions.bump('queue', self.nzo_id)
         # Prevent loss of paused state when terminated
-        if self.nzo_id:
-            sabnzbd.save_data(self, self.nzo_id, self.workpath)
+        self.log_change('status', self.status)
+        self.save_journal()
 
     def resume(self):
         self.status = Status.QUEUED
+        revisions.bump('queue', self.nzo_id)
+        self.log_change('status', self.status)
+        self.save_journal()
         if self.encrypted:
             # If user resumes after encryption warning, no more auto-pauses
             self.encrypted = 2
@@ -1011,8 +1199,10 @@ class NzbObject(TryList):
     def add_parfile(self, parfile):
         if parfile not in self.files:
             self.files.append(parfile)
+            self.reset_ready()
         if parfile.extrapars and parfile in parfile.extrapars:
             parfile.extrapars.remove(parfile)
+        self.files_changed()
 
     def remove_parset(self, setname):
         self.partable.pop(setname)
@@ -1087,7 +1277,15 @@ class NzbObject(TryList):
         article = None
         nzf_remove_list = []
 
-        for nzf in self.files:
+        # Files before the position of this server have nothing for it,
+        # until a reset of a try list or a change of self.files
+        if self.ready_epoch != current_epoch():
+            # All try lists were reset
+            self.reset_ready()
+        files = self.files
+        pos = self.ready_pos.get(server, 0)
+        while pos < len(files):
+            nzf = files[pos]
             assert isinstance(nzf, NzbFile)
             if nzf.deleted:
                 logging.debug('Skipping existing file %s', nzf.filename or nzf.subject)
@@ -1103,19 +1301,26 @@ class NzbObject(TryList):
                             if not nzf.import_finished:
                                 logging.error(Ta('Error importing %s'), nzf)
                                 nzf_remove_list.append(nzf)
+                                pos += 1
                                 continue
                         else:
+                            pos += 1
                             continue
 
                     article = nzf.get_article(server)
                     if article:
                         break
+            pos += 1
+        self.ready_pos[server] = pos
 
         # Remove all files for which admin could not be read
         for nzf in nzf_remove_list:
             nzf.deleted = True
             nzf.completed = True
             self.files.remove(nzf)
+        if nzf_remove_list:
+            self.reset_ready()
+            self.files_changed()
         # If cleanup emptied the active files list, end this job
         if nzf_remove_list and not self.files:
             sabnzbd.NzbQueue.do.end_job(self)
@@ -1172,6 +1377,8 @@ class NzbObject(TryList):
                     if tmp_nzf.nzf_id not in nzf_ids:
                         self.files[pos-1] = nzf
                         self.files[pos] = tmp_nzf
+            self.reset_ready()
+            self.files_changed()
 
     def move_down_bulk(self, nzf_ids, cleanup = True):
         if cleanup:
@@ -1188,6 +1395,8 @@ class NzbObject(TryList):
                     if tmp_nzf.nzf_id not in nzf_ids:
                         self.files[pos+1] = nzf
                         self.files[pos] = tmp_nzf
+            self.reset_ready()
+            self.files_changed()
 
     ## end nzo.Mutators #######################################################
     ###########################################################################
@@ -1212,19 +1421,22 @@ class NzbObject(TryList):
         """ Remove all admin info, 'keep_basic' preserves attribs and nzb """
         wpath = self.workpath
         for nzf in self.files:
-            sabnzbd.remove_data(nzf.nzf_id, wpath)
+            nzf.remove_admin()
 
         for _set in self.extrapars:
             for nzf in self.extrapars[_set]:
-                sabnzbd.remove_data(nzf.nzf_id, wpath)
+                nzf.remove_admin()
 
         for nzf in self.finished_files:
-            sabnzbd.remove_data(nzf.nzf_id, wpath)
+            nzf.remove_admin()
+        sabnzbd.remove_data(SEGMENT_INDEX_FILE, wpath)
 
         if self.new_caching and not self.futuretype:
             if keep_basic:
                 remove_all(wpath, 'SABnzbd_nz?_*')
+                sabnzbd.remove_data(JOURNAL_FILE, wpath)
                 remove_all(wpath, 'SABnzbd_article_*')
+                remove_all(wpath, 'SABnzbd_part_*')
             else:
                 remove_all(wpath, recursive=True)
             if del_files:
@@ -1235,14 +1447,35 @@ class NzbObject(TryList):
                 except:
                     pass
 
+    def files_changed(self):
+        """ Drop the cached file information, to be called after
+            any change of the file lists or of their progress
+        """
+        self.info_cache = {}
+        if self.nzo_id:
+            revisions.bump('queue', self.nzo_id)
+
     def remaining(self):
         """ Return remaining bytes """
+        try:
+            return self.info_cache['remaining']
+        except KeyError:
+            pass
         bytes_left = 0
         for nzf in self.files:
             bytes_left += nzf.bytes_left
+        self.info_cache['remaining'] = bytes_left
         return bytes_left
 
-    def gather_info(self, for_cli = False):
+    def gather_files(self, for_cli = False):
+        """ Return (bytes_left, finished, active, queued) file information,
+            rebuilt only after the job has changed
+        """
+        try:
+            return self.info_cache[for_cli]
+        except KeyError:
+            pass
+
         bytes_left_all = 0
 
         active_files = []
@@ -1286,6 +1519,14 @@ class NzbObject(TryList):
 
                 queued_files.append((_set, bytes_left, bytes, filename, date))
 
+        info = (bytes_left_all, finished_files, active_files, queued_files)
+        self.info_cache[for_cli] = info
+        self.info_cache['remaining'] = bytes_left_all
+        return info
+
+    def gather_info(self, for_cli = False):
+        bytes_left_all, finished_files, active_files, queued_files = self.gather_files(for_cli)
+
         avg_date = self.avg_date
         if for_cli:
             avg_date = time.mktime(avg_date.timetuple())
@@ -1298,6 +1539,25 @@ class NzbObject(TryList):
                 len(self.nzo_info.get('missing_art_log', []))
                 )
 
+    def gather_summary(self):
+        """ Return gather_info without the file lists, small enough to
+            be saved in the queue file
+        """
+        return (self.repair, self.unpack, self.delete, self.script,
+                self.nzo_id, self.final_name_pw, {},
+                self.msgid, self.cat, self.url,
+                self.remaining(), self.bytes, self.avg_date,
+                [], [], [], self.status, self.priority,
+                len(self.nzo_info.get('missing_art_log', []))
+                )
+
+    def new_nzf_id(self):
+        """ Return an unused NZF_ID, without creating an admin file """
+        n = len(self.files_table)
+        while 'SABnzbd_nzf_%d' % n in self.files_table:
+            n += 1
+        return 'SABnzbd_nzf_%d' % n
+
     def get_nzf_by_id(self, nzf_id):
         if nzf_id in self.files_table:
             return self.files_table[nzf_id]
@@ -1326,15 +1586,143 @@ class NzbObject(TryList):
             self.unpack_info[key] = [msg]
 
     def set_action_line(self, action=None, msg=None):
+        stage = (self.action_line or '').partition(': ')[0]
         if action and msg:
             self.action_line = '%s: %s' % (action, msg)
         else:
             self.action_line = ''
+        revisions.bump('history', self.nzo_id)
+        # Progress within a stage is rate limited, a new stage always goes out
+        if self.action_line.partition(': ')[0] != stage or events.due('postproc'):
+            events.post('postproc', {'nzo_id' : self.nzo_id, 'status' : self.status, 'action_line' : self.action_line})
 
     @property
     def repair_opts(self):
         return self.repair, self.unpack, self.delete
 
+    def log_change(self, *entry):
+        """ Record a change of the job in its journal """
+        if self.nzo_id and not self.futuretype:
+            self.journal.add(entry)
+
+    def log_article(self, article, found):
+        """ Record a finished article in the journal
+            The entry is held until the file is on disk, the data
+            may still be in the cache only.
+        """
+        nzf = article.nzf
+        self.journal.add_name(nzf.nzf_id, nzf.filename, nzf.type, nzf.direct)
+        self.journal.add(('article', nzf.nzf_id, article.partnum, found, article.offset),
+                         hold=nzf.nzf_id)
+
+    def log_file_done(self, nzf):
+        """ Record the articles of a file that is on disk (or will not be) """
+        self.journal.release(nzf.nzf_id)
+        self.save_journal()
+
+    def set_assembled(self, nzf, assembled, size):
+        """ Record how far the part file of nzf is written,
+            before the written articles are removed from disk
+        """
+        nzf.assembled = assembled
+        nzf.assembled_size = size
+        self.log_change('assembled', nzf.nzf_id, assembled, size)
+        self.save_journal()
+
+    def log_order(self):
+        """ Record the order of the files in the journal """
+        self.log_change('order', [nzf.nzf_id for nzf in self.files])
+        self.save_journal()
+
+    def save_journal(self):
+        """ Write the logged changes to disk """
+        if self.nzo_id and not self.futuretype:
+            self.journal.flush(self.workpath, self.journal_gen or 0)
+
+    @synchronized(JOURNAL_LOCK)
+    def save_snapshot(self):
+        """ Save the complete job and start a new journal
+            No change can be logged in between, it would be lost.
+        """
+        if self.futuretype:
+            sabnzbd.save_data(self, self.nzo_id, self.workpath)
+            return
+        # A crash before the new journal is written leaves a
+        # journal of the previous generation, which is then ignored
+        self.journal_gen = (self.journal_gen or 0) + 1
+        sabnzbd.save_data(self, self.nzo_id, self.workpath)
+        try:
+            size = os.path.getsize(os.path.join(self.workpath, self.nzo_id))
+        except OSError:
+            size = 0
+        self.journal.reset(self.workpath, self.journal_gen, size)
+
+    def replay_journal(self):
+        """ Apply the changes logged after the last snapshot,
+            return True when there were any
+        """
+        if self.futuretype:
+            return False
+        entries = self.journal.load(self.workpath, self.journal_gen or 0)
+        if not entries:
+            return False
+        logging.info('Replaying %s changes of %s', len(entries), self.final_name)
+        self.journal.active = False
+        try:
+            for entry in entries:
+                kind = entry[0]
+                if kind == 'article':
+                    nzf = self.files_table.get(entry[1])
+                    if nzf and not nzf.deleted:
+                        if not nzf.import_finished:
+                            nzf.finish_import()
+                        article = nzf.decodetable.get(entry[2])
+                        if article and len(entry) > 4:
+                            article.offset = entry[4]
+                        if article and article in nzf.articles:
+                            self.remove_article(article, entry[3])
+                elif kind == 'assembled':
+                    nzf = self.files_table.get(entry[1])
+                    if nzf and not nzf.deleted:
+                        if not nzf.import_finished:
+                            nzf.finish_import()
+                        nzf.assembled, nzf.assembled_size = entry[2], entry[3]
+                        # Already in the part file, no need to download again
+                        for partnum in sorted(nzf.decodetable)[:entry[2]]:
+                            article = nzf.decodetable[partnum]
+                            if article in nzf.articles:
+                                self.remove_article(article, True)
+                elif kind == 'name':
+                    nzf = self.files_table.get(entry[1])
+                    if nzf:
+                        nzf.filename, nzf.type = entry[2], entry[3]
+                        if len(entry) > 4 and entry[4] is not None:
+                            nzf.direct = entry[4]
+                elif kind == 'bytes':
+                    self.bytes_downloaded = entry[1]
+                elif kind == 'priority':
+                    self.priority = entry[1]
+                elif kind == 'status':
+                    if entry[1] == Status.QUEUED:
+                        self.resume()
+                    else:
+                        self.status = entry[1]
+                elif kind == 'order':
+                    files = [self.files_table[nzf_id] for nzf_id in entry[1]
+                             if nzf_id in self.files_table and self.files_table[nzf_id] in self.files]
+                    self.files = files + [nzf for nzf in self.files if nzf not in files]
+                    self.reset_ready()
+                elif kind == 'remove':
+                    nzf = self.files_table.get(entry[1])
+                    if nzf:
+                        self.remove_nzf(nzf)
+        except:
+            logging.error(Ta('Error while replaying journal of %s'), self.final_name)
+            logging.info("Traceback: ", exc_info = True)
+        self.files_changed()
+        self.journal.active = True
+        return True
+
     def save_attribs(self):
         set_attrib_file(self.workpath, (self.cat, self.pp, self.script, self.priority, self.final_name_pw_clean, self.url))
 
@@ -1372,8 +1760,15 @@ class NzbObject(TryList):
                 # Handle new attributes
                 self.__dict__[tup[1]] = None
         self.pp_active = False
+        # Older queues stored a list
+        self.saved_articles = set(self.saved_articles or ())
         self.avg_stamp = time.mktime(self.avg_date.timetuple())
         self.wait = None
+        self.journal_gen = self.journal_gen or 0
+        self.journal = Journal()
+        self.info_cache = {}
+        self.ready_pos = {}
+        self.ready_epoch = current_epoch()
         TryList.__init__(self)
 
 
@@ -0,0 +1,293 @@
+#!/usr/bin/python -OO
+# Copyright 2008-2012 The SABnzbd-Team <team@sabnzbd.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+sabnzbd.poller - socket event polling for the downloader
+"""
+
+import errno
+import logging
+import select
+import socket
+
+HAVE_EPOLL = hasattr(select, 'epoll')
+
+
+#------------------------------------------------------------------------------
+def socket_pair():
+    """ Return pair of connected sockets, Windows has no socket.socketpair() """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sender.connect(listener.getsockname())
+        receiver = listener.accept()[0]
+    finally:
+        listener.close()
+    return receiver, sender
+
+
+class Wakeup(object):
+    """ Self-pipe that lets other threads interrupt a waiting poll,
+        its receiving end is part of every poll
+    """
+    def __init__(self):
+        self.receiver, self.sender = socket_pair()
+        self.receiver.setblocking(0)
+        self.sender.setblocking(0)
+        self.pending = False
+
+    def fileno(self):
+        return self.receiver.fileno()
+
+    def wake(self):
+        """ Make the current or next poll return """
+        if not self.pending:
+            self.pending = True
+            try:
+                self.sender.send('x')
+            except socket.error:
+                # Full or closed, either way nobody needs another byte
+                pass
+
+    def clear(self):
+        """ Consume the wakeups, called after each poll
+            The flag is reset only after draining: a wake() before that
+            needs no byte, its caller's changes are seen before the next poll.
+            Resetting it first could drain the byte of a wake() that set it,
+            leaving the flag set and all later wakeups skipped.
+        """
+        try:
+            while self.receiver.recv(4096):
+                pass
+        except socket.error:
+            pass
+        self.pending = False
+
+    def close(self):
+        for sock in (self.receiver, self.sender):
+            try:
+                sock.close()
+            except:
+                pass
+
+
+#------------------------------------------------------------------------------
+class SelectPoller(object):
+    """ Portable poller based on select.select()
+        Limited to FD_SETSIZE sockets, the key lists are only
+        rebuilt when the registrations have changed.
+    """
+    name = 'select'
+
+    def __init__(self):
+        self.read_fds = {}
+        self.write_fds = {}
+        self.__wakeup = Wakeup()
+        self.__readkeys = [self.__wakeup.fileno()]
+        self.__writekeys = []
+        self.__dirty = False
+
+    def register(self, fileno, nw, write=False):
+        """ Set interest of 'fileno' to either write or read """
+        if write:
+            self.read_fds.pop(fileno, None)
+            self.write_fds[fileno] = nw
+        else:
+            self.write_fds.pop(fileno, None)
+            self.read_fds[fileno] = nw
+        self.__dirty = True
+
+    def unregister(self, fileno):
+        """ Remove 'fileno', no matter what the current interest is """
+        if fileno in self.read_fds or fileno in self.write_fds:
+            self.read_fds.pop(fileno, None)
+            self.write_fds.pop(fileno, None)
+            self.__dirty = True
+
+    def lookup(self, fileno):
+        """ Return the NewsWrapper registered for 'fileno' """
+        return self.read_fds.get(fileno) or self.write_fds.get(fileno)
+
+    def find(self, nw):
+        """ Find the fileno matching the nw, needed for closed connections """
+        for fileno in self.read_fds.keys() + self.write_fds.keys():
+            if self.lookup(fileno) is nw:
+                return fileno
+        return None
+
+    def reading(self, fileno):
+        return fileno in self.read_fds
+
+    def empty(self):
+        return not (self.read_fds or self.write_fds)
+
+    def poll(self, timeout):
+        """ Wait for events at most 'timeout' seconds (None is until woken up),
+            return (readable, writable) lists of filenos
+        """
+        if self.__dirty:
+            # Only the downloader thread registers sockets, so nothing
+            # can change between taking the snapshot and clearing the flag
+            self.__readkeys = self.read_fds.keys() + [self.__wakeup.fileno()]
+            self.__writekeys = self.write_fds.keys()
+            self.__dirty = False
+        # Windows reports failed connects as exceptions, not as writable
+        read, write, error = select.select(self.__readkeys, self.__writekeys, self.__writekeys, timeout)
+        if error:
+            write = list(set(write).union(error))
+        if self.__wakeup.fileno() in read:
+            self.__wakeup.clear()
+            read.remove(self.__wakeup.fileno())
+        return read, write
+
+    def wake(self):
+        """ Interrupt the current or next poll, can be called from any thread """
+        self.__wakeup.wake()
+
+    def close(self):
+        self.read_fds = {}
+        self.write_fds = {}
+        self.__dirty = True
+        self.__wakeup.close()
+
+
+#------------------------------------------------------------------------------
+class EpollPoller(object):
+    """ Linux epoll based poller
+        Sockets are registered once and only interest changes
+        are passed to the kernel, so a wakeup costs O(active sockets).
+    """
+    name = 'epoll'
+
+    def __init__(self):
+        self.__epoll = select.epoll()
+        self.__nws = {}      # fileno -> NewsWrapper
+        self.__events = {}   # fileno -> registered event mask
+        self.__wakeup = Wakeup()
+        self.__epoll.register(self.__wakeup.fileno(), select.EPOLLIN)
+
+    def register(self, fileno, nw, write=False):
+        """ Set interest of 'fileno' to either write or read """
+        if write:
+            mask = select.EPOLLOUT
+        else:
+            mask = select.EPOLLIN | select.EPOLLPRI
+        self.__nws[fileno] = nw
+        old = self.__events.get(fileno)
+        if old == mask:
+            return
+        self.__events[fileno] = mask
+        try:
+            if old is None:
+                self.__epoll.register(fileno, mask)
+            else:
+                self.__epoll.modify(fileno, mask)
+        except IOError, e:
+            if e.errno == errno.EEXIST:
+                self.__epoll.modify(fileno, mask)
+            elif e.errno == errno.ENOENT:
+                self.__epoll.register(fileno, mask)
+            else:
+                raise
+
+    def unregister(self, fileno):
+        """ Remove 'fileno', no matter what the current interest is """
+        self.__nws.pop(fileno, None)
+        if self.__events.pop(fileno, None) is not None:
+            try:
+                self.__epoll.unregister(fileno)
+            except (IOError, ValueError):
+                # Socket was already closed, the kernel dropped it for us
+                pass
+
+    def lookup(self, fileno):
+        """ Return the NewsWrapper registered for 'fileno' """
+        return self.__nws.get(fileno)
+
+    def find(self, nw):
+        """ Find the fileno matching the nw, needed for closed connections """
+        for fileno, _nw in self.__nws.items():
+            if _nw is nw:
+                return fileno
+        return None
+
+    def reading(self, fileno):
+        return bool(self.__events.get(fileno, 0) & select.EPOLLIN)
+
+    def empty(self):
+        return not self.__events
+
+    def poll(self, timeout):
+        """ Wait for events at most 'timeout' seconds (None is until woken up),
+            return (readable, writable) lists of filenos
+        """
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.__epoll.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return [], []
+            raise
+        read = []
+        write = []
+        for fileno, event in events:
+            mask = self.__events.get(fileno)
+            if mask is None:
+                if fileno == self.__wakeup.fileno():
+                    self.__wakeup.clear()
+                continue
+            if mask & select.EPOLLOUT:
+                write.append(fileno)
+            else:
+                # Errors and hang-ups are reported as readable,
+                # the following recv() will report the problem.
+                read.append(fileno)
+        return read, write
+
+    def wake(self):
+        """ Interrupt the current or next poll, can be called from any thread """
+        self.__wakeup.wake()
+
+    def close(self):
+        self.__nws = {}
+        self.__events = {}
+        try:
+            self.__epoll.close()
+        except:
+            pass
+        self.__wakeup.close()
+
+
+#------------------------------------------------------------------------------
+def create_poller(kind):
+    """ Return poller of requested kind ('auto', 'epoll' or 'select'),
+        falling back to select() when the kind is not available
+    """
+    kind = (kind or 'auto').lower()
+    if kind in ('auto', 'epoll') and HAVE_EPOLL:
+        try:
+            return EpollPoller()
+        except (IOError, OSError):
+            logging.info('Cannot create epoll object, using select()')
+    elif kind == 'epoll':
+        logging.info('epoll is not available on this platform, using select()')
+    return SelectPoller()
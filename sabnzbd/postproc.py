@@ -47,6 +47,7 @@ import sabnzbd.cfg as cfg
 import sabnzbd.nzbqueue
 import sabnzbd.database as database
 import sabnzbd.growler as growler
+import sabnzbd.revisions as revisions
 
 
 #------------------------------------------------------------------------------
@@ -115,6 +116,7 @@ class PostProcessor(Thread):
         """ Push on finished job in the queue """
         if nzo not in self.history_queue:
             self.history_queue.append(nzo)
+        revisions.bump('history', nzo.nzo_id)
         self.queue.put(nzo)
         self.save()
 
@@ -125,6 +127,7 @@ class PostProcessor(Thread):
         except:
             nzo_id = getattr(nzo, 'nzo_id', 'unknown id')
             logging.error(Ta('Failed to remove nzo from postproc queue (id)') + ' ' + nzo_id)
+        revisions.bump('history', getattr(nzo, 'nzo_id', None))
         self.save()
 
     def stop(self):
@@ -178,6 +181,7 @@ class PostProcessor(Thread):
 
             ## Flag NZO as being processed
             nzo.pp_active = True
+            revisions.bump('history', nzo.nzo_id)
 
             ## Pause downloader, if users wants that
             if cfg.pause_on_post_processing():
@@ -511,8 +515,6 @@ def process_job(nzo):
     # Add the nzo to the database. Only the path, script and time taken is passed
     # Other information is obtained from the nzo
     history_db.add_history_db(nzo, workdir_complete, nzo.downpath, postproc_time, script_log, script_line)
-    # The connection is only used once, so close it here
-    history_db.close()
 
     ## Clean up the NZO
     try:
@@ -0,0 +1,77 @@
+#!/usr/bin/python -OO
+# Copyright 2008-2012 The SABnzbd-Team <team@sabnzbd.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+sabnzbd.revisions - revision counter for changes of queue and history
+"""
+
+import time
+from threading import Lock
+
+from sabnzbd.constants import MAX_REVISION_ITEMS
+
+#------------------------------------------------------------------------------
+# Every change of the queue, post-processing or history raises the revision.
+# Per job the revision of its last change is kept, so API clients
+# can ask for only the jobs that changed after the revision they have.
+
+__LOCK = Lock()
+
+# Start beyond any revision handed out before a restart,
+# so that clients cannot mistake an old revision for a recent one
+__BASE = int(time.time() * 1000)
+__REVISION = __BASE
+__ITEMS = {}    # (section, nzo_id) -> revision of last change
+
+
+def bump(section, nzo_id=None):
+    """ Register a change of job 'nzo_id' in 'section' ('queue' or 'history'),
+        without 'nzo_id' only the order or the set of jobs changed
+    """
+    global __REVISION, __BASE
+    __LOCK.acquire()
+    try:
+        __REVISION += 1
+        if nzo_id:
+            __ITEMS[(section, nzo_id)] = __REVISION
+            if len(__ITEMS) > MAX_REVISION_ITEMS:
+                # Forget the oldest half, older revisions get a full answer
+                revs = sorted(__ITEMS.itervalues())
+                __BASE = revs[len(revs) / 2]
+                for key, rev in __ITEMS.items():
+                    if rev <= __BASE:
+                        del __ITEMS[key]
+        return __REVISION
+    finally:
+        __LOCK.release()
+
+
+def current():
+    """ Return the current revision """
+    return __REVISION
+
+
+def valid(since):
+    """ Return True when changes after revision 'since' are known """
+    return since is not None and __BASE <= since <= __REVISION
+
+
+def changed(section, nzo_id, since):
+    """ Return True when job 'nzo_id' changed after revision 'since' """
+    if not valid(since):
+        return True
+    return __ITEMS.get((section, nzo_id), __BASE) > since
@@ -31,9 +31,11 @@ from sabnzbd.newzbin import Bookmarks
 import sabnzbd.downloader
 import sabnzbd.dirscanner
 import sabnzbd.misc
+import sabnzbd.database
 import sabnzbd.config as config
 import sabnzbd.cfg as cfg
 from sabnzbd.postproc import PostProcessor
+from sabnzbd.constants import DB_VACUUM_INTERVAL, DECODER_SAMPLE_INTERVAL
 
 
 __SCHED = None  # Global pointer to Scheduler instance
@@ -129,6 +131,14 @@ def init():
     __SCHED.add_interval_task(sched_guardian, "Guardian", 15, 30,
                                   kronos.method.sequential, None, None)
 
+    # Measure the load of the decoder threads
+    __SCHED.add_interval_task(sample_decoder, "DecoderLoad", DECODER_SAMPLE_INTERVAL, DECODER_SAMPLE_INTERVAL,
+                                  kronos.method.sequential, None, None)
+
+    # Return free space of the history database in small steps
+    __SCHED.add_interval_task(sabnzbd.database.vacuum_history, "Vacuum", 120, DB_VACUUM_INTERVAL,
+                                  kronos.method.sequential, None, None)
+
     # Set RSS check interval
     if not rss_planned:
         interval = cfg.rss_rate()
@@ -390,12 +400,6 @@ def pause_check():
         sabnzbd.unpause_all()
 
 
-#------------------------------------------------------------------------------
-def plan_server(action, parms, interval):
-    """ Plan to re-activate server after "interval" minutes
-    """
-    __SCHED.add_single_task(action, '', interval*60, kronos.method.sequential, parms, None)
-
 #------------------------------------------------------------------------------
 def force_rss():
     """ Add a one-time RSS scan, one second from now
@@ -421,6 +425,10 @@ def sched_guardian():
     global __SCHED_GUARDIAN, __SCHED_GUARDIAN_CNT
     __SCHED_GUARDIAN = True
 
+def sample_decoder():
+    if sabnzbd.downloader.Downloader.do:
+        sabnzbd.downloader.Downloader.do.decoder.sample()
+
 def sched_check():
     global __SCHED_GUARDIAN, __SCHED_GUARDIAN_CNT
     if not __SCHED_GUARDIAN:
@@ -0,0 +1,110 @@
+#!/usr/bin/python -OO
+# Copyright 2008-2012 The SABnzbd-Team <team@sabnzbd.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+sabnzbd.segmentindex - one file with the segments of all files of a job
+"""
+
+import os
+import mmap
+import struct
+import zlib
+import logging
+import cPickle
+
+from sabnzbd.constants import SEGMENT_INDEX_FILE
+
+# Layout of the index file:
+#   header: magic, version, number of records, end of the last record
+#   record: length and crc32 of the data, followed by the data,
+#           which is the pickled article_db of one NzbFile
+# Records are only appended. Each NzbFile remembers the offset of
+# its own record, so finding the segments of a file needs no table scan.
+# The header is rewritten when the writer is closed, a header that
+# does not cover a record means that the job was not saved completely.
+
+MAGIC = 'SABSEGIX'
+VERSION = 1
+HEADER = struct.Struct('<8sIII')
+RECORD = struct.Struct('<II')
+
+
+class SegmentIndex(object):
+    """ Writer for the segment index of one job """
+    def __init__(self, path):
+        self.path = os.path.join(path, SEGMENT_INDEX_FILE)
+        self.count = 0
+        self.f = open(self.path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION, 0, HEADER.size))
+        self.end = HEADER.size
+
+    def append(self, article_db):
+        """ Store article_db, return the offset of its record """
+        data = cPickle.dumps(article_db, 2)
+        offset = self.end
+        self.f.write(RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self.f.write(data)
+        self.end += RECORD.size + len(data)
+        self.count += 1
+        return offset
+
+    def close(self):
+        """ Complete the header and flush it all to disk, just once """
+        if self.f:
+            try:
+                self.f.seek(0)
+                self.f.write(HEADER.pack(MAGIC, VERSION, self.count, self.end))
+                self.f.flush()
+                os.fsync(self.f.fileno())
+            except (IOError, OSError):
+                logging.error(Ta('Saving %s failed'), self.path)
+                logging.info("Traceback: ", exc_info = True)
+            self.f.close()
+            self.f = None
+
+
+def load_segments(path, offset):
+    """ Return the article_db stored at 'offset' in the index file
+        in folder 'path', or None when it cannot be read.
+    """
+    path = os.path.join(path, SEGMENT_INDEX_FILE)
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        logging.info("%s missing", path)
+        return None
+    try:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version, count, end = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != VERSION or offset + RECORD.size > end:
+                    raise ValueError('bad header')
+                size, crc = RECORD.unpack_from(mm, offset)
+                start = offset + RECORD.size
+                data = mm[start:start + size]
+                if start + size > end or zlib.crc32(data) & 0xffffffff != crc:
+                    raise ValueError('bad record')
+                return cPickle.loads(data)
+            finally:
+                mm.close()
+        except:
+            logging.error(Ta('Loading %s failed'), path)
+            logging.info("Traceback: ", exc_info = True)
+            return None
+    finally:
+        f.close()
@@ -23,7 +23,6 @@ import logging
 from threading import Lock
 
 import sabnzbd
-from sabnzbd.decorators import synchronized
 
 
 # TryList keeps track of which servers have been tried for
@@ -33,32 +32,138 @@ from sabnzbd.decorators import synchronized
 # However, this would break queue compatibility with
 # previous releases (despite the mapping done in nzbstuff).
 
-TRYLIST_LOCK = Lock()
+# Each server gets its own bit, a try list is a bitmask of servers.
+# The bit belongs to the server id, so a restarted server keeps it.
+# Reads need no lock. Changes take TRY_LIST_LOCK: a reset that ran between
+# the read and the write of a concurrent add would otherwise be undone
+# by the add writing the old mask back.
+
+# A try list that was set before the current epoch counts as empty,
+# so all try lists can be reset at once by starting a new epoch.
+
+SERVER_BITS = {}
+SERVER_BITS_LOCK = Lock()
+TRY_LIST_LOCK = Lock()
+_epoch = 0
+
+
+def server_bit(server):
+    """ Return the bit of the server, assign it on first use """
+    key = server.id
+    try:
+        return SERVER_BITS[key]
+    except KeyError:
+        SERVER_BITS_LOCK.acquire()
+        try:
+            if key not in SERVER_BITS:
+                SERVER_BITS[key] = 1L << len(SERVER_BITS)
+            return SERVER_BITS[key]
+        finally:
+            SERVER_BITS_LOCK.release()
+
+
+def new_epoch():
+    """ Clear all try lists at once """
+    global _epoch
+    _epoch += 1
+    if sabnzbd.LOG_ALL: logging.debug("Try lists reset, epoch %s", _epoch)
+
+
+def current_epoch():
+    return _epoch
+
+
+# The helpers below do the work for both classes,
+# which only differ in the names of their two fields.
+
+def _in_list(obj, mask_attr, epoch_attr, server):
+    return getattr(obj, epoch_attr) == _epoch and bool(getattr(obj, mask_attr) & server_bit(server))
+
+
+def _add(obj, mask_attr, epoch_attr, server):
+    bit = server_bit(server)
+    TRY_LIST_LOCK.acquire()
+    try:
+        if getattr(obj, epoch_attr) != _epoch:
+            setattr(obj, mask_attr, 0)
+            setattr(obj, epoch_attr, _epoch)
+        mask = getattr(obj, mask_attr)
+        if not mask & bit:
+            if sabnzbd.LOG_ALL: logging.debug("Appending %s to %s.__try_list", server, obj)
+            setattr(obj, mask_attr, mask | bit)
+    finally:
+        TRY_LIST_LOCK.release()
+
+
+def _remove(obj, mask_attr, epoch_attr, server):
+    bit = server_bit(server)
+    TRY_LIST_LOCK.acquire()
+    try:
+        mask = getattr(obj, mask_attr)
+        if getattr(obj, epoch_attr) == _epoch and mask & bit:
+            if sabnzbd.LOG_ALL: logging.debug("Removing %s from %s.__try_list", server, obj)
+            setattr(obj, mask_attr, mask & ~bit)
+    finally:
+        TRY_LIST_LOCK.release()
+
+
+def _reset(obj, mask_attr, epoch_attr):
+    TRY_LIST_LOCK.acquire()
+    try:
+        setattr(obj, mask_attr, 0)
+        setattr(obj, epoch_attr, _epoch)
+    finally:
+        TRY_LIST_LOCK.release()
+
+
 class TryList:
+    # Mangled names, these are stored in the queue files
+    _MASK = '_TryList__try_mask'
+    _EPOCH = '_TryList__try_epoch'
+
+    def __init__(self):
+        self.__try_mask = 0
+        self.__try_epoch = _epoch
+
+    def server_in_try_list(self, server):
+        """ Return whether specified server has been tried """
+        return _in_list(self, TryList._MASK, TryList._EPOCH, server)
+
+    def add_to_try_list(self, server):
+        """ Register server as having been tried already """
+        _add(self, TryList._MASK, TryList._EPOCH, server)
+
+    def remove_from_try_list(self, server):
+        """ Server is no longer listed as tried """
+        _remove(self, TryList._MASK, TryList._EPOCH, server)
+
+    def reset_try_list(self):
+        """ Clean the list """
+        _reset(self, TryList._MASK, TryList._EPOCH)
+
+
+class SlotTryList(object):
+    """ TryList for objects that use __slots__, the two fields
+        are stored in the object itself instead of a __dict__
+    """
+    __slots__ = ('_try_mask', '_try_epoch')
+
     def __init__(self):
-        self.__try_list = []
+        self._try_mask = 0
+        self._try_epoch = _epoch
 
-    @synchronized(TRYLIST_LOCK)
     def server_in_try_list(self, server):
         """ Return whether specified server has been tried """
-        return (server in self.__try_list)
+        return _in_list(self, '_try_mask', '_try_epoch', server)
 
-    @synchronized(TRYLIST_LOCK)
     def add_to_try_list(self, server):
         """ Register server as having been tried already """
-        if server not in self.__try_list:
-            if sabnzbd.LOG_ALL: logging.debug("Appending %s to %s.__try_list", server, self)
-            self.__try_list.append(server)
+        _add(self, '_try_mask', '_try_epoch', server)
 
-    @synchronized(TRYLIST_LOCK)
     def remove_from_try_list(self, server):
         """ Server is no longer listed as tried """
-        if server in self.__try_list:
-            if sabnzbd.LOG_ALL: logging.debug("Removing %s from %s.__try_list",  server, self)
-            self.__try_list.remove(server)
+        _remove(self, '_try_mask', '_try_epoch', server)
 
-    @synchronized(TRYLIST_LOCK)
     def reset_try_list(self):
         """ Clean the list """
-        if self.__try_list:
-            self.__try_list = []
+        _reset(self, '_try_mask', '_try_epoch')
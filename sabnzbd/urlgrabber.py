@@ -39,6 +39,7 @@ import sabnzbd.misc as misc
 import sabnzbd.dirscanner as dirscanner
 from sabnzbd.nzbqueue import NzbQueue
 import sabnzbd.cfg as cfg
+import sabnzbd.revisions as revisions
 
 _BAD_GZ_HOSTS = ('.zip', 'nzbsa.co.za', 'newshost.za.net')
 
@@ -60,6 +61,7 @@ class URLGrabber(Thread):
         """ Add an URL to the URLGrabber queue, 'when' is seconds from now """
         if when and future_nzo:
             future_nzo.wait = time.time() + when
+            revisions.bump('queue', future_nzo.nzo_id)
         self.queue.put((url, future_nzo))
 
     def rm_bookmark(self, url):